@@ -1,113 +1,321 @@
-import os,json
+import os,json,sys,time,random,importlib,hashlib
+STARTUP_BEGIN = time.perf_counter()
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, jsonify, Response, stream_with_context, send_from_directory, abort
 from flask_pymongo import PyMongo
 from flask_bcrypt import Bcrypt
 from datetime import timedelta, datetime
 from dotenv import load_dotenv
-import requests
 from bson import ObjectId
 from werkzeug.utils import secure_filename
 import os
 from document_parser import extract_text, parse_vuln_txt, chunk_text
-from pinecone import Pinecone, ServerlessSpec
-from sentence_transformers import SentenceTransformer
 import logging
 from flask_cors import CORS
 
 # Load environment variables
 load_dotenv()
 
-# Import cybersec_agent functions
-from cybersec_agent import answer_cybersec_query, should_use_web_search
+# --- Heavy dependencies are created on first use (or by the background warm-up) ---
+from resources import ResourceRegistry
+resources = ResourceRegistry(started=STARTUP_BEGIN)
+
+# cybersec_agent and cybersec load models/clients when imported, so import them lazily
+cybersec_agent = resources.register("cybersec_agent", lambda: importlib.import_module("cybersec_agent"))
+cybersec = resources.register("cybersec", lambda: importlib.import_module("cybersec"))
+
+def answer_cybersec_query(*args, **kwargs):
+    return cybersec_agent.answer_cybersec_query(*args, **kwargs)
+
+def should_use_web_search(*args, **kwargs):
+    return cybersec_agent.should_use_web_search(*args, **kwargs)
 
 # Import cybersec memory functions - removing is_personal_fact as it's not available
-from cybersec import (
-    store_user_memory,
-    retrieve_user_memories,
-    extract_and_store_facts
-)
+def store_user_memory(*args, **kwargs):
+    return cybersec.store_user_memory(*args, **kwargs)
+
+def retrieve_user_memories(*args, **kwargs):
+    return cybersec.retrieve_user_memories(*args, **kwargs)
+
+def extract_and_store_facts(*args, **kwargs):
+    return cybersec.extract_and_store_facts(*args, **kwargs)
+
+# --- Conversations/messages live in their own collections ---
+from conversation_store import ConversationStore, make_snippet
+
+# --- Per-user semantic index of conversation messages ---
+from message_index import MessageIndex
+
+# --- Concurrent per-request stages ---
+from request_stages import RequestStages
+
+# --- Durable background jobs for post-response work ---
+from job_queue import JobQueue, task, start_worker_threads, INGEST_QUEUE, BULK_QUEUE, ABANDONED_ERROR
+
+# --- Persistent cache for document summaries ---
+from summary_cache import SummaryCache, content_hash
+
+# --- Background upload ingestion status ---
+from ingestion import IngestionTracker
+
+# --- Indexed registry of uploaded files ---
+from file_registry import FileRegistry
+
+# --- Packed per-document chunk storage ---
+from chunk_store import ChunkStore, chunk_store_path, write_chunk_store, read_chunk_store_text
+
+# --- Byte-capped LRU of loaded documents ---
+from document_cache import DocumentCache
+DOCUMENT_CACHE_MAX_BYTES = int(os.getenv("DOCUMENT_CACHE_MAX_BYTES", str(128 * 1024 * 1024)))
 
-# --- Import MongoMemoryStore for semantic memory ---
-from mongo_memory_store import MongoMemoryStore
+# --- Shared HTTP client for LLM calls ---
+from llm_client import LLMClient
 
-# Initialize Pinecone and embedding model (singleton)
-pinecone_api_key = os.getenv("PINECONE_API_KEY")
-pc = Pinecone(api_key=pinecone_api_key)
-pinecone_index = pc.Index("files")
-embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+# --- Concurrent map/tree-reduce for large documents ---
+from map_reduce import map_reduce, map_concurrent, MAP_CONCURRENCY
+
+# --- Incremental SSE parsing and delta coalescing for streamed replies ---
+from streaming import iter_completion_deltas, coalesce
+
+# --- Shared embedding model with query cache and micro-batching ---
+from embedding_service import EmbeddingService
+
+# --- Shared cache of web-search answers ---
+from web_answer_cache import WebAnswerCache
+WEB_CACHE_TTL_SECONDS = int(os.getenv("WEB_CACHE_TTL_SECONDS", str(6 * 3600)))
+WEB_CACHE_MAX_ENTRIES = int(os.getenv("WEB_CACHE_MAX_ENTRIES", "5000"))
+WEB_CACHE_SEMANTIC = os.getenv("WEB_CACHE_SEMANTIC", "0") == "1"
+WEB_CACHE_SIMILARITY = float(os.getenv("WEB_CACHE_SIMILARITY", "0.92"))
+
+# --- Token-budgeted prompt assembly ---
+from prompt_assembler import PromptAssembler, count_tokens, history_hash, truncate_to_tokens, PROMPT_TOKEN_BUDGET
+# Tokens of an uploaded document (or its findings) sent with each chat turn
+PROMPT_DOCUMENT_TOKENS = int(os.getenv("PROMPT_DOCUMENT_TOKENS", "1500"))
+# Messages kept word for word when older history is rolled into the conversation summary
+HISTORY_KEEP_RECENT = int(os.getenv("HISTORY_KEEP_RECENT", "6"))
+# Tokens of context added to a web search query
+WEB_QUERY_TOKEN_BUDGET = int(os.getenv("WEB_QUERY_TOKEN_BUDGET", "600"))
+
+# --- One ranked, deduplicated lookup over both memory stores ---
+from memory_retrieval import MemoryRetriever
+
+# --- Local embedding classifiers for fact detection and routing ---
+from intent_classifier import IntentClassifier, PERSONAL_FACT_EXAMPLES, WEB_SEARCH_EXAMPLES, FILE_QUERY_EXAMPLES
+INTENT_MIN_MARGIN = float(os.getenv("INTENT_MIN_MARGIN", "0.06"))
+
+resources.mark("imports")
+
+# Initialize Pinecone and embedding model (singletons, created on first use)
+def _connect_pinecone_index():
+    from pinecone import Pinecone
+    pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
+    return pc.Index("files")
+
+pinecone_index = resources.register("pinecone_index", _connect_pinecone_index)
+embedding_service = EmbeddingService.from_env()
+resources.register("embedding_model", lambda: embedding_service.model)
 
 # --- Helper: Embed and upsert file chunks into Pinecone ---
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+PINECONE_UPSERT_BATCH_SIZE = int(os.getenv("PINECONE_UPSERT_BATCH_SIZE", "100"))
+PINECONE_UPSERT_PARALLEL = int(os.getenv("PINECONE_UPSERT_PARALLEL", "2"))
+
+def _upsert_batch_with_retry(batch, max_retries=3):
+    """
+    Upsert one batch of vectors, retrying the batch if the call fails or upserts fewer vectors than sent.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            result = pinecone_index.upsert(vectors=batch)
+            upserted = getattr(result, "upserted_count", None)
+            if upserted is None and isinstance(result, dict):
+                upserted = result.get("upserted_count")
+            if upserted is None or upserted >= len(batch):
+                return
+            error = RuntimeError(f"Pinecone upserted {upserted}/{len(batch)} vectors")
+        except Exception as e:
+            error = e
+        if attempt == max_retries:
+            raise error
+        delay = (2 ** attempt) * (0.5 + random.random())
+        print(f"[PINECONE] Batch upsert failed ({error}), retrying in {delay:.1f}s", file=sys.stderr)
+        time.sleep(delay)
+
+def embed_file_chunks(file_id, chunks):
+    """
+    Embed a file's chunks in batches of EMBEDDING_BATCH_SIZE.
+    Returns: list of (vector id, embedding, metadata) tuples ready for Pinecone.
+    """
+    if not chunks:
+        return []
+    embeddings = embedding_service.encode_documents(chunks, batch_size=EMBEDDING_BATCH_SIZE)
+    return [
+        (f"{file_id}-chunk{idx}", embedding, {"file_id": file_id, "chunk_index": idx, "text": chunk})
+        for idx, (chunk, embedding) in enumerate(zip(chunks, embeddings))
+    ]
+
+def upsert_vectors_to_pinecone(vectors, batch_size=PINECONE_UPSERT_BATCH_SIZE, parallel=PINECONE_UPSERT_PARALLEL):
+    """
+    Upsert vectors into Pinecone in batches of `batch_size`, with up to `parallel`
+    batches in flight. Each batch is retried on its own, so a partial failure
+    doesn't redo the batches that already went through.
+    """
+    if not vectors:
+        return
+    batches = [vectors[i:i + batch_size] for i in range(0, len(vectors), batch_size)]
+    if parallel > 1 and len(batches) > 1:
+        with ThreadPoolExecutor(max_workers=min(parallel, len(batches)), thread_name_prefix="pinecone") as executor:
+            # list() re-raises the first batch that still failed after its retries
+            list(executor.map(_upsert_batch_with_retry, batches))
+    else:
+        for batch in batches:
+            _upsert_batch_with_retry(batch)
+    print(f"[PINECONE] Upserted {len(vectors)} vectors in {len(batches)} batch(es)")
+
 def upsert_file_chunks_to_pinecone(file_id, file_content, max_chars=2000):
     from document_parser import chunk_text
     chunks = chunk_text(file_content, max_chars=max_chars)
-    embeddings = embedding_model.encode(chunks).tolist()
-    for idx, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
-        pinecone_index.upsert([(f"{file_id}-chunk{idx}", embedding, {"file_id": file_id, "chunk_index": idx, "text": chunk})])
+    upsert_vectors_to_pinecone(embed_file_chunks(file_id, chunks))
     return len(chunks)
 
 # --- Helper: Retrieve relevant chunks for a question ---
 def retrieve_relevant_chunks_from_pinecone(question, file_id=None, top_k=5):
-    q_embedding = embedding_model.encode([question]).tolist()[0]
+    q_embedding = embedding_service.embed_query(question)
     filter_dict = {"file_id": {"$eq": file_id}} if file_id else None
     results = pinecone_index.query(vector=q_embedding, top_k=top_k, include_metadata=True, filter=filter_dict)
     return [match['metadata']['text'] for match in results['matches']]
 
 # --- Helper: Q&A over Pinecone-retrieved chunks ---
-def qa_cybersec_pinecone(question, file_id, llm_api_func, model=None, top_k=5):
-    relevant_chunks = retrieve_relevant_chunks_from_pinecone(question, file_id=file_id, top_k=top_k)
-    all_answers = []
-    for chunk in relevant_chunks:
-        prompt = (
-            f"Based on the following document section, answer the question:\n"
-            f"{chunk}\n\nQuestion: {question}\n"
-            "If the content is not related to cybersecurity, respond with: "
-            "'I can only help with cybersecurity topics. Please ask something related to web security, hacking, threats, or protection.'"
+QA_CONTEXT_TOKEN_BUDGET = int(os.getenv("QA_CONTEXT_TOKEN_BUDGET", "6000"))
+
+def estimate_tokens(text):
+    """Token count for budgeting prompts (tiktoken when installed, ~4 characters per token otherwise)."""
+    return count_tokens(text)
+
+def qa_cybersec_pinecone(question, file_id, llm_api_func, model=None, top_k=5, mode="auto", stream=False,
+                         llm_stream_func=None, max_context_tokens=QA_CONTEXT_TOKEN_BUDGET, concurrency=MAP_CONCURRENCY,
+                         fallback_text=None):
+    """
+    Answer a question from the top_k Pinecone chunks of a file.
+    - mode: "stuffed" packs every chunk into one prompt, "fanout" answers per chunk
+      concurrently (at most `concurrency` calls in flight) and then aggregates,
+      "auto" stuffs when the chunks fit in max_context_tokens and fans out otherwise.
+    - stream: if True, returns an iterator of text deltas for the final call, streamed through llm_stream_func.
+    - fallback_text: the document itself, used (cut to max_context_tokens) when the file has
+      no vectors yet, e.g. while it is still being indexed.
+    Returns: the answer string, or a generator when stream=True.
+    """
+    try:
+        relevant_chunks = retrieve_relevant_chunks_from_pinecone(question, file_id=file_id, top_k=top_k)
+    except Exception as e:
+        if fallback_text is None:
+            raise
+        print(f"DEBUG QA: Pinecone retrieval failed ({e}), using the document text")
+        relevant_chunks = []
+    if not relevant_chunks and fallback_text:
+        relevant_chunks = [truncate_to_tokens(fallback_text, max_context_tokens - estimate_tokens(question))]
+    refusal = (
+        "If the content is not related to cybersecurity, respond with: "
+        "'I can only help with cybersecurity topics. Please ask something related to web security, hacking, threats, or protection.'"
+    )
+
+    if mode == "auto":
+        context_tokens = sum(estimate_tokens(chunk) for chunk in relevant_chunks) + estimate_tokens(question)
+        mode = "stuffed" if context_tokens <= max_context_tokens else "fanout"
+        print(f"DEBUG QA: {len(relevant_chunks)} chunks, ~{context_tokens} tokens -> {mode} mode")
+
+    if mode == "stuffed":
+        sections = "\n\n".join(f"[Section {i+1}]\n{chunk}" for i, chunk in enumerate(relevant_chunks))
+        final_prompt = (
+            f"Based on the following document sections, answer the question:\n"
+            f"{sections}\n\nQuestion: {question}\n"
+            + refusal
         )
-        answer = llm_api_func(prompt, model=model)
-        all_answers.append(answer)
-    # Aggregate answers
-    final_prompt = "Combine and summarize these answers, focusing only on cybersecurity-related content. If none of the content is cybersecurity-related, respond with: 'I can only help with cybersecurity topics. Please ask something related to web security, hacking, threats, or protection.'\n" + "\n".join(all_answers)
-    final_answer = llm_api_func(final_prompt, model=model)
-    return final_answer
+    else:
+        def answer_chunk(chunk):
+            prompt = (
+                f"Based on the following document section, answer the question:\n"
+                f"{chunk}\n\nQuestion: {question}\n"
+                + refusal
+            )
+            return llm_api_func(prompt, model=model)
+        all_answers = [a for a in map_concurrent(answer_chunk, relevant_chunks, concurrency) if a]
+        # Aggregate answers
+        final_prompt = "Combine and summarize these answers, focusing only on cybersecurity-related content. If none of the content is cybersecurity-related, respond with: 'I can only help with cybersecurity topics. Please ask something related to web security, hacking, threats, or protection.'\n" + "\n".join(all_answers)
+
+    if stream:
+        if llm_stream_func is None:
+            # No streaming client given: deliver the whole answer as a single chunk
+            return iter([llm_api_func(final_prompt, model=model)])
+        return llm_stream_func(final_prompt, model=model)
+    return llm_api_func(final_prompt, model=model)
 
 # --- Local implementation of is_personal_fact ---
 def is_personal_fact(text):
     """
-    Determine if text contains personal factual information worth remembering for security context
+    Determine if text contains personal factual information worth remembering for security context.
+    Messages the local classifier is confident carry no fact are answered without the LLM;
+    the rest go to the LLM, which also extracts the fact.
     Returns: tuple of (bool, str) - (contains_fact, extracted_fact)
     """
-    # Initialize with default return values
-    contains_fact = False
-    extracted_fact = ""
-
+    label, margin, confident = fact_classifier.predict(text)
+    if confident and label == "no_fact":
+        fact_classifier.log(text, label, "local", margin)
+        return False, ""
     try:
-        # Use the global LLM from cybersec_agent
-        from cybersec_agent import llm
-
-        system_prompt = (
-            "You analyze text to determine if it contains personal information worth remembering for a security context.\n"
-            "Examples: system configurations, security tools used, industries, work environments, software versions.\n"
-            "If it DOES contain important personal context, respond with 'YES: <the factual information>'.\n"
-            "If it does NOT contain important personal context, respond with 'NO'.\n"
-        )
-        
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": text}
-        ]
-        
-        response = llm.invoke(messages)
-        response_text = response.content.strip()
-        
-        if response_text.upper().startswith("YES:"):
-            # Extract the personal fact from the response
-            fact = response_text[4:].strip()
-            return True, fact
-        else:
-            return False, ""
+        result = _llm_personal_fact(text)
     except Exception as e:
         print(f"Error in is_personal_fact: {e}")
         return False, ""
+    fact_classifier.log(text, "fact" if result[0] else "no_fact", "fallback", margin)
+    return result
+
+def _llm_personal_fact(text):
+    # Use the global LLM from cybersec_agent
+    from cybersec_agent import llm
+
+    system_prompt = (
+        "You analyze text to determine if it contains personal information worth remembering for a security context.\n"
+        "Examples: system configurations, security tools used, industries, work environments, software versions.\n"
+        "If it DOES contain important personal context, respond with 'YES: <the factual information>'.\n"
+        "If it does NOT contain important personal context, respond with 'NO'.\n"
+    )
+    
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": text}
+    ]
+    
+    response = llm.invoke(messages)
+    response_text = response.content.strip()
+    
+    if response_text.upper().startswith("YES:"):
+        # Extract the personal fact from the response
+        fact = response_text[4:].strip()
+        return True, fact
+    else:
+        return False, ""
+
+def store_detected_fact(fact_result, user_id, conversation_id, conversation_title):
+    """
+    Store the output of is_personal_fact as a user memory if it found a fact.
+    """
+    contains_fact, extracted_fact = fact_result
+    if not contains_fact:
+        return
+    print(f"💾 DEBUG: Storing personal fact for user {user_id}: {extracted_fact}")
+    print(f"💾 DEBUG: Storing in conversation '{conversation_title}' (ID: {conversation_id})")
+    store_user_memory(
+        user_id, 
+        extracted_fact,
+        conversation_id=conversation_id,
+        conversation_title=conversation_title,
+        mem_type="fact",
+        is_factual=True,
+        importance=0.8,
+        topic="cybersecurity"
+    )
+    print(f"💾 DEBUG: Personal fact stored successfully!")
 
 MONGO_URI = "mongodb://localhost:27017/Moktashef-DEV"
 API_KEY = os.getenv("API_KEY")
@@ -127,9 +335,9 @@ app = Flask(__name__)
 CORS(app, 
      origins=["http://localhost:3000", "http://localhost:5173", "http://localhost:5174", "http://127.0.0.1:3000", "http://127.0.0.1:5173", "http://127.0.0.1:5174"],
      supports_credentials=True,
-     allow_headers=["Content-Type", "Authorization", "accesstoken", "X-Request-With", "Accept", "Origin"],
+     allow_headers=["Content-Type", "Authorization", "accesstoken", "X-Request-With", "Accept", "Origin", "If-None-Match"],
      methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-     expose_headers=["Content-Type", "X-Web-Search-Used"]
+     expose_headers=["Content-Type", "X-Web-Search-Used", "X-Web-Search-Cached", "ETag"]
 )
 
 app.config["MONGO_URI"] = MONGO_URI
@@ -139,38 +347,380 @@ mongo = PyMongo(app)
 bcrypt = Bcrypt(app)
 
 # --- Initialize MongoMemoryStore ---
-memory_store = MongoMemoryStore(MONGO_URI, db_name="vuln_analyzer", collection_name="memories")
+def _create_memory_store():
+    from mongo_memory_store import MongoMemoryStore
+    return MongoMemoryStore(MONGO_URI, db_name="vuln_analyzer", collection_name="memories")
+
+memory_store = resources.register("memory_store", _create_memory_store)
+
+# --- Initialize unified memory retrieval (cybersec user memories + MongoMemoryStore) ---
+memory_retriever = MemoryRetriever({
+    "cybersec": retrieve_user_memories,
+    "memory_store": lambda user_id, query, conversation_id: memory_store.get_relevant_memories(user_id, query, conversation_id)
+}, embedding_service)
+
+# --- Initialize ConversationStore ---
+conversation_store = ConversationStore(mongo.db)
+
+def user_exists(user_id):
+    """Check the user exists without loading the whole user document."""
+    return mongo.db.users.find_one({"_id": ObjectId(user_id)}, {"_id": 1}) is not None
+
+# --- Initialize SummaryCache ---
+summary_cache = SummaryCache(mongo.db.summary_cache)
+
+# --- Initialize the uploaded file registry ---
+file_registry = FileRegistry(mongo.db.files)
+
+# --- Initialize upload ingestion status tracking ---
+ingestion_tracker = IngestionTracker(mongo.db.ingest_jobs)
+
+# How long a chat request waits for an attached file that is still being ingested
+INGEST_WAIT_SECONDS = float(os.getenv("INGEST_WAIT_SECONDS", "10"))
+
+def wait_for_document(file_id, timeout=INGEST_WAIT_SECONDS):
+    """
+    Wait until an uploaded file's chunk stage is done (chat can use it from then on).
+    Returns: (state, job) with state "ready", "processing" (still not chunked after
+    timeout seconds) or "failed"; job is the ingest job (None for untracked files).
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        job = ingestion_tracker.find_by_file(file_id)
+        if job is None or job["chunked"]:
+            return "ready", job
+        if job["status"] == "failed":
+            return "failed", job
+        if time.monotonic() >= deadline:
+            return "processing", job
+        time.sleep(0.5)
+
+def document_not_ready_response(state, job):
+    if state == "failed":
+        return jsonify({"msg": f"The file could not be processed: {job['error']}"}), 400
+    return jsonify({
+        "msg": "The file is still being processed. Please try again in a moment.",
+        "status": "processing",
+        "job_id": job["job_id"],
+        "status_url": f"/upload/status/{job['job_id']}"
+    }), 409
+
+# --- Initialize the job queue (run `python worker.py` for a standalone worker) ---
+job_queue = JobQueue(mongo.db.jobs)
+
+# --- Initialize the intent classifiers (decisions are logged to intent_decisions) ---
+fact_classifier = IntentClassifier("personal_fact", PERSONAL_FACT_EXAMPLES, embedding_service,
+                                   min_margin=INTENT_MIN_MARGIN, decision_log=mongo.db.intent_decisions)
+web_search_classifier = IntentClassifier("web_search", WEB_SEARCH_EXAMPLES, embedding_service,
+                                         min_margin=INTENT_MIN_MARGIN, decision_log=mongo.db.intent_decisions)
+# Its fallback is a keyword check, whose mistakes ("explain XSS" -> file) must not become examples
+file_query_classifier = IntentClassifier("file_query", FILE_QUERY_EXAMPLES, embedding_service,
+                                         min_margin=INTENT_MIN_MARGIN, decision_log=mongo.db.intent_decisions,
+                                         learn_from_log=False)
+intent_classifiers = (fact_classifier, web_search_classifier, file_query_classifier)
+
+def route_web_search(message):
+    """Whether a message needs web search: the local classifier when confident, else cybersec_agent's check."""
+    label, margin, confident = web_search_classifier.predict(message)
+    if confident:
+        web_search_classifier.log(message, label, "local", margin)
+        return label == "web"
+    use_web = bool(should_use_web_search(message))
+    web_search_classifier.log(message, "web" if use_web else "no_web", "fallback", margin)
+    return use_web
+
+FILE_RELATED_KEYWORDS = ["file", "document", "scan", "result", "upload", "content", "analysis", "vulnerability", "finding", "report", "read", "interpret", "explain"]
+
+def is_file_related(message):
+    """Whether a message is about an uploaded file: the local classifier when confident, else the keyword check."""
+    label, margin, confident = file_query_classifier.predict(message)
+    if confident:
+        file_query_classifier.log(message, label, "local", margin)
+        return label == "file"
+    related = any(keyword in message.lower() for keyword in FILE_RELATED_KEYWORDS)
+    file_query_classifier.log(message, "file" if related else "general", "heuristic", margin)
+    return related
+
+def _load_intent_classifiers():
+    # Decisions the fallbacks made become extra examples
+    for classifier in intent_classifiers:
+        added = classifier.load_logged_examples()
+        print(f"[INTENT] {classifier.name}: {added} examples learned from logged decisions")
+    return intent_classifiers
+
+# --- Initialize the web-search answer cache (shared by all users and workers) ---
+web_answer_cache = WebAnswerCache(
+    mongo.db.web_answer_cache,
+    ttl_seconds=WEB_CACHE_TTL_SECONDS,
+    max_entries=WEB_CACHE_MAX_ENTRIES,
+    embedding_service=embedding_service if WEB_CACHE_SEMANTIC else None,
+    similarity_threshold=WEB_CACHE_SIMILARITY
+)
+
+def web_cache_enabled(user_id, data):
+    """
+    Whether this request may read and fill the web answer cache: a request can
+    bypass it with "use_cache": false, and a user can opt out for good
+    (preferences.web_answer_cache, see PUT /user/preferences).
+    """
+    if data.get("use_cache") is False:
+        return False
+    user = mongo.db.users.find_one({"_id": ObjectId(user_id)}, {"preferences.web_answer_cache": 1}) or {}
+    return user.get("preferences", {}).get("web_answer_cache", True) is not False
+
+def lookup_web_answer(query):
+    try:
+        return web_answer_cache.get(query)
+    except Exception as e:
+        print(f"[WEB-CACHE] Lookup failed: {e}", file=sys.stderr)
+        return None
+
+def store_web_answer(query, agent_result):
+    """Cache an agent answer, unless it is empty or an error."""
+    answer = agent_result.get("answer")
+    if not answer or answer == "[No answer]" or answer.startswith("[ERROR]"):
+        return
+    try:
+        web_answer_cache.set(query, answer, agent_result.get("links", []))
+    except Exception as e:
+        print(f"[WEB-CACHE] Store failed: {e}", file=sys.stderr)
+
+# Connecting to Mongo and creating indexes is part of the warm-up, not of the import
+def _init_mongo():
+    mongo.db.command("ping")
+    for store in (conversation_store, summary_cache, file_registry, ingestion_tracker, job_queue, web_answer_cache, *intent_classifiers):
+        store.ensure_indexes()
+    return mongo.db
+
+resources.register("mongo", _init_mongo)
+resources.register("intent_classifiers", _load_intent_classifiers, required=False)
+resources.mark("app")
+
+@task("memory_add")
+def memory_add_task(user_id, conversation_id, text, role, extra=None):
+    memory_store.add(user_id, conversation_id, text, role=role, extra=extra)
+
+@task("extract_facts")
+def extract_facts_task(user_id, message, reply, conversation_id, conversation_title):
+    extract_and_store_facts(user_id, message, reply, conversation_id, conversation_title)
+
+@task("store_user_memory")
+def store_user_memory_task(user_id, text, **kwargs):
+    store_user_memory(user_id, text, **kwargs)
+
+@task("detect_and_store_fact")
+def detect_and_store_fact_task(user_id, text, conversation_id, conversation_title):
+    store_detected_fact(is_personal_fact(text), user_id, conversation_id, conversation_title)
+
+# --- Semantic index of conversation messages (embedded in the background as they are written) ---
+message_index = MessageIndex(pinecone_index, embedding_service)
+
+@task("index_message")
+def index_message_task(user_id, conversation_id, seq):
+    # The message is read when the job runs, so an edit made in the meantime is what gets indexed
+    message = conversation_store.get_message(user_id, conversation_id, seq)
+    if message is None:
+        message_index.delete(user_id, [MessageIndex.vector_id(conversation_id, seq)])
+        return
+    message_index.upsert(user_id, conversation_id, seq, message.get("content", ""), role=message.get("role"))
+
+@task("unindex_messages")
+def unindex_messages_task(user_id, conversation_id, from_seq=0):
+    message_index.delete_conversation(user_id, conversation_id, from_seq=from_seq)
+
+def enqueue_message_indexing(user_id, conversation_id, seq):
+    if seq is not None:
+        job_queue.enqueue("index_message", {"user_id": user_id, "conversation_id": conversation_id, "seq": seq})
+
+def enqueue_post_response_jobs(turn_id, user_id, conversation_id, conversation_title, message, reply, reply_to=None, add_to_memory=True):
+    """
+    Queue the work that used to run synchronously after a reply was streamed.
+    turn_id makes the jobs idempotent if the same turn is enqueued twice.
+    """
+    if add_to_memory:
+        job_queue.enqueue("memory_add", {
+            "user_id": user_id,
+            "conversation_id": conversation_id,
+            "text": reply,
+            "role": "assistant",
+            "extra": {"replyTo": reply_to} if reply_to else None
+        }, idempotency_key=f"memory_add:{turn_id}")
+    job_queue.enqueue("extract_facts", {
+        "user_id": user_id,
+        "message": message,
+        "reply": reply,
+        "conversation_id": conversation_id,
+        "conversation_title": conversation_title
+    }, idempotency_key=f"extract_facts:{turn_id}")
 
 # --- Helper function for Groq API calls ---
+# Every completion goes through one pooled, keep-alive client with timeouts and retries
+llm_client = LLMClient.from_env()
+
 def groq_api_call(messages, model=None, temperature=0.6, stream=True):
     """
     Make a call to Groq's API
-    Returns: Response object if stream=False, or generator if stream=True
+    Returns: Response object if stream=True, or the decoded JSON body if stream=False
     """
-    headers = {
-        "Authorization": f"Bearer {os.getenv('API_KEY')}",
-        "Content-Type": "application/json"
-    }
-    
-    payload = {
-        "model": model or os.getenv("MODEL"),
-        "messages": messages,
-        "temperature": temperature,
-        "stream": stream
-    }
-    
-    response = requests.post(
-        f"{os.getenv('BASE_URL')}/chat/completions",
-        headers=headers,
-        json=payload,
+    return llm_client.chat_completion(
+        messages,
+        model=model or MODEL,
+        temperature=temperature,
         stream=stream
     )
-    response.raise_for_status()
-    
-    if not stream:
-        return response.json()
-    return response
 
+def llm_api_func(prompt, model=None):
+    """
+    Single-prompt, non-streaming completion used by the document summarization and Q&A helpers.
+    """
+    completion = groq_api_call(
+        messages=[{"role": "user", "content": prompt}],
+        model=model or MODEL,
+        temperature=TEMPERATURE,
+        stream=False
+    )
+    return completion.get("choices", [{}])[0].get("message", {}).get("content", "")
+
+def llm_stream_func(prompt, model=None):
+    """
+    Streaming counterpart of llm_api_func: yields the completion as it is generated.
+    """
+    response = groq_api_call(
+        messages=[{"role": "user", "content": prompt}],
+        model=model or MODEL,
+        temperature=TEMPERATURE,
+        stream=True
+    )
+    yield from iter_completion_deltas(response)
+
+# --- Prompt assembly shared by chat, edit_message and web search ---
+SYSTEM_PROMPT = (
+    "You are Moktashif, a smart and friendly cybersecurity assistant.\n"
+    "🧠 MEMORY SYSTEM: You have access to the user's previous conversations and personal information. "
+    "ALWAYS use the cross-conversation context provided below to remember facts about the user (like their name, work environment, tools they use, etc.). "
+    "When the user asks a question, check if similar questions or relevant context exist in their past conversations. "
+    "If you see cross-conversation context, USE IT - this information persists across all conversations with this user. "
+    "If the user is replying to a specific message, use the content of that message as immediate context for their new question. "
+    "Always prioritize the most relevant and recent information, but do not repeat answers verbatim unless asked.\n"
+    "You are strictly limited to answering only cybersecurity-related questions.\n"
+    "If a user asks anything not related to cybersecurity — including famous people, sports, general trivia, or personal questions — you must politely refuse.\n"
+    "Say: 'I can only help with cybersecurity topics. Please ask something related to web security, hacking, threats, or protection.'\n"
+    "Do not provide answers outside the domain, even if you know them. Never break character.\n"
+    "Use a warm, human tone with short, clear answers. You can be casual or slightly witty when appropriate, especially in greetings or small talk.\n"
+    "Introduce yourself as 'Moktashif' only when it makes sense — such as during first-time greetings, re-engagement after a pause, or if the user asks who you are.\n"
+    "Don't overuse your name. Vary your language like a real human would.\n"
+    "Avoid technical jargon unless the user clearly understands it. Always favor helpful explanations over buzzwords.\n"
+    "Do not break character or explain that you're an AI. Stay in role as Moktashif.\n"
+    "Do not hallucinate or provide false information regarding the security field like if the user have asked you about new cve or new tools just tell them that you don't know.\n"
+    "If the user asks about something recent, breaking, or requests the latest information, you may use live web search results if available.\n"
+    "If you do not have enough information to answer, you may request to use the web search feature.\n"
+    "You are a cybersecurity expert. Provide accurate information about cybersecurity topics "
+    "based on your training data. If the user is asking about something that would require "
+    "real-time or recent information that might not be in your knowledge base, let them know "
+    "they should enable web search for the most up-to-date information."
+)
+
+# Sections get the prompt budget in this order (lower first)
+PRIORITY_FACT = 10
+PRIORITY_REPLY = 20
+PRIORITY_MEMORIES = 30
+PRIORITY_DOCUMENT = 40
+PRIORITY_HISTORY_SUMMARY = 45
+PRIORITY_HISTORY = 50
+
+def format_memories(memories):
+    """
+    Format memory_retriever.retrieve() output for a prompt.
+    Returns: (current conversation block, other conversations block), either may be "".
+    """
+    def line(mem):
+        # MongoMemoryStore entries are conversation messages, cybersec entries are facts
+        return f"{mem['role']}: {mem.get('text', '')}" if mem.get("role") else mem.get('text', '')
+
+    current_block = ""
+    other_block = ""
+    if memories.get("current"):
+        current_block = "🔍 IMPORTANT CONTEXT FROM CURRENT CONVERSATION:\n" + "\n".join(
+            f"- {line(mem)}" for mem in memories["current"]
+        )
+    if memories.get("other"):
+        other_block = "🌐 CRITICAL CROSS-CONVERSATION CONTEXT (Remember these facts about the user):\n" + "\n".join(
+            f"- From '{mem.get('conversation_title') or 'Previous conversation'}': {line(mem)}"
+            for mem in memories["other"]
+        )
+    return current_block, other_block
+
+def document_section(document_context, structured_findings=None):
+    if structured_findings:
+        # Format structured findings as a numbered list for the LLM (cut to the section budget)
+        findings_str = "\n".join(
+            f"{i+1}. Tags: {', '.join(f['tags'])} | URL: {f['url']} | Extras: {f['extras']}"
+            for i, f in enumerate(structured_findings)
+        )
+        return ("The user uploaded a vulnerability scan file. Here is a numbered list of findings extracted from the document. "
+                "Use these as reference when answering questions about vulnerabilities in the document:\n" + findings_str)
+    return ("The user has uploaded a document. Use the following as additional context when answering their queries: "
+            f"\n---\n{document_context}\n---")
+
+def build_llm_messages(assembler, user_id, conversation_id, history, user_message, label):
+    """
+    Add the conversation history to the assembler and build the message list.
+
+    history is the conversation's messages before user_message (a prefix of the stored
+    messages). Its older part is replaced by the cached rolling summary when one covers
+    it; when the rest no longer fits the budget, a job rolls the summary forward so the
+    next turns send a summary instead of silently losing the oldest messages.
+    """
+    summarized = 0
+    cached = summary_cache.get_history_summary(conversation_id)
+    if cached and cached["upto"] <= len(history) and cached["covered_hash"] == history_hash(history[:cached["upto"]]):
+        summarized = cached["upto"]
+        assembler.add("history_summary", "Summary of the earlier conversation:\n" + cached["summary"],
+                      PRIORITY_HISTORY_SUMMARY, stable=True)
+    recent = history[summarized:]
+    assembler.set_history(recent, PRIORITY_HISTORY)
+
+    llm_messages = assembler.build(user_message)
+    print(f"[PROMPT] {label}: {assembler.report()}")
+
+    if assembler.history_dropped:
+        upto = summarized + max(assembler.history_dropped, len(recent) - HISTORY_KEEP_RECENT)
+        job_queue.enqueue("summarize_history", {
+            "user_id": user_id,
+            "conversation_id": conversation_id,
+            "upto": upto
+        }, idempotency_key=f"summarize_history:{conversation_id}:{upto}")
+    return llm_messages
+
+@task("summarize_history")
+def summarize_history_task(user_id, conversation_id, upto):
+    """
+    Roll the conversation summary forward to cover its first `upto` messages,
+    starting from the previous summary when it is still valid.
+    """
+    messages = conversation_store.get_messages(user_id, conversation_id)[:upto]
+    if len(messages) < upto:
+        return  # Truncated by an edit since the job was queued
+
+    previous = summary_cache.get_history_summary(conversation_id)
+    start, prior_summary = 0, ""
+    if previous and previous["covered_hash"] == history_hash(messages[:previous["upto"]]):
+        if previous["upto"] >= upto:
+            return
+        start, prior_summary = previous["upto"], previous["summary"]
+
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages[start:])
+    prompt = (
+        "You keep a running summary of a conversation between a user and a cybersecurity assistant. "
+        "Update the summary with the new messages. Keep facts about the user and their systems, the questions asked, "
+        "findings, decisions and open issues; drop small talk. Answer with the summary only, under 250 words.\n\n"
+        f"Current summary:\n{prior_summary or '(none)'}\n\n"
+        f"New messages:\n{truncate_to_tokens(transcript, PROMPT_TOKEN_BUDGET)}"
+    )
+    summary = llm_api_func(prompt)
+    if summary:
+        summary_cache.set_history_summary(conversation_id, summary, upto, history_hash(messages))
+        print(f"[PROMPT] Summarized the first {upto} messages of conversation {conversation_id}")
 
 
 
@@ -182,38 +732,13 @@ def create_conversation():
         if not user_id:
             return jsonify({"msg": "user_id is required"}), 400
             
-        user = mongo.db.users.find_one({"_id": ObjectId(user_id)})
-        if not user:
+        if not user_exists(user_id):
             return jsonify({"msg": "User not found."}), 404
         
         data = request.json
         title = data.get('title', 'New Conversation')
         
-        # Create a new conversation with proper ISO format dates
-        current_time = datetime.utcnow().isoformat() + "Z"
-        new_conversation = {
-            "id": str(ObjectId()),
-            "title": title,
-            "created_at": current_time,
-            "updated_at": current_time,
-            "messages": []
-        }
-        
-        # Initialize conversations array if it doesn't exist
-        if 'conversations' not in user:
-            result = mongo.db.users.update_one(
-                {"_id": ObjectId(user_id)},
-                {"$set": {"conversations": [new_conversation]}}
-            )
-        else:
-            # Add to existing conversations array
-            result = mongo.db.users.update_one(
-                {"_id": ObjectId(user_id)},
-                {"$push": {"conversations": new_conversation}}
-            )
-        
-        if result.modified_count == 0:
-            return jsonify({"msg": "Failed to create conversation."}), 500
+        new_conversation = conversation_store.create_conversation(user_id, title)
             
         return jsonify({"conversation": new_conversation}), 201
         
@@ -227,24 +752,26 @@ def get_conversations():
     if not user_id:
         return jsonify({"msg": "user_id is required"}), 400
         
-    user = mongo.db.users.find_one({"_id": ObjectId(user_id)})
-    if not user:
+    if not user_exists(user_id):
         return jsonify({"msg": "User not found."}), 404
     
-    # Return just the conversation metadata, not all messages
-    conversations = user.get('conversations', [])
-    conversation_list = [
-        {
-            "id": conv["id"],
-            "title": conv["title"],
-            "created_at": conv["created_at"],
-            "updated_at": conv["updated_at"],
-            "message_count": len(conv.get("messages", []))
-        }
-        for conv in conversations
-    ]
+    # Without a limit every conversation is returned, as before
+    limit = request.args.get('limit')
+    try:
+        limit = min(max(int(limit), 1), 200) if limit is not None else None
+        # Return just the conversation metadata, not all messages
+        conversation_list, next_cursor = conversation_store.list_conversations(
+            user_id, limit=limit, cursor=request.args.get('cursor')
+        )
+    except ValueError as e:
+        return jsonify({"msg": f"Invalid pagination parameters: {e}"}), 400
     
-    return jsonify({"conversations": conversation_list}), 200
+    # The sidebar polls this endpoint; an unchanged listing is answered with 304 Not Modified
+    body = {"conversations": conversation_list, "next_cursor": next_cursor}
+    response = jsonify(body)
+    response.set_etag(hashlib.sha1(json.dumps(body, sort_keys=True, default=str).encode("utf-8")).hexdigest())
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response.make_conditional(request)
 
 @app.route('/conversations/<conversation_id>', methods=['GET'])
 def get_conversation(conversation_id):
@@ -252,15 +779,11 @@ def get_conversation(conversation_id):
     if not user_id:
         return jsonify({"msg": "user_id is required"}), 400
         
-    user = mongo.db.users.find_one({"_id": ObjectId(user_id)})
-    if not user:
+    if not user_exists(user_id):
         return jsonify({"msg": "User not found."}), 404
     
     # Find the conversation
-    conversation = next(
-        (conv for conv in user.get('conversations', []) if conv["id"] == conversation_id),
-        None
-    )
+    conversation = conversation_store.get_conversation(user_id, conversation_id)
     
     if not conversation:
         return jsonify({"msg": "Conversation not found."}), 404
@@ -273,21 +796,16 @@ def delete_conversation(conversation_id):
     if not user_id:
         return jsonify({"msg": "user_id is required"}), 400
         
-    user = mongo.db.users.find_one({"_id": ObjectId(user_id)})
-    if not user:
+    if not user_exists(user_id):
         return jsonify({"msg": "User not found."}), 404
     
-    # Filter out the conversation to delete
-    conversations = [
-        conv for conv in user.get('conversations', [])
-        if conv["id"] != conversation_id
-    ]
-    
-    # Update user document
-    mongo.db.users.update_one(
-        {"_id": ObjectId(user_id)},
-        {"$set": {"conversations": conversations}}
-    )
+    conversation_store.delete_conversation(user_id, conversation_id)
+    summary_cache.delete_history_summary(conversation_id)
+    # The conversation's files stay listed (they can be reused in other conversations);
+    # only their cached summaries are dropped
+    for f in file_registry.list_conversation_files(user_id, conversation_id):
+        summary_cache.delete_file(f['file_id'])
+    job_queue.enqueue("unindex_messages", {"user_id": user_id, "conversation_id": conversation_id})
     
     return jsonify({"msg": "Conversation deleted."}), 200
 
@@ -297,8 +815,7 @@ def rename_conversation(conversation_id):
     if not user_id:
         return jsonify({"msg": "user_id is required"}), 400
         
-    user = mongo.db.users.find_one({"_id": ObjectId(user_id)})
-    if not user:
+    if not user_exists(user_id):
         return jsonify({"msg": "User not found."}), 404
     
     data = request.json
@@ -307,26 +824,13 @@ def rename_conversation(conversation_id):
         return jsonify({"msg": "Title required."}), 400
     
     # Check for case-sensitive duplicate
-    for conv in user.get('conversations', []):
-        if conv["title"] == new_title and conv["id"] != conversation_id:
-            return jsonify({"msg": "A conversation with this name already exists."}), 409
+    if conversation_store.title_exists(user_id, new_title, exclude_id=conversation_id):
+        return jsonify({"msg": "A conversation with this name already exists."}), 409
     
     # Find and update the conversation
-    conversations = user.get('conversations', [])
-    for conv in conversations:
-        if conv["id"] == conversation_id:
-            conv["title"] = new_title
-            conv["updated_at"] = datetime.utcnow().isoformat() + "Z"
-            break
-    else:
+    if not conversation_store.rename_conversation(user_id, conversation_id, new_title):
         return jsonify({"msg": "Conversation not found."}), 404
     
-    # Update user document
-    mongo.db.users.update_one(
-        {"_id": ObjectId(user_id)},
-        {"$set": {"conversations": conversations}}
-    )
-    
     return jsonify({"msg": "Conversation renamed."}), 200
 
 @app.route('/conversations/search', methods=['GET'])
@@ -335,65 +839,65 @@ def search_conversations():
     if not user_id:
         return jsonify({"msg": "user_id is required"}), 400
         
-    user = mongo.db.users.find_one({"_id": ObjectId(user_id)})
-    if not user:
+    if not user_exists(user_id):
         return jsonify({"msg": "User not found."}), 404
 
-    query = request.args.get('q', '').strip().lower()
+    query = request.args.get('q', '').strip()
     if not query:
         return jsonify({"results": []})
 
-    conversations = user.get('conversations', [])
-    results = []
-
-    # First, search by conversation title
-    for conv in conversations:
-        if query in conv.get('title', '').lower():
-            results.append({
-                "id": conv["id"],
-                "title": conv["title"],
-                "match_type": "title",
-                "snippet": None,
-                "created_at": conv["created_at"],
-                "updated_at": conv["updated_at"],
-                "matches": [],
-                "matchIndexes": []
-            })
-
-    # If no title matches, search inside messages (collect all matches per conversation)
-    if not results:
-        for conv in conversations:
-            matches = []
-            match_indexes = []
-            for idx, msg in enumerate(conv.get('messages', [])):
-                content = msg.get('content', '')
-                if query in content.lower():
-                    snippet = content
-                    # Optionally, shorten the snippet
-                    if len(snippet) > 80:
-                        idx_query = snippet.lower().index(query)
-                        start = max(0, idx_query - 30)
-                        end = min(len(snippet), idx_query + len(query) + 30)
-                        snippet = snippet[start:end]
-                        if start > 0:
-                            snippet = '...' + snippet
-                        if end < len(content):
-                            snippet = snippet + '...'
-                    matches.append(snippet)
-                    match_indexes.append(idx)
-            if matches:
-                results.append({
-                    "id": conv["id"],
-                    "title": conv["title"],
-                    "match_type": "message",
-                    "snippet": matches[0],
-                    "created_at": conv["created_at"],
-                    "updated_at": conv["updated_at"],
-                    "matches": matches,
-                    "matchIndexes": match_indexes
-                })
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+        offset = max(int(request.args.get('offset', 0)), 0)
+    except ValueError:
+        return jsonify({"msg": "limit and offset must be integers"}), 400
+
+    # Indexed word/prefix search over titles and messages, ranked by match and recency
+    results, total = conversation_store.search(user_id, query, limit=limit, offset=offset)
+    next_offset = offset + len(results) if offset + len(results) < total else None
+    return jsonify({"results": results, "total": total, "next_offset": next_offset}), 200
+
+@app.route('/conversations/semantic_search', methods=['GET'])
+def semantic_search_conversations():
+    user_id = request.args.get('user_id')
+    if not user_id:
+        return jsonify({"msg": "user_id is required"}), 400
+        
+    if not user_exists(user_id):
+        return jsonify({"msg": "User not found."}), 404
 
-    return jsonify({"results": results}), 200
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"results": []})
+
+    try:
+        top_k = min(max(int(request.args.get('top_k', 10)), 1), 50)
+    except ValueError:
+        return jsonify({"msg": "top_k must be an integer"}), 400
+
+    # Nearest messages by meaning, grouped per conversation in the same shape as /conversations/search
+    hits = message_index.search(user_id, query, top_k=top_k)
+    conversations = conversation_store.get_conversations(user_id, {hit["conversation_id"] for hit in hits})
+    results = {}
+    for hit in hits:
+        conv = conversations.get(hit["conversation_id"])
+        if conv is None:
+            continue  # deleted since it was indexed
+        result = results.setdefault(conv["id"], {
+            "id": conv["id"],
+            "title": conv["title"],
+            "match_type": "semantic",
+            "snippet": make_snippet(hit["text"], []),
+            "created_at": conv["created_at"],
+            "updated_at": conv["updated_at"],
+            "score": hit["score"],
+            "matches": [],
+            "matchIndexes": []
+        })
+        result["matches"].append(make_snippet(hit["text"], []))
+        result["matchIndexes"].append(hit["seq"])
+
+    return jsonify({"results": list(results.values())}), 200
 
 # --- Modified Chat Endpoint ---
 @app.route('/chat/<conversation_id>', methods=['POST'])
@@ -402,19 +906,10 @@ def chat(conversation_id):
     if not user_id:
         return jsonify({"msg": "user_id is required"}), 400
         
-    user = mongo.db.users.find_one({"_id": ObjectId(user_id)})
-    if not user:
+    if not user_exists(user_id):
         return jsonify({"msg": "User not found."}), 404
 
-    conversations = user.get('conversations', [])
-    conversation_index = None
-    conversation = None
-
-    for i, conv in enumerate(conversations):
-        if conv["id"] == conversation_id:
-            conversation = conv
-            conversation_index = i
-            break
+    conversation = conversation_store.get_conversation(user_id, conversation_id)
 
     if conversation is None:
         return jsonify({"msg": "Conversation not found."}), 404
@@ -426,30 +921,13 @@ def chat(conversation_id):
     file_id = data.get('file_id')  # Get specific file ID if provided
     
     # --- PATCH: Auto-attach most recent file if message is about a file but file_id is missing ---
-    file_related_keywords = ["file", "document", "scan", "result", "upload", "content", "analysis", "vulnerability", "finding", "report", "read", "interpret", "explain"]
-    is_file_related_query = any(keyword in message.lower() for keyword in file_related_keywords)
+    is_file_related_query = is_file_related(message)
     if not file_id and is_file_related_query:
         # Look for the most recent file uploaded for this conversation
-        upload_dir = app.config['UPLOAD_FOLDER']
-        files = []
-        if os.path.exists(upload_dir):
-            for filename in os.listdir(upload_dir):
-                if filename.startswith(f"{user_id}_{conversation_id}_") and filename.endswith("_metadata.json"):
-                    metadata_path = os.path.join(upload_dir, filename)
-                    try:
-                        with open(metadata_path, 'r', encoding='utf-8') as f:
-                            metadata = json.load(f)
-                            files.append({
-                                'file_id': filename.replace('_metadata.json', ''),
-                                'filename': metadata.get('original_filename', 'Unknown'),
-                                'upload_time': metadata.get('upload_time')
-                            })
-                    except Exception as e:
-                        print(f"Error loading metadata: {e}")
-        files.sort(key=lambda x: x.get('upload_time', ''), reverse=True)
-        if files:
-            file_id = files[0]['file_id']
-            print(f"[AUTO-ATTACH] Using most recent file for this message: {files[0]['filename']} (file_id: {file_id})")
+        latest_file = file_registry.latest_conversation_file(user_id, conversation_id)
+        if latest_file:
+            file_id = latest_file['file_id']
+            print(f"[AUTO-ATTACH] Using most recent file for this message: {latest_file['filename']} (file_id: {file_id})")
         else:
             print("[AUTO-ATTACH] No file found to auto-attach for this file-related query.")
             return jsonify({"msg": "It looks like you're asking about a file, but I couldn't find any uploaded file for this conversation. Please re-attach the file and try again."}), 400
@@ -464,51 +942,58 @@ def chat(conversation_id):
     if not message:
         return jsonify({"msg": "Message required."}), 400
 
+    # Don't answer without the document while it is still being ingested
+    if file_id:
+        document_state, ingest_job = wait_for_document(file_id)
+        if document_state != "ready":
+            return document_not_ready_response(document_state, ingest_job)
+
     messages = conversation.get('messages', [])
 
     # Update timestamp
     current_time = datetime.utcnow().isoformat() + "Z"
-    conversation["updated_at"] = current_time
 
     # Track if web search was automatically used
     auto_search_used = False
     
-    # --- Check if message contains personal facts ---
-    print(f"🔍 DEBUG: Checking if message contains personal facts: '{message[:100]}...'")
-    contains_fact, extracted_fact = is_personal_fact(message)
-    print(f"🔍 DEBUG: Personal fact detection result: contains_fact={contains_fact}, extracted_fact='{extracted_fact}'")
-    
-    # --- If it contains a personal fact, store it automatically ---
     conversation_title = conversation.get('title', 'Untitled Conversation')
-    
-    if contains_fact:
-        print(f"💾 DEBUG: Storing personal fact for user {user_id}: {extracted_fact}")
-        print(f"💾 DEBUG: Storing in conversation '{conversation_title}' (ID: {conversation_id})")
-        store_user_memory(
-            user_id, 
-            extracted_fact,
-            conversation_id=conversation_id,
-            conversation_title=conversation_title,
-            mem_type="fact",
-            is_factual=True,
-            importance=0.8,
-            topic="cybersecurity"
-        )
-        print(f"💾 DEBUG: Personal fact stored successfully!")
 
-    # --- Add user message to semantic memory ---
-    memory_store.add(user_id, conversation_id, message, role="user", extra={"replyTo": reply_to} if reply_to else None)
+    # --- Start the independent pre-LLM stages concurrently ---
+    # Prompt assembly only waits on the fact check and the two memory lookups;
+    # storing the fact and the user message happen in the background.
+    stages = RequestStages(f"chat {conversation_id}")
+    turn_id = str(ObjectId())
+    print(f"🔍 DEBUG: Checking if message contains personal facts: '{message[:100]}...'")
+    stages.submit("is_personal_fact", is_personal_fact, message)
+    stages.chain("store_fact", "is_personal_fact", store_detected_fact, user_id, conversation_id, conversation_title)
+    # The lambda defers memory_store.add's lookup (and the store's creation) to the background thread
+    stages.fire_and_forget("memory_add_user", lambda *a, **k: memory_store.add(*a, **k), user_id, conversation_id, message, role="user", extra={"replyTo": reply_to} if reply_to else None)
+    if not force_web_search:
+        stages.submit("should_use_web_search", route_web_search, message)
+    stages.submit("retrieve_memories", memory_retriever.retrieve, user_id, message, conversation_id)
 
     # Debug logging for reply_to data
     print(f"DEBUG: Received reply_to data: {reply_to}")
     if isinstance(reply_to, dict):
         print(f"DEBUG: reply_to keys: {reply_to.keys()}")
+
+    # --- Without a file, decide on web search (and look up a cached answer) before the
+    # response starts, so the X-Web-Search-* headers are right when they are sent ---
+    use_web_search = None
+    cached_answer = None
+    cache_enabled = False
+    if not file_id:
+        use_web_search = force_web_search or stages.result("should_use_web_search", default=False)
+        if use_web_search:
+            auto_search_used = True
+            cache_enabled = web_cache_enabled(user_id, data)
+            if cache_enabled:
+                cached_answer = lookup_web_answer(message)
         
     # Integrate with cybersecurity agent
     def generate():
         import sys
         import json
-        from cybersec_agent import answer_cybersec_query, should_use_web_search
         
         # Save user message immediately with file information
         user_message = {"role": "user", "content": message}
@@ -530,21 +1015,16 @@ def chat(conversation_id):
                 print(f"DEBUG: Error getting file metadata: {e}")
                 
         messages.append(user_message)
-        conversation["messages"] = messages
-        conversation["updated_at"] = current_time
-        conversations[conversation_index] = conversation
         
         # Update in database right away to ensure file info is saved
-        mongo.db.users.update_one(
-            {"_id": ObjectId(user_id)},
-            {"$set": {"conversations": conversations}}
-        )
+        user_seq = conversation_store.append_message(user_id, conversation_id, user_message, updated_at=current_time)
+        enqueue_message_indexing(user_id, conversation_id, user_seq)
         print(f"DEBUG: Saved user message with hasFile: {user_message.get('hasFile', False)}, fileName: {user_message.get('fileName', 'None')}")
 
         # Variables to track response outside the try block
         partial_reply = ""
         error_occurred = False
-        nonlocal auto_search_used
+        nonlocal auto_search_used, use_web_search
 
         try:
             # --- Load document context ONLY if file_id is specified ---
@@ -554,51 +1034,21 @@ def chat(conversation_id):
             
             if file_id:
                 print(f"DEBUG: Loading document context for file_id: {file_id}")
-                # --- CHUNKING: Load all chunk files for this file_id ---
-                chunk_texts = []
-                chunk_idx = 0
-                while True:
-                    chunk_path = os.path.join(app.config['UPLOAD_FOLDER'], f'{file_id}_context_{chunk_idx}.txt')
-                    if not os.path.exists(chunk_path):
-                        break
-                    with open(chunk_path, 'r', encoding='utf-8') as f:
-                        chunk_texts.append(f.read())
-                    chunk_idx += 1
-                if chunk_texts:
-                    document_context = '\n'.join(chunk_texts)
-                    print(f"DEBUG: Loaded {len(chunk_texts)} chunk(s) for document context ({len(document_context)} chars)")
-                else:
-                    # Fallback to old single context file
-                    context_path = os.path.join(app.config['UPLOAD_FOLDER'], f'{file_id}_context.txt')
-                    if os.path.exists(context_path):
-                        with open(context_path, 'r', encoding='utf-8') as f:
-                            document_context = f.read()
-                            print(f"DEBUG: Loaded document context ({len(document_context)} chars)")
-                    
-                    # Try to get the filename from metadata
-                    metadata_path = os.path.join(app.config['UPLOAD_FOLDER'], f'{file_id}_metadata.json')
-                    if os.path.exists(metadata_path):
-                        try:
-                            with open(metadata_path, 'r', encoding='utf-8') as f:
-                                metadata = json.load(f)
-                                filename = metadata.get('original_filename', 'Unknown')
-                                print(f"DEBUG: Found filename from metadata: {filename}")
-                        except Exception as e:
-                            print(f"DEBUG: Error reading metadata: {e}")
-                    
-                    # Try to parse structured findings if .txt
-                    if context_path.endswith('.txt'):
-                        try:
-                            structured_findings = parse_vuln_txt(document_context)
-                            print(f"DEBUG: Parsed structured findings: {len(structured_findings)} items")
-                        except Exception as e:
-                            print(f"DEBUG: Error parsing structured findings: {e}")
-                            structured_findings = None
+                document, from_cache = get_cached_document(file_id)
+                if document:
+                    document_context = document["document_context"]
+                    structured_findings = document["structured_findings"]
+                    filename = document["filename"]
+                    print(f"DEBUG: Loaded document context ({len(document_context)} chars, cached: {from_cache})")
+                    if structured_findings:
+                        print(f"DEBUG: Parsed structured findings: {len(structured_findings)} items")
                             
-                    # Store file context in memory system
-                    if document_context:
+                    # Store file context in memory system (once per load, not on every follow-up question)
+                    if document_context and not from_cache:
                         file_context_memory = f"Document loaded: '{filename}' with content: {document_context[:500]}..."
-                        store_user_memory(
+                        stages.fire_and_forget(
+                            "store_file_memory",
+                            store_user_memory,
                             user_id,
                             file_context_memory,
                             conversation_id=conversation_id,
@@ -609,109 +1059,70 @@ def chat(conversation_id):
                             topic="document"
                         )
             
-            # --- Decide if web search is needed ---
-            use_web_search = force_web_search or should_use_web_search(message)
+            # --- Decide if web search is needed (already decided up front when there is no file) ---
+            if use_web_search is None:
+                use_web_search = force_web_search or stages.result("should_use_web_search", default=False)
             # --- Hierarchical Summarization/Q&A for file analysis ---
             if file_id and document_context:
-                from chat import hierarchical_summarize, qa_over_summary
-                def llm_api_func(prompt, model=None):
-                    completion = groq_api_call(
-                        messages=[{"role": "user", "content": prompt}],
-                        model=model or MODEL,
-                        temperature=TEMPERATURE,
-                        stream=False
-                    )
-                    return completion.get("choices", [{}])[0].get("message", {}).get("content", "")
                 general_file_questions = [
                     "what do you think of this file", "summarize this file", "analyze this file", "overview of this file"
                 ]
-                if any(q in message.lower() for q in general_file_questions):
-                    answer = hierarchical_summarize(document_context, llm_api_func)
+                # The document summary is computed once per file in the background and cached;
+                # until it exists, questions are answered from the most relevant chunks
+                summary = summary_cache.get_document_summary(file_id, document_context)
+                if summary is None:
+                    enqueue_document_summary(file_id, document_context)
+                    print(f"DEBUG: No summary yet for {file_id}, answering from retrieved chunks")
+                    answer_stream = qa_cybersec_pinecone(message, file_id, llm_api_func, stream=True,
+                                                         llm_stream_func=llm_stream_func, fallback_text=document_context)
+                    for frame in coalesce(answer_stream):
+                        partial_reply += frame
+                        yield frame
+                elif any(q in message.lower() for q in general_file_questions):
+                    partial_reply = summary
+                    yield summary
                 else:
-                    answer = qa_over_summary(document_context, message, llm_api_func)
-                for chunk in answer.splitlines(keepends=True):
-                    partial_reply += chunk
-                    yield chunk
-                if partial_reply:
-                    memory_store.add(user_id, conversation_id, partial_reply, role="assistant", extra={"replyTo": reply_to} if reply_to else None)
-                    assistant_message = {"role": "assistant", "content": partial_reply}
-                    if reply_to:
-                        assistant_message["replyTo"] = reply_to
-                    messages.append(assistant_message)
-                    conversation["messages"] = messages
-                    conversation["updated_at"] = current_time
-                    conversations[conversation_index] = conversation
-                    mongo.db.users.update_one(
-                        {"_id": ObjectId(user_id)},
-                        {"$set": {"conversations": conversations}}
-                    )
-                return  # End after streaming hierarchical answer
+                    # Only the final answer is generated per question, so stream it as it is produced
+                    answer_stream = qa_over_summary(document_context, message, llm_api_func, summary=summary,
+                                                    stream=True, llm_stream_func=llm_stream_func)
+                    for frame in coalesce(answer_stream):
+                        partial_reply += frame
+                        yield frame
+                return  # End after streaming hierarchical answer (saved in finally)
             if use_web_search:
                 auto_search_used = True
+                if cached_answer is not None:
+                    print("DEBUG: Answering from the web answer cache")
+                    partial_reply = cached_answer["answer"]
+                    yield partial_reply
+                    return
                 print("DEBUG: Using web search to answer question")
                 # Use cybersec_agent to answer
                 agent_result = answer_cybersec_query(message)
-                answer = agent_result.get("answer", "[No answer]")
-                # Stream the answer to the client
-                for chunk in answer.splitlines(keepends=True):
-                    partial_reply += chunk
-                    yield chunk
-                # Save to memory and conversation as assistant reply
-                if partial_reply:
-                    memory_store.add(user_id, conversation_id, partial_reply, role="assistant", extra={"replyTo": reply_to} if reply_to else None)
-                    assistant_message = {"role": "assistant", "content": partial_reply}
-                    if reply_to:
-                        assistant_message["replyTo"] = reply_to
-                    messages.append(assistant_message)
-                    conversation["messages"] = messages
-                    conversation["updated_at"] = current_time
-                    conversations[conversation_index] = conversation
-                    mongo.db.users.update_one(
-                        {"_id": ObjectId(user_id)},
-                        {"$set": {"conversations": conversations}}
-                    )
-                    
-                    # Extract and store facts from the response
-                    extract_and_store_facts(
-                        user_id,
-                        message,
-                        partial_reply,
-                        conversation_id,
-                        conversation_title
-                    )
-                return  # End after streaming web answer
+                # Only the plain message is cached: the query has no file or memory context in it
+                if cache_enabled:
+                    store_web_answer(message, agent_result)
+                # The agent returns a finished answer, so send it in one write
+                partial_reply = agent_result.get("answer", "[No answer]")
+                yield partial_reply
+                return  # End after streaming web answer (saved in finally)
                 
-            # --- Retrieve relevant memories from cross-conversation context ---
-            cybersec_memories = retrieve_user_memories(user_id, message, conversation_id)
+            # --- Retrieve relevant memories (both stores, ranked and deduplicated) ---
+            memories = stages.result("retrieve_memories", default={"current": [], "other": []})
             
-            # Debug the cross-conversation memory retrieval
-            print(f"🧠 DEBUG CYBERSEC MEMORY: Retrieved {len(cybersec_memories['current'])} memories from current conversation")
-            print(f"🧠 DEBUG CYBERSEC MEMORY: Retrieved {len(cybersec_memories['other'])} memories from other conversations")
+            # Debug the memory retrieval
+            print(f"🧠 DEBUG MEMORY: Retrieved {len(memories['current'])} memories from current conversation")
+            print(f"🧠 DEBUG MEMORY: Retrieved {len(memories['other'])} memories from other conversations")
             
-            if cybersec_memories['current']:
-                print(f"🧠 DEBUG CYBERSEC MEMORY: Sample current memory: {cybersec_memories['current'][0].get('text', '')[:100]}...")
-                for i, mem in enumerate(cybersec_memories['current'][:3]):  # Show first 3 memories
-                    print(f"🧠   Current Memory {i+1}: {mem.get('text', '')[:150]}...")
+            for i, mem in enumerate(memories['current'][:3]):  # Show the top 3 memories
+                print(f"🧠   Current Memory {i+1} ({mem['source']}, score {mem['score']}): {mem.get('text', '')[:150]}...")
             
-            if cybersec_memories['other']:
-                print(f"🧠 DEBUG CYBERSEC MEMORY: Sample other memory: {cybersec_memories['other'][0].get('text', '')[:100]}...")
-                for i, mem in enumerate(cybersec_memories['other'][:3]):  # Show first 3 cross-conversation memories
+            if memories['other']:
+                for i, mem in enumerate(memories['other'][:3]):  # Show the top 3 cross-conversation memories
                     conv_title = mem.get('conversation_title', 'Unknown Conversation')
-                    print(f"🧠   Cross-Conv Memory {i+1} from '{conv_title}': {mem.get('text', '')[:150]}...")
+                    print(f"🧠   Cross-Conv Memory {i+1} from '{conv_title}' ({mem['source']}, score {mem['score']}): {mem.get('text', '')[:150]}...")
             else:
-                print(f"🧠 DEBUG CYBERSEC MEMORY: ⚠️ NO CROSS-CONVERSATION MEMORIES FOUND for user {user_id} with query: {message[:50]}...")
-                
-            # --- Retrieve relevant memories for this user and query from old memory system ---
-            relevant_memories = memory_store.get_relevant_memories(user_id, message, conversation_id)
-            
-            # Debug the memory retrieval
-            print(f"DEBUG MEMORY: Current conversation has {len(messages)} messages")
-            print(f"DEBUG MEMORY: Retrieved {len(relevant_memories['current'])} memories from current conversation")
-            print(f"DEBUG MEMORY: Retrieved {len(relevant_memories['other'])} memories from other conversations")
-            
-            # Print a sample of the current conversation memories
-            if relevant_memories['current']:
-                print(f"DEBUG MEMORY: Sample current memory: {relevant_memories['current'][0]['text'][:100]}...")
+                print(f"🧠 DEBUG MEMORY: ⚠️ NO CROSS-CONVERSATION MEMORIES FOUND for user {user_id} with query: {message[:50]}...")
             
             # --- Get reply context (if replying to a message in current conversation) ---
             reply_context_block = ""
@@ -799,90 +1210,8 @@ def chat(conversation_id):
                 else:
                     print(f"DEBUG: No matching message found for reply_to: {reply_to}")
                     
-            # --- Format cybersec cross-conversation memories for LLM prompt ---
-            cybersec_memory_prompt = ""
-            if cybersec_memories["current"]:
-                cybersec_memory_prompt += "\n🔍 IMPORTANT CONTEXT FROM CURRENT CONVERSATION:\n" + "\n".join(
-                    f"- {mem.get('text', '')}" for mem in cybersec_memories["current"]
-                )
-            if cybersec_memories["other"]:
-                cybersec_memory_prompt += "\n\n🌐 CRITICAL CROSS-CONVERSATION CONTEXT (Remember these facts about the user):\n" + "\n".join(
-                    f"- From '{mem.get('conversation_title', 'Previous conversation')}': {mem.get('text', '')}" 
-                    for mem in cybersec_memories["other"]
-                )
-                print(f"🧠 DEBUG: Adding {len(cybersec_memories['other'])} cross-conversation memories to system prompt")
-                
-            # --- Format older memories for LLM prompt ---
-            memory_prompt = ""
-            if relevant_memories["current"]:
-                memory_prompt += "\nCurrent conversation context (most relevant):\n" + "\n".join(
-                    f"- {msg['role']}: {msg['text']}" for msg in relevant_memories["current"]
-                )
-            if relevant_memories["other"]:
-                memory_prompt += "\nRelevant information from other conversations:\n" + "\n".join(
-                    f"- In [{msg['conversation_id']}]: {msg['role']}: {msg['text']}" for msg in relevant_memories["other"]
-                )
-                
-            # --- Improved system prompt ---
-            system_prompt = (
-                "You are Moktashif, a smart and friendly cybersecurity assistant.\n"
-                "🧠 MEMORY SYSTEM: You have access to the user's previous conversations and personal information. "
-                "ALWAYS use the cross-conversation context provided below to remember facts about the user (like their name, work environment, tools they use, etc.). "
-                "When the user asks a question, check if similar questions or relevant context exist in their past conversations. "
-                "If you see cross-conversation context, USE IT - this information persists across all conversations with this user. "
-                "If the user is replying to a specific message, use the content of that message as immediate context for their new question. "
-                "Always prioritize the most relevant and recent information, but do not repeat answers verbatim unless asked.\n"
-                "You are strictly limited to answering only cybersecurity-related questions.\n"
-                "If a user asks anything not related to cybersecurity — including famous people, sports, general trivia, or personal questions — you must politely refuse.\n"
-                "Say: 'I can only help with cybersecurity topics. Please ask something related to web security, hacking, threats, or protection.'\n"
-                "Do not provide answers outside the domain, even if you know them. Never break character.\n"
-                "Use a warm, human tone with short, clear answers. You can be casual or slightly witty when appropriate, especially in greetings or small talk.\n"
-                "Introduce yourself as 'Moktashif' only when it makes sense — such as during first-time greetings, re-engagement after a pause, or if the user asks who you are.\n"
-                "Don't overuse your name. Vary your language like a real human would.\n"
-                "Avoid technical jargon unless the user clearly understands it. Always favor helpful explanations over buzzwords.\n"
-                "Do not break character or explain that you're an AI. Stay in role as Moktashif.\n"
-                "Do not hallucinate or provide false information regarding the security field like if the user have asked you about new cve or new tools just tell them that you don't know.\n"
-                "If the user asks about something recent, breaking, or requests the latest information, you may use live web search results if available.\n"
-                "If you do not have enough information to answer, you may request to use the web search feature.\n"
-                "You are a cybersecurity expert. Provide accurate information about cybersecurity topics "
-                "based on your training data. If the user is asking about something that would require "
-                "real-time or recent information that might not be in your knowledge base, let them know "
-                "they should enable web search for the most up-to-date information."
-            )
-            
-            # If there are personal facts from other conversations, emphasize them
-            if contains_fact:
-                system_prompt += f"\n\nThe user just shared an important personal fact: {extracted_fact}"
-                
-            if cybersec_memory_prompt:
-                system_prompt += "\n\n" + cybersec_memory_prompt
-                
-            if reply_context_block:
-                system_prompt += reply_context_block
-                
-            if memory_prompt:
-                system_prompt += "\n\n" + memory_prompt
-            
-            # --- Document Context Integration ONLY if file_id is specified ---
-            if document_context and file_id:
-                if structured_findings:
-                    # Format structured findings as a numbered list for the LLM
-                    findings_str = "\n".join([
-                        f"{i+1}. Tags: {', '.join(f['tags'])} | URL: {f['url']} | Extras: {f['extras']}"
-                        for i, f in enumerate(structured_findings[:20])  # Limit to 20 for prompt size
-                    ])
-                    system_prompt += ("\n\nThe user uploaded a vulnerability scan file. Here is a numbered list of findings extracted from the document. Use these as reference when answering questions about vulnerabilities in the document:\n" + findings_str)
-                else:
-                    system_prompt += ("\n\nThe user has uploaded a document. Use the following as additional context when answering their queries: "
-                        f"\n---\n{document_context[:2000]}\n---\n"  # Limit context to first 2000 chars for LLM input size
-                    )
-            
             # Enhance file context handling to use web search for file-related questions
-            file_related_keywords = ["file", "document", "scan", "result", "upload", "content", "analysis", 
-                                     "vulnerability", "finding", "report", "read", "interpret", "explain"]
-                                     
-            is_file_related_query = any(keyword in message.lower() for keyword in file_related_keywords)
-            
+            # (is_file_related_query was decided when the request came in)
             # If we have document context AND the query is about the file, use web search for better answers
             if document_context and file_id and is_file_related_query:
                 use_web_search = True
@@ -890,49 +1219,40 @@ def chat(conversation_id):
                 # Enhance the query with file content for better results
                 enhanced_query = f"{message} regarding: {document_context[:300]}..."
                 agent_result = answer_cybersec_query(enhanced_query)
-                answer = agent_result.get("answer", "[No answer]")
-                # Stream the answer to the client
-                for chunk in answer.splitlines(keepends=True):
-                    partial_reply += chunk
-                    yield chunk
-                # Save to memory and conversation as assistant reply
-                if partial_reply:
-                    memory_store.add(user_id, conversation_id, partial_reply, role="assistant", extra={"replyTo": reply_to} if reply_to else None)
-                    assistant_message = {"role": "assistant", "content": partial_reply}
-                    if reply_to:
-                        assistant_message["replyTo"] = reply_to
-                    messages.append(assistant_message)
-                    conversation["messages"] = messages
-                    conversation["updated_at"] = current_time
-                    conversations[conversation_index] = conversation
-                    mongo.db.users.update_one(
-                        {"_id": ObjectId(user_id)},
-                        {"$set": {"conversations": conversations}}
-                    )
-                    
-                    # Extract and store facts from the response
-                    extract_and_store_facts(
-                        user_id,
-                        message,
-                        partial_reply,
-                        conversation_id,
-                        conversation_title
-                    )
-                return  # End after streaming web answer
-            
-            # Prepare LLM message history
-            llm_messages = [{"role": "system", "content": system_prompt}]
+                # The agent returns a finished answer, so send it in one write
+                partial_reply = agent_result.get("answer", "[No answer]")
+                yield partial_reply
+                return  # End after streaming web answer (saved in finally)
+
+            # --- Assemble the prompt within the token budget ---
+            assembler = PromptAssembler(SYSTEM_PROMPT)
+
+            # Document Context Integration ONLY if file_id is specified (stable across the turns about this file)
+            if document_context and file_id:
+                assembler.add("document", document_section(document_context, structured_findings),
+                              PRIORITY_DOCUMENT, stable=True, max_tokens=PROMPT_DOCUMENT_TOKENS)
+
+            # If there are personal facts from other conversations, emphasize them
+            contains_fact, extracted_fact = stages.result("is_personal_fact", default=(False, ""))
+            print(f"🔍 DEBUG: Personal fact detection result: contains_fact={contains_fact}, extracted_fact='{extracted_fact}'")
+            if contains_fact:
+                assembler.add("fact", f"The user just shared an important personal fact: {extracted_fact}", PRIORITY_FACT)
+
+            current_memories, other_memories = format_memories(memories)
+            if other_memories:
+                print(f"🧠 DEBUG: Adding {len(memories['other'])} cross-conversation memories to the prompt")
+            assembler.add("memories_current", current_memories, PRIORITY_MEMORIES)
+            assembler.add("memories_other", other_memories, PRIORITY_MEMORIES)
+            assembler.add("reply", reply_context_block.strip(), PRIORITY_REPLY)
+
+            # Prepare LLM message history: up to and including the replied-to message, or the whole
+            # conversation before this message (the budget keeps the most recent part)
             if reply_context_messages is not None:
-                # Use all messages up to and including the replied-to message, then the new user message
-                for msg in reply_context_messages:
-                    llm_messages.append({"role": msg["role"], "content": msg["content"]})
-                llm_messages.append({"role": "user", "content": message})
+                history = reply_context_messages
                 print(f"DEBUG: Using reply context with {len(reply_context_messages)} messages for LLM")
             else:
-                # Add recent messages for context (default behavior)
-                for msg in messages[-10:]:
-                    llm_messages.append({"role": msg["role"], "content": msg["content"]})
-                print(f"DEBUG: Using last {len(messages[-10:])} messages for LLM")
+                history = messages[:-1]
+            llm_messages = build_llm_messages(assembler, user_id, conversation_id, history, message, f"chat {conversation_id}")
 
             # Send to Groq API
             response = groq_api_call(
@@ -942,29 +1262,11 @@ def chat(conversation_id):
                 stream=True
             )
             
-            for chunk in response.iter_lines():
-                if not chunk:
-                    continue
-                line = chunk.decode()
-                if line.startswith("data: "):
-                    line = line[len("data: "):]
-                if line.strip() == "[DONE]":
-                    break
-                try:
-                    data = json.loads(line)
-                    delta = data.get("choices", [{}])[0].get("delta", {}).get("content", "")
-                    if delta:
-                        partial_reply += delta
-                        # Print to terminal for local debugging
-                        print(delta, end="", flush=True)
-                        # Send to client without buffering
-                        yield delta
-                except Exception as e:
-                    print(f"Stream parse error: {e}", file=sys.stderr)
-                    continue
-            
-            # Print newline after completion in terminal
-            print()
+            # Tiny deltas are merged into frames (by size or age) before being written to the client
+            for frame in coalesce(iter_completion_deltas(response)):
+                partial_reply += frame
+                yield frame
+            print(f"DEBUG: Streamed reply of {len(partial_reply)} chars")
         except Exception as e:
             error_msg = f"[ERROR] API error: {e}"
             print(error_msg, file=sys.stderr)
@@ -972,37 +1274,26 @@ def chat(conversation_id):
             error_occurred = True
             yield error_msg
         finally:
-            # --- Add assistant reply to semantic memory ---
+            # Every branch ends here: save the reply once, then hand memory/fact work to the job queue
             if partial_reply:  # Only save if we got a response
-                memory_store.add(user_id, conversation_id, partial_reply, role="assistant", extra={"replyTo": reply_to} if reply_to else None)
                 # Add the assistant message to the conversation
                 assistant_message = {"role": "assistant", "content": partial_reply}
                 if reply_to:
                     assistant_message["replyTo"] = reply_to
                 messages.append(assistant_message)
-                conversation["messages"] = messages
-                conversation["updated_at"] = current_time
-                conversations[conversation_index] = conversation
-                
-                # Extract and store facts from the assistant's response
-                extract_and_store_facts(
-                    user_id,
-                    message,
-                    partial_reply,
-                    conversation_id,
-                    conversation_title
-                )
                 
                 # Update in the database
-                update_result = mongo.db.users.update_one(
-                    {"_id": ObjectId(user_id)},
-                    {"$set": {"conversations": conversations}}
-                )
-                print(f"Database update completed. Modified: {update_result.modified_count}")
+                seq = conversation_store.append_message(user_id, conversation_id, assistant_message, updated_at=current_time)
+                enqueue_message_indexing(user_id, conversation_id, seq)
+                print(f"Database update completed. Saved assistant message at index: {seq}")
+                
+                # Semantic memory and fact extraction run in the background worker
+                enqueue_post_response_jobs(turn_id, user_id, conversation_id, conversation_title, message, partial_reply, reply_to)
 
     # Create the response with proper headers
-    response = Response(stream_with_context(generate()), mimetype='text/plain')
+    response = Response(stream_with_context(stages.stream(generate())), mimetype='text/plain')
     response.headers.set('X-Web-Search-Used', str(auto_search_used).lower())
+    response.headers.set('X-Web-Search-Cached', str(cached_answer is not None).lower())
     return response
 
 
@@ -1068,6 +1359,120 @@ def chat(conversation_id):
 #     # Forward to the updated chat endpoint
 #     return chat(conversation_id)
 
+# --- Helper: Load the full text of an uploaded document ---
+def load_chunked_document(file_id):
+    """
+    Read an uploaded document from its packed chunk store, or from the legacy
+    per-chunk files for uploads that haven't been converted yet.
+    Returns: the text, or None if the document wasn't stored in chunks.
+    """
+    text = read_chunk_store_text(chunk_store_path(app.config['UPLOAD_FOLDER'], file_id))
+    if text is not None:
+        return text
+    chunk_texts = []
+    chunk_idx = 0
+    while True:
+        chunk_path = os.path.join(app.config['UPLOAD_FOLDER'], f'{file_id}_context_{chunk_idx}.txt')
+        if not os.path.exists(chunk_path):
+            break
+        with open(chunk_path, 'r', encoding='utf-8') as f:
+            chunk_texts.append(f.read())
+        chunk_idx += 1
+    return '\n'.join(chunk_texts) if chunk_texts else None
+
+def load_document_text(file_id):
+    """
+    Reassemble an uploaded document from its chunks (or the legacy single context file).
+    Returns: the text, or None if nothing was stored for this file_id.
+    """
+    text = load_chunked_document(file_id)
+    if text is not None:
+        return text
+    context_path = os.path.join(app.config['UPLOAD_FOLDER'], f'{file_id}_context.txt')
+    if os.path.exists(context_path):
+        with open(context_path, 'r', encoding='utf-8') as f:
+            return f.read()
+    return None
+
+# --- In-process cache of loaded documents (follow-up questions on the same file skip the disk and the parser) ---
+document_cache = DocumentCache(DOCUMENT_CACHE_MAX_BYTES)
+
+def document_version(file_id):
+    """
+    mtime of the stored document, so a cached copy is dropped once the file is rewritten or removed.
+    Returns: None if nothing is stored for this file_id.
+    """
+    upload_dir = app.config['UPLOAD_FOLDER']
+    for path in (
+        chunk_store_path(upload_dir, file_id),
+        os.path.join(upload_dir, f'{file_id}_context_0.txt'),
+        os.path.join(upload_dir, f'{file_id}_context.txt')
+    ):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            continue
+    return None
+
+def get_cached_document(file_id):
+    """
+    Load an uploaded document together with its parsed findings and original filename.
+    Returns: (dict with document_context, structured_findings and filename, or None;
+              True if it was served from the cache)
+    """
+    version = document_version(file_id)
+    if version is None:
+        document_cache.invalidate(file_id)
+        return None, False
+    document = document_cache.get(file_id, version)
+    if document is not None:
+        return document, True
+
+    document_context = load_document_text(file_id)
+    if document_context is None:
+        return None, False
+    try:
+        structured_findings = parse_vuln_txt(document_context)
+    except Exception as e:
+        print(f"DEBUG: Error parsing structured findings: {e}")
+        structured_findings = None
+    metadata = file_registry.get(file_id)
+    if metadata is None:
+        # Uploads that predate the registry and haven't been imported yet
+        metadata_path = os.path.join(app.config['UPLOAD_FOLDER'], f'{file_id}_metadata.json')
+        metadata = {}
+        if os.path.exists(metadata_path):
+            try:
+                with open(metadata_path, 'r', encoding='utf-8') as f:
+                    metadata = json.load(f)
+            except Exception as e:
+                print(f"DEBUG: Error reading metadata: {e}")
+    document = {
+        "document_context": document_context,
+        "structured_findings": structured_findings,
+        "filename": metadata.get('original_filename', 'Unknown')
+    }
+    document_cache.put(file_id, document, version)
+    return document, False
+
+# --- Helpers: Write an uploaded document's chunks and metadata ---
+def load_document_chunks(file_id):
+    with ChunkStore(chunk_store_path(app.config['UPLOAD_FOLDER'], file_id)) as store:
+        return store.chunks()
+
+def write_document_chunks(file_id, chunks):
+    # --- CHUNKING: Store all chunks in a single packed file ---
+    write_chunk_store(chunk_store_path(app.config['UPLOAD_FOLDER'], file_id), chunks)
+    document_cache.invalidate(file_id)
+
+def write_file_metadata(file_id, metadata):
+    # Written once the document is chunked, so files that fail to parse are never listed or auto-attached.
+    # The registry serves file lookups; the JSON file is kept next to the upload as before
+    file_registry.register(file_id, metadata)
+    metadata_path = os.path.join(app.config['UPLOAD_FOLDER'], f'{file_id}_metadata.json')
+    with open(metadata_path, 'w', encoding='utf-8') as f:
+        json.dump(metadata, f)
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -1094,111 +1499,141 @@ def upload_file():
         filename = secure_filename(file.filename)
         
         # Find conversation to get its title
-        user = mongo.db.users.find_one({"_id": ObjectId(user_id)})
-        conversation = None
+        conversation = conversation_store.get_conversation(user_id, conversation_id, include_messages=False)
         conversation_title = "Untitled Conversation"
-        if user:
-            conversation = next((conv for conv in user.get('conversations', []) if conv["id"] == conversation_id), None)
-            if conversation:
-                conversation_title = conversation.get('title', 'Untitled Conversation')
+        if conversation:
+            conversation_title = conversation.get('title', 'Untitled Conversation')
         
         # Create a unique filename with conversation ID included
         unique_file_id = f"{user_id}_{conversation_id}_{datetime.utcnow().timestamp()}"
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{unique_file_id}_{filename}")
         file.save(file_path)
+        filetype = filename.rsplit('.', 1)[1].lower()
         
-        try:
-            text, filetype = extract_text(file_path)
-        except Exception as e:
-            return jsonify({'msg': f'Failed to parse document: {str(e)}'}), 400
-            
-        # Store file content with conversation-specific key
-        context_path = os.path.join(app.config['UPLOAD_FOLDER'], f'{unique_file_id}_context.txt')
-        # --- CHUNKING: Split large text into chunks and store each chunk separately ---
-        chunk_paths = []
-        chunks = chunk_text(text, max_chars=2000)
-        for idx, chunk in enumerate(chunks):
-            chunk_path = os.path.join(app.config['UPLOAD_FOLDER'], f'{unique_file_id}_context_{idx}.txt')
-            with open(chunk_path, 'w', encoding='utf-8') as f:
-                f.write(chunk)
-            chunk_paths.append(chunk_path)
-        # For backward compatibility, also store the first chunk as the main context file
-        with open(context_path, 'w', encoding='utf-8') as f:
-            f.write(chunks[0] if chunks else '')
-            
-        # Store metadata about the file
-        metadata_path = os.path.join(app.config['UPLOAD_FOLDER'], f'{unique_file_id}_metadata.json')
-        with open(metadata_path, 'w', encoding='utf-8') as f:
-            json.dump({
-                'user_id': user_id,
-                'conversation_id': conversation_id,
-                'original_filename': file.filename,
-                'upload_time': datetime.utcnow().isoformat(),
-                'filetype': filetype
-            }, f)
-            
-        # Store file information in the memory system
-        file_memory = (
-            f"User uploaded a file named '{file.filename}' of type '{filetype}'. "
-            f"The file contains: {text[:500]}..."
-        )
+        # Parsing, chunking, embedding, indexing and summarizing happen in the background;
+        # the file's metadata is stored once it has been chunked
+        job_id = ingestion_tracker.create(user_id, unique_file_id, file.filename)
         
-        store_user_memory(
-            user_id,
-            file_memory,
-            conversation_id=conversation_id,
-            conversation_title=conversation_title,
-            mem_type="file",
-            is_factual=True,
-            importance=0.7,
-            topic="document"
-        )
-            
-        # Upsert file chunks into Pinecone
-        upsert_file_chunks_to_pinecone(unique_file_id, text)
+        job_queue.enqueue("ingest_file", {
+            "job_id": job_id,
+            "file_id": unique_file_id,
+            "file_path": file_path,
+            "user_id": user_id,
+            "conversation_id": conversation_id,
+            "conversation_title": conversation_title,
+            "original_filename": file.filename,
+            "upload_time": datetime.utcnow().isoformat()
+        }, idempotency_key=f"ingest_file:{job_id}")
             
         return jsonify({
-            'msg': 'File uploaded and parsed successfully', 
+            'msg': 'File uploaded, processing started', 
             'filetype': filetype, 
             'filename': file.filename,
-            'file_id': unique_file_id
-        }), 200
+            'file_id': unique_file_id,
+            'job_id': job_id,
+            'status_url': f"/upload/status/{job_id}"
+        }), 202
     else:
         return jsonify({'msg': 'File type not allowed'}), 400
 
-@app.route('/upload/filename/<conversation_id>', methods=['GET'])
-def get_uploaded_filename_for_conversation(conversation_id):
+@app.route('/upload/status/<job_id>', methods=['GET'])
+def get_upload_status(job_id):
     user_id = request.args.get('user_id')
     if not user_id:
         return jsonify({"msg": "user_id is required"}), 400
     
-    # Get all files for this user and conversation
-    upload_dir = app.config['UPLOAD_FOLDER']
-    files = []
-    
-    if os.path.exists(upload_dir):
-        for filename in os.listdir(upload_dir):
-            if filename.startswith(f"{user_id}_{conversation_id}_") and filename.endswith("_metadata.json"):
-                metadata_path = os.path.join(upload_dir, filename)
-                try:
-                    with open(metadata_path, 'r', encoding='utf-8') as f:
-                        metadata = json.load(f)
-                        files.append({
-                            'file_id': filename.replace('_metadata.json', ''),
-                            'filename': metadata.get('original_filename', 'Unknown'),
-                            'upload_time': metadata.get('upload_time')
-                        })
-                except Exception as e:
-                    print(f"Error loading metadata: {e}")
-    
-    # Sort by upload time, newest first
-    files.sort(key=lambda x: x.get('upload_time', ''), reverse=True)
+    status = ingestion_tracker.get(job_id)
+    if not status or status["user_id"] != user_id:
+        return jsonify({"msg": "Upload job not found."}), 404
     
-    # Return the most recent file or None
-    if files:
-        return jsonify({'files': files}), 200
+    return jsonify(status), 200
+
+# --- Background ingestion pipeline: extract -> chunk -> embed -> index -> summarize ---
+def ingest_file_abandoned(job_id, **payload):
+    # The worker died on the last attempt, so ingest_file_task never recorded the failure
+    ingestion_tracker.update(job_id, status="failed", error=ABANDONED_ERROR)
+
+@task("ingest_file", queue=INGEST_QUEUE, on_abandoned=ingest_file_abandoned)
+def ingest_file_task(job_id, file_id, file_path, user_id, conversation_id, conversation_title, original_filename, upload_time=None):
+    # A retry resumes after the last stage that finished
+    attempt = ingestion_tracker.start_attempt(job_id)
+    done = ingestion_tracker.completed_stages(job_id)
+
+    try:
+        if "chunk" in done:
+            chunks = load_document_chunks(file_id)
+        else:
+            try:
+                with ingestion_tracker.stage(job_id, "extract"):
+                    text, filetype = extract_text(file_path)
+            except Exception as e:
+                # A document that can't be parsed won't parse on a retry either
+                ingestion_tracker.update(job_id, status="failed", error=f"Failed to parse document: {str(e)}")
+                return
+
+            # Chat can use the file as soon as this stage is done
+            with ingestion_tracker.stage(job_id, "chunk"):
+                chunks = chunk_text(text, max_chars=2000)
+                write_document_chunks(file_id, chunks)
+                write_file_metadata(file_id, {
+                    'user_id': user_id,
+                    'conversation_id': conversation_id,
+                    'original_filename': original_filename,
+                    'upload_time': upload_time or datetime.utcnow().isoformat(),
+                    'filetype': filetype,
+                    'ingest_job_id': job_id
+                })
+
+        if "index" not in done:
+            # Vectors aren't kept between attempts, so a failed index stage embeds again
+            with ingestion_tracker.stage(job_id, "embed"):
+                vectors = embed_file_chunks(file_id, chunks)
+
+            with ingestion_tracker.stage(job_id, "index"):
+                # Vector ids are stable, so upserting again after a failure doesn't duplicate anything
+                upsert_vectors_to_pinecone(vectors)
+                # Store file information in the memory system
+                filetype = (file_registry.get(file_id) or {}).get("filetype")
+                preview = '\n'.join(chunks)[:500]
+                file_memory = (
+                    f"User uploaded a file named '{original_filename}' of type '{filetype}'. "
+                    f"The file contains: {preview}..."
+                )
+                store_user_memory(
+                    user_id,
+                    file_memory,
+                    conversation_id=conversation_id,
+                    conversation_title=conversation_title,
+                    mem_type="file",
+                    is_factual=True,
+                    importance=0.7,
+                    topic="document"
+                )
+
+        # Precompute the document summary so file questions don't pay for it
+        if "summarize" not in done:
+            with ingestion_tracker.stage(job_id, "summarize"):
+                enqueue_document_summary(file_id, '\n'.join(chunks))
+    except Exception as e:
+        # The job queue retries; only the last attempt is a failure the client should stop on
+        final = attempt >= job_queue.max_attempts
+        ingestion_tracker.update(job_id, status="failed" if final else "retrying", error=str(e))
+        raise
+
+    ingestion_tracker.update(job_id, status="done", error=None, chunk_count=len(chunks))
+
+@app.route('/upload/filename/<conversation_id>', methods=['GET'])
+def get_uploaded_filename_for_conversation(conversation_id):
+    user_id = request.args.get('user_id')
+    if not user_id:
+        return jsonify({"msg": "user_id is required"}), 400
     
-    return jsonify({'files': []}), 200
+    # Get all files for this user and conversation, newest first
+    files = [
+        {'file_id': f['file_id'], 'filename': f['filename'], 'upload_time': f['upload_time']}
+        for f in file_registry.list_conversation_files(user_id, conversation_id)
+    ]
+    return jsonify({'files': files}), 200
 
 @app.route('/conversations/<conversation_id>/messages/<int:msg_index>/edit', methods=['PUT'])
 def edit_message(conversation_id, msg_index):
@@ -1206,12 +1641,10 @@ def edit_message(conversation_id, msg_index):
     if not user_id:
         return jsonify({"msg": "user_id is required"}), 400
         
-    user = mongo.db.users.find_one({"_id": ObjectId(user_id)})
-    if not user:
+    if not user_exists(user_id):
         return jsonify({"msg": "User not found."}), 404
 
-    conversations = user.get('conversations', [])
-    conversation = next((conv for conv in conversations if conv["id"] == conversation_id), None)
+    conversation = conversation_store.get_conversation(user_id, conversation_id)
     if not conversation:
         return jsonify({"msg": "Conversation not found."}), 404
 
@@ -1223,14 +1656,17 @@ def edit_message(conversation_id, msg_index):
     new_content = data.get("content", "").strip()
     if not new_content:
         return jsonify({"msg": "Content required."}), 400
+    # Stream the regenerated reply as text/plain instead of returning the conversation when it's done
+    stream_reply = bool(data.get("stream")) or request.args.get("stream") in ("1", "true")
 
     # Store previous version
-    if 'versions' not in messages[msg_index]:
-        messages[msg_index]['versions'] = []
-    messages[msg_index]['versions'].append({
+    user_version = {
         'content': messages[msg_index]['content'],
         'timestamp': messages[msg_index].get('timestamp')
-    })
+    }
+    if 'versions' not in messages[msg_index]:
+        messages[msg_index]['versions'] = []
+    messages[msg_index]['versions'].append(user_version)
     
     # Preserve file attachments and other metadata when editing the message
     file_id = messages[msg_index].get('file_id')
@@ -1253,146 +1689,184 @@ def edit_message(conversation_id, msg_index):
     contains_fact, extracted_fact = is_personal_fact(new_content)
     conversation_title = conversation.get('title', 'Untitled Conversation')
     
-    # If it contains a personal fact, store it automatically
+    # If it contains a personal fact, store it in the background
     if contains_fact:
         print(f"DEBUG EDIT: Storing personal fact from edited message: {extracted_fact}")
-        store_user_memory(
-            user_id, 
-            extracted_fact,
-            conversation_id=conversation_id,
-            conversation_title=conversation_title,
-            mem_type="fact",
-            is_factual=True,
-            importance=0.8,
-            topic="cybersecurity"
-        )
+        job_queue.enqueue("store_user_memory", {
+            "user_id": user_id,
+            "text": extracted_fact,
+            "conversation_id": conversation_id,
+            "conversation_title": conversation_title,
+            "mem_type": "fact",
+            "is_factual": True,
+            "importance": 0.8,
+            "topic": "cybersecurity"
+        })
 
     # Find the assistant response after this user message
     if msg_index + 1 >= len(messages) or messages[msg_index + 1]["role"] != "assistant":
         return jsonify({"msg": "No assistant response after this message."}), 400
 
     # Store previous assistant response version
-    if 'versions' not in messages[msg_index + 1]:
-        messages[msg_index + 1]['versions'] = []
-    messages[msg_index + 1]['versions'].append({
+    assistant_version = {
         'content': messages[msg_index + 1]['content'],
         'timestamp': messages[msg_index + 1].get('timestamp')
-    })
+    }
+    if 'versions' not in messages[msg_index + 1]:
+        messages[msg_index + 1]['versions'] = []
+    messages[msg_index + 1]['versions'].append(assistant_version)
 
     # Truncate all messages after the assistant response
     messages = messages[:msg_index + 2]
     conversation['messages'] = messages
 
     # Regenerate assistant response
-    # Prepare LLM/system prompt as in chat endpoint
-    system_prompt = (
-        "You are Moktashif, a smart and friendly cybersecurity assistant.\n"
-        "You are strictly limited to answering only cybersecurity-related questions.\n"
-        "If a user asks anything not related to cybersecurity — including famous people, sports, general trivia, or personal questions — you must politely refuse.\n"
-        "Say: 'I can only help with cybersecurity topics. Please ask something related to web security, hacking, threats, or protection.'\n"
-        "Do not provide answers outside the domain, even if you know them. Never break character.\n"
-        "Use a warm, human tone with short, clear answers. You can be casual or slightly witty when appropriate, especially in greetings or small talk.\n"
-        "Introduce yourself as 'Moktashif' only when it makes sense — such as during first-time greetings, re-engagement after a pause, or if the user asks who you are.\n"
-        "Don't overuse your name. Vary your language like a real human would.\n"
-        "Avoid technical jargon unless the user clearly understands it. Always favor helpful explanations over buzzwords.\n"
-        "Do not break character or explain that you're an AI. Stay in role as Moktashif.\n"
-        "Do not hallucinate or provide false information regarding the security field like if the user have asked you about new cve or new tools just tell them that you don't know.\n"
-        "If the user asks about something recent, breaking, or requests the latest information, you may use live web search results if available.\n"
-        "If you do not have enough information to answer, you may request to use the web search feature.\n"
-        "You are a cybersecurity expert. Provide accurate information about cybersecurity topics "
-        "based on your training data. If the user is asking about something that would require "
-        "real-time or recent information that might not be in your knowledge base, let them know "
-        "they should enable web search for the most up-to-date information."
-    )
+    # Prepare the prompt as in the chat endpoint
+    assembler = PromptAssembler(SYSTEM_PROMPT)
     
     # Retrieve cross-conversation memories for context
-    cybersec_memories = retrieve_user_memories(user_id, new_content, conversation_id)
+    memories = memory_retriever.retrieve(user_id, new_content, conversation_id)
     
     # Debug memory retrieval for message editing
-    print(f"🧠 DEBUG EDIT MEMORY: Retrieved {len(cybersec_memories.get('current', []))} current memories")
-    print(f"🧠 DEBUG EDIT MEMORY: Retrieved {len(cybersec_memories.get('other', []))} cross-conversation memories")
+    print(f"🧠 DEBUG EDIT MEMORY: Retrieved {len(memories.get('current', []))} current memories")
+    print(f"🧠 DEBUG EDIT MEMORY: Retrieved {len(memories.get('other', []))} cross-conversation memories")
     
-    if cybersec_memories.get("other", []):
-        for i, mem in enumerate(cybersec_memories["other"][:2]):
+    if memories.get("other", []):
+        for i, mem in enumerate(memories["other"][:2]):
             conv_title = mem.get('conversation_title', 'Unknown')
             print(f"🧠   Edit Cross-Conv Memory {i+1} from '{conv_title}': {mem.get('text', '')[:100]}...")
     
-    # Format cross-conversation context for LLM
-    cybersec_memory_prompt = ""
-    if cybersec_memories.get("current", []):
-        cybersec_memory_prompt += "\n🔍 IMPORTANT CONTEXT FROM CURRENT CONVERSATION:\n" + "\n".join(
-            f"- {mem.get('text', '')}" for mem in cybersec_memories.get("current", [])
-        )
-    if cybersec_memories.get("other", []):
-        cybersec_memory_prompt += "\n\n🌐 CRITICAL CROSS-CONVERSATION CONTEXT (Remember these facts about the user):\n" + "\n".join(
-            f"- From '{mem.get('conversation_title', 'Previous conversation')}': {mem.get('text', '')}" 
-            for mem in cybersec_memories.get("other", [])
-        )
-        print(f"🧠 DEBUG EDIT: Adding {len(cybersec_memories['other'])} cross-conversation memories to edit prompt")
-    
-    # If there are personal facts from other conversations, emphasize them
-    if contains_fact:
-        system_prompt += f"\n\nThe user just shared an important personal fact: {extracted_fact}"
-        
-    if cybersec_memory_prompt:
-        system_prompt += "\n\n" + cybersec_memory_prompt
-    
     # Check if there's a file to include in the context
     document_context = None
     if file_id:
-        context_path = os.path.join(app.config['UPLOAD_FOLDER'], f'{file_id}_context.txt')
-        if os.path.exists(context_path):
-            with open(context_path, 'r', encoding='utf-8') as f:
-                document_context = f.read()
-            system_prompt += ("\n\nThe user has uploaded a document. Use the following as additional context when answering their queries: "
-                f"\n---\n{document_context[:2000]}\n---\n"
-            )
-    
-    llm_messages = [{"role": "system", "content": system_prompt}]
-    for m in messages[:msg_index + 1]:
-        llm_messages.append({"role": m["role"], "content": m["content"]})
-
-    payload = {
-        "model": MODEL,
-        "messages": llm_messages,
-        "temperature": TEMPERATURE,
-        "stream": False
-    }
-    headers = {
-        "Authorization": f"Bearer {API_KEY}",
-        "Content-Type": "application/json"
-    }
-    resp = requests.post(f"{BASE_URL}/chat/completions", json=payload, headers=headers)
-    resp.raise_for_status()
-    data = resp.json()
+        document, _ = get_cached_document(file_id)
+        if document:
+            document_context = document["document_context"]
+            assembler.add("document", document_section(document_context), PRIORITY_DOCUMENT,
+                          stable=True, max_tokens=PROMPT_DOCUMENT_TOKENS)
+
+    # If there are personal facts from other conversations, emphasize them
+    if contains_fact:
+        assembler.add("fact", f"The user just shared an important personal fact: {extracted_fact}", PRIORITY_FACT)
+
+    current_memories, other_memories = format_memories(memories)
+    assembler.add("memories_current", current_memories, PRIORITY_MEMORIES)
+    assembler.add("memories_other", other_memories, PRIORITY_MEMORIES)
+
+    llm_messages = build_llm_messages(assembler, user_id, conversation_id, messages[:msg_index], new_content,
+                                      f"edit {conversation_id}:{msg_index}")
+
+    if stream_reply:
+        return stream_edited_reply(
+            user_id, conversation_id, conversation_title, msg_index, llm_messages,
+            new_content, messages[msg_index]["timestamp"], user_version, assistant_version
+        )
+
+    data = groq_api_call(
+        messages=llm_messages,
+        model=MODEL,
+        temperature=TEMPERATURE,
+        stream=False
+    )
     new_response = data["choices"][0]["message"]["content"]
 
     # Update assistant response
     messages[msg_index + 1]["content"] = new_response
     messages[msg_index + 1]["timestamp"] = datetime.utcnow().isoformat() + 'Z'
+    messages[msg_index + 1]["incomplete"] = False
     conversation['messages'] = messages
     conversation['updated_at'] = datetime.utcnow().isoformat() + 'Z'
     
-    # Extract and store facts from the new response
-    extract_and_store_facts(
-        user_id,
-        new_content,
-        new_response,
-        conversation_id,
-        conversation_title
+    # Save back to DB: only the two edited messages are written, later messages are dropped.
+    # The user message is only updated if nobody else edited it while we were generating.
+    if not conversation_store.update_message(
+        user_id, conversation_id, msg_index,
+        {"content": new_content, "timestamp": messages[msg_index]["timestamp"]},
+        push_version=user_version,
+        expected_content=user_version["content"]
+    ):
+        return jsonify({"msg": "This message was changed in another session. Please reload the conversation."}), 409
+    conversation_store.update_message(
+        user_id, conversation_id, msg_index + 1,
+        # Clears the flag left by an earlier streamed edit that was cut off
+        {"content": new_response, "timestamp": messages[msg_index + 1]["timestamp"], "incomplete": False},
+        push_version=assistant_version
     )
+    conversation_store.truncate_messages(user_id, conversation_id, msg_index + 2)
+    conversation['message_count'] = len(messages)
 
-    # Save back to DB
-    for i, conv in enumerate(conversations):
-        if conv["id"] == conversation_id:
-            conversations[i] = conversation
-            break
-    mongo.db.users.update_one(
-        {"_id": ObjectId(user_id)},
-        {"$set": {"conversations": conversations}}
-    )
+    # Re-embed the two edited messages and drop the vectors of the discarded ones
+    enqueue_message_indexing(user_id, conversation_id, msg_index)
+    enqueue_message_indexing(user_id, conversation_id, msg_index + 1)
+    job_queue.enqueue("unindex_messages", {"user_id": user_id, "conversation_id": conversation_id, "from_seq": msg_index + 2})
+
+    # Extract and store facts from the new response in the background
+    enqueue_post_response_jobs(str(ObjectId()), user_id, conversation_id, conversation_title, new_content, new_response, add_to_memory=False)
     return jsonify({"conversation": conversation}), 200
 
+EDIT_STREAM_SAVE_INTERVAL = float(os.getenv("EDIT_STREAM_SAVE_INTERVAL", "1.0"))
+
+def stream_edited_reply(user_id, conversation_id, conversation_title, msg_index, llm_messages,
+                        new_content, edited_at, user_version, assistant_version):
+    """
+    Streaming mode of edit_message. The edit itself (new user content, previous versions,
+    truncation) is saved before generating, and the regenerated reply is written back
+    every EDIT_STREAM_SAVE_INTERVAL seconds while it streams. A client that drops mid-reply
+    leaves the partial reply saved with incomplete=True instead of a half-applied edit.
+    """
+    if not conversation_store.update_message(
+        user_id, conversation_id, msg_index,
+        {"content": new_content, "timestamp": edited_at},
+        push_version=user_version,
+        expected_content=user_version["content"]
+    ):
+        return jsonify({"msg": "This message was changed in another session. Please reload the conversation."}), 409
+    conversation_store.update_message(
+        user_id, conversation_id, msg_index + 1,
+        {"content": "", "timestamp": datetime.utcnow().isoformat() + 'Z', "incomplete": True},
+        push_version=assistant_version
+    )
+    conversation_store.truncate_messages(user_id, conversation_id, msg_index + 2)
+    enqueue_message_indexing(user_id, conversation_id, msg_index)
+    job_queue.enqueue("unindex_messages", {"user_id": user_id, "conversation_id": conversation_id, "from_seq": msg_index + 2})
+
+    def generate():
+        partial_reply = ""
+        completed = False
+        last_saved = time.perf_counter()
+        try:
+            response = groq_api_call(
+                messages=llm_messages,
+                model=MODEL,
+                temperature=TEMPERATURE,
+                stream=True
+            )
+            for frame in coalesce(iter_completion_deltas(response)):
+                partial_reply += frame
+                yield frame
+                if time.perf_counter() - last_saved >= EDIT_STREAM_SAVE_INTERVAL:
+                    conversation_store.update_message(user_id, conversation_id, msg_index + 1, {"content": partial_reply})
+                    last_saved = time.perf_counter()
+            completed = True
+        except Exception as e:
+            error_msg = f"[ERROR] API error: {e}"
+            print(error_msg, file=sys.stderr)
+            if not partial_reply:
+                partial_reply = error_msg
+            yield error_msg
+        finally:
+            # Runs on completion, on error, and when the client disconnects
+            conversation_store.update_message(
+                user_id, conversation_id, msg_index + 1,
+                {"content": partial_reply, "timestamp": datetime.utcnow().isoformat() + 'Z', "incomplete": not completed}
+            )
+            enqueue_message_indexing(user_id, conversation_id, msg_index + 1)
+            if completed:
+                # Extract and store facts from the new response in the background
+                enqueue_post_response_jobs(str(ObjectId()), user_id, conversation_id, conversation_title, new_content, partial_reply, add_to_memory=False)
+
+    return Response(stream_with_context(generate()), mimetype='text/plain')
+
 @app.route('/conversations/<conversation_id>/web_search', methods=['POST'])
 def web_search_endpoint(conversation_id):
     """
@@ -1403,19 +1877,10 @@ def web_search_endpoint(conversation_id):
     if not user_id:
         return jsonify({"msg": "user_id is required"}), 400
         
-    user = mongo.db.users.find_one({"_id": ObjectId(user_id)})
-    if not user:
+    if not user_exists(user_id):
         return jsonify({"msg": "User not found."}), 404
 
-    conversations = user.get('conversations', [])
-    conversation_index = None
-    conversation = None
-
-    for i, conv in enumerate(conversations):
-        if conv["id"] == conversation_id:
-            conversation = conv
-            conversation_index = i
-            break
+    conversation = conversation_store.get_conversation(user_id, conversation_id)
 
     if conversation is None:
         return jsonify({"msg": "Conversation not found."}), 404
@@ -1433,33 +1898,33 @@ def web_search_endpoint(conversation_id):
     if not message:
         return jsonify({"msg": "Message required."}), 400
 
+    if file_id:
+        document_state, ingest_job = wait_for_document(file_id)
+        if document_state != "ready":
+            return document_not_ready_response(document_state, ingest_job)
+
     messages = conversation.get('messages', [])
 
     # Update timestamp
     current_time = datetime.utcnow().isoformat() + "Z"
-    conversation["updated_at"] = current_time
-    
-    # --- Check if message contains personal facts ---
-    contains_fact, extracted_fact = is_personal_fact(message)
     
-    # --- If it contains a personal fact, store it automatically ---
     conversation_title = conversation.get('title', 'Untitled Conversation')
-    
-    if contains_fact:
-        print(f"DEBUG WEB SEARCH: Storing personal fact: {extracted_fact}")
-        store_user_memory(
-            user_id, 
-            extracted_fact,
-            conversation_id=conversation_id,
-            conversation_title=conversation_title,
-            mem_type="fact",
-            is_factual=True,
-            importance=0.8,
-            topic="cybersecurity"
-        )
-
-    # Add user message to semantic memory
-    memory_store.add(user_id, conversation_id, message, role="user", extra={"replyTo": reply_to} if reply_to else None)
+    turn_id = str(ObjectId())
+
+    # --- Fact detection/storage and semantic memory don't affect the search, so run them in the background ---
+    job_queue.enqueue("detect_and_store_fact", {
+        "user_id": user_id,
+        "text": message,
+        "conversation_id": conversation_id,
+        "conversation_title": conversation_title
+    }, idempotency_key=f"detect_and_store_fact:{turn_id}")
+    job_queue.enqueue("memory_add", {
+        "user_id": user_id,
+        "conversation_id": conversation_id,
+        "text": message,
+        "role": "user",
+        "extra": {"replyTo": reply_to} if reply_to else None
+    }, idempotency_key=f"memory_add_user:{turn_id}")
 
     # Save user message immediately with file information
     user_message = {"role": "user", "content": message}
@@ -1481,22 +1946,21 @@ def web_search_endpoint(conversation_id):
             print(f"DEBUG WEB SEARCH: Error getting file metadata: {e}")
             
     messages.append(user_message)
-    conversation["messages"] = messages
-    conversation["updated_at"] = current_time
-    conversations[conversation_index] = conversation
     
     # Update in database right away to ensure file info is saved
-    mongo.db.users.update_one(
-        {"_id": ObjectId(user_id)},
-        {"$set": {"conversations": conversations}}
-    )
+    user_seq = conversation_store.append_message(user_id, conversation_id, user_message, updated_at=current_time)
+    enqueue_message_indexing(user_id, conversation_id, user_seq)
     print(f"DEBUG WEB SEARCH: Saved user message with hasFile: {user_message.get('hasFile', False)}, fileName: {user_message.get('fileName', 'None')}")
 
+    # A reply or a file always adds private context to the query, so those are never cached.
+    # A cached answer skips the cross-conversation memories the live search would add.
+    cache_enabled = not reply_to and not file_id and web_cache_enabled(user_id, data)
+    cached_answer = lookup_web_answer(message) if cache_enabled else None
+
     def generate():
         import sys
         import json
         import os
-        from cybersec_agent import answer_cybersec_query
         
         partial_reply = ""
         
@@ -1505,6 +1969,12 @@ def web_search_endpoint(conversation_id):
         print(f"DEBUG WEB SEARCH: GOOGLE_CSE_ID exists: {'Yes' if os.getenv('GOOGLE_CSE_ID') else 'No'}")
         
         try:
+            if cached_answer is not None:
+                print("DEBUG WEB SEARCH: Answering from the web answer cache")
+                partial_reply = cached_answer["answer"]
+                yield partial_reply
+                return
+
             # --- Get reply context (if replying to a message in current conversation) ---
             reply_context_block = ""
             reply_context_messages = None
@@ -1586,88 +2056,62 @@ def web_search_endpoint(conversation_id):
             
             if file_id:
                 print(f"DEBUG WEB SEARCH: Loading document context for file_id: {file_id}")
-                # --- CHUNKING: Load all chunk files for this file_id ---
-                chunk_texts = []
-                chunk_idx = 0
-                while True:
-                    chunk_path = os.path.join(app.config['UPLOAD_FOLDER'], f'{file_id}_context_{chunk_idx}.txt')
-                    if not os.path.exists(chunk_path):
-                        break
-                    with open(chunk_path, 'r', encoding='utf-8') as f:
-                        chunk_texts.append(f.read())
-                    chunk_idx += 1
-                if chunk_texts:
-                    document_context = '\n'.join(chunk_texts)
-                    print(f"DEBUG WEB SEARCH: Loaded {len(chunk_texts)} chunk(s) for document context ({len(document_context)} chars)")
-                else:
-                    # Fallback to old single context file
-                    context_path = os.path.join(app.config['UPLOAD_FOLDER'], f'{file_id}_context.txt')
-                    if os.path.exists(context_path):
-                        with open(context_path, 'r', encoding='utf-8') as f:
-                            document_context = f.read()
-                            print(f"DEBUG WEB SEARCH: Loaded document context ({len(document_context)} chars)")
-                    
-                    # Try to get the filename from metadata
-                    metadata_path = os.path.join(app.config['UPLOAD_FOLDER'], f'{file_id}_metadata.json')
-                    if os.path.exists(metadata_path):
-                        try:
-                            with open(metadata_path, 'r', encoding='utf-8') as f:
-                                metadata = json.load(f)
-                                filename = metadata.get('original_filename', 'Unknown')
-                                print(f"DEBUG WEB SEARCH: Found filename from metadata: {filename}")
-                        except Exception as e:
-                            print(f"DEBUG WEB SEARCH: Error reading metadata: {e}")
+                document, from_cache = get_cached_document(file_id)
+                if document:
+                    document_context = document["document_context"]
+                    filename = document["filename"]
+                    print(f"DEBUG WEB SEARCH: Loaded document context ({len(document_context)} chars, cached: {from_cache})")
                             
-                    # Store file context in memory system
-                    if document_context:
+                    # Store file context in memory system (once per load, not on every follow-up question)
+                    if document_context and not from_cache:
                         file_context_memory = f"Document loaded: '{filename}' with content: {document_context[:500]}..."
-                        store_user_memory(
-                            user_id,
-                            file_context_memory,
-                            conversation_id=conversation_id,
-                            conversation_title=conversation_title,
-                            mem_type="file",
-                            is_factual=True,
-                            importance=0.7,
-                            topic="document"
-                        )
+                        job_queue.enqueue("store_user_memory", {
+                            "user_id": user_id,
+                            "text": file_context_memory,
+                            "conversation_id": conversation_id,
+                            "conversation_title": conversation_title,
+                            "mem_type": "file",
+                            "is_factual": True,
+                            "importance": 0.7,
+                            "topic": "document"
+                        })
             
             # Retrieve cross-conversation memories for context
-            cybersec_memories = retrieve_user_memories(user_id, message, conversation_id)
+            memories = memory_retriever.retrieve(user_id, message, conversation_id)
             
             # Debug memory retrieval for web search
-            print(f"🧠 DEBUG WEB SEARCH MEMORY: Retrieved {len(cybersec_memories.get('current', []))} current memories")
-            print(f"🧠 DEBUG WEB SEARCH MEMORY: Retrieved {len(cybersec_memories.get('other', []))} cross-conversation memories")
+            print(f"🧠 DEBUG WEB SEARCH MEMORY: Retrieved {len(memories.get('current', []))} current memories")
+            print(f"🧠 DEBUG WEB SEARCH MEMORY: Retrieved {len(memories.get('other', []))} cross-conversation memories")
             
-            if cybersec_memories.get("other", []):
-                for i, mem in enumerate(cybersec_memories["other"][:2]):
+            if memories.get("other", []):
+                for i, mem in enumerate(memories["other"][:2]):
                     conv_title = mem.get('conversation_title', 'Unknown')
                     print(f"🧠   Web Search Cross-Conv Memory {i+1} from '{conv_title}': {mem.get('text', '')[:100]}...")
             
             # Format cross-conversation context
-            cross_context = ""
-            if cybersec_memories.get("other", []):
-                cross_context = "\n\n🌐 IMPORTANT CONTEXT FROM OTHER CONVERSATIONS:\n" + "\n".join(
-                    f"- From '{mem.get('conversation_title', 'Previous conversation')}': {mem.get('text', '')}" 
-                    for mem in cybersec_memories.get("other", [])
-                )
-                print(f"🧠 DEBUG WEB SEARCH: Adding {len(cybersec_memories['other'])} cross-conversation memories to web search query")
+            _, cross_context = format_memories(memories)
+            if cross_context:
+                print(f"🧠 DEBUG WEB SEARCH: Adding {len(memories['other'])} cross-conversation memories to web search query")
             
-            # Use the document context in the search if available
-            enhanced_message = message
+            # The search query is the message plus whatever context fits WEB_QUERY_TOKEN_BUDGET
+            assembler = PromptAssembler(message, budget=count_tokens(message) + WEB_QUERY_TOKEN_BUDGET)
             
             # Add reply context to enhanced message if available
             if reply_context_block:
                 print(f"DEBUG WEB SEARCH: Adding reply context to enhanced message")
-                enhanced_message = f"{message}\n\nPrevious message context: {reply_content}"
+                assembler.add("reply", f"\n\nPrevious message context: {reply_content}", PRIORITY_REPLY)
                 
+            # Use the document context in the search if available
             if document_context:
                 print(f"DEBUG WEB SEARCH: Enhancing message with document context")
-                enhanced_message = f"{enhanced_message} regarding file '{filename}': {document_context[:300]}..."
+                assembler.add("document", f" regarding file '{filename}': {document_context}", PRIORITY_DOCUMENT, max_tokens=75)
                 
             if cross_context:
                 print(f"DEBUG WEB SEARCH: Adding cross-conversation context to query")
-                enhanced_message = f"{enhanced_message}\n\nAdditional context: {cross_context}"
+                assembler.add("memories_other", f"\n\nAdditional context: \n\n{cross_context}", PRIORITY_MEMORIES)
+
+            enhanced_message = assembler.build_text()
+            print(f"[PROMPT] web search {conversation_id}: {assembler.report()}")
             
             # Always use web search for this endpoint
             print(f"DEBUG WEB SEARCH: Sending message to cybersec_agent: {enhanced_message[:100]}...")
@@ -1678,6 +2122,10 @@ def web_search_endpoint(conversation_id):
                 # Debug if web search was actually used
                 print(f"DEBUG WEB SEARCH: Used web search: {agent_result.get('used_web_search', False)}")
                 print(f"DEBUG WEB SEARCH: Links returned: {len(agent_result.get('links', []))}")
+
+                # Only cache answers to the bare message, never to a query carrying the user's context
+                if cache_enabled and enhanced_message == message:
+                    store_web_answer(message, agent_result)
                 
                 answer = agent_result.get("answer", "[No answer]")
                 
@@ -1695,10 +2143,9 @@ def web_search_endpoint(conversation_id):
                     
                     answer = error_msg
                 
-                # Stream the answer to the client
-                for chunk in answer.splitlines(keepends=True):
-                    partial_reply += chunk
-                    yield chunk
+                # The agent returns a finished answer, so send it in one write
+                partial_reply += answer
+                yield answer
                     
             except Exception as agent_error:
                 print(f"DEBUG WEB SEARCH: Error from cybersec_agent: {agent_error}")
@@ -1714,35 +2161,23 @@ def web_search_endpoint(conversation_id):
         finally:
             # Save the assistant reply if we got one
             if partial_reply:
-                memory_store.add(user_id, conversation_id, partial_reply, role="assistant", extra={"replyTo": reply_to} if reply_to else None)
-                
-                # Extract and store facts from the assistant's response
-                extract_and_store_facts(
-                    user_id,
-                    message,
-                    partial_reply,
-                    conversation_id,
-                    conversation_title
-                )
-                
                 # Add assistant message to the conversation
                 assistant_message = {"role": "assistant", "content": partial_reply}
                 if reply_to:
                     assistant_message["replyTo"] = reply_to
                 messages.append(assistant_message)
-                conversation["messages"] = messages
-                conversation["updated_at"] = current_time
-                conversations[conversation_index] = conversation
                 
                 # Update in database
-                mongo.db.users.update_one(
-                    {"_id": ObjectId(user_id)},
-                    {"$set": {"conversations": conversations}}
-                )
+                seq = conversation_store.append_message(user_id, conversation_id, assistant_message, updated_at=current_time)
+                enqueue_message_indexing(user_id, conversation_id, seq)
+                
+                # Semantic memory and fact extraction run in the background worker
+                enqueue_post_response_jobs(turn_id, user_id, conversation_id, conversation_title, message, partial_reply, reply_to)
 
     # Create response with correct headers
     response = Response(stream_with_context(generate()), mimetype='text/plain')
     response.headers.set('X-Web-Search-Used', 'true')  # Always true for this endpoint
+    response.headers.set('X-Web-Search-Cached', str(cached_answer is not None).lower())
     return response
 
 # Add a new endpoint to list all uploaded files for a user
@@ -1752,32 +2187,8 @@ def list_user_files():
     if not user_id:
         return jsonify({"msg": "user_id is required"}), 400
     
-    # Get all files for this user from the uploads directory
-    upload_dir = app.config['UPLOAD_FOLDER']
-    files = []
-    
-    if os.path.exists(upload_dir):
-        for filename in os.listdir(upload_dir):
-            if filename.endswith('_metadata.json') and filename.startswith(f"{user_id}_"):
-                metadata_path = os.path.join(upload_dir, filename)
-                try:
-                    with open(metadata_path, 'r', encoding='utf-8') as f:
-                        metadata = json.load(f)
-                        file_id = filename.replace('_metadata.json', '')
-                        files.append({
-                            'file_id': file_id,
-                            'filename': metadata.get('original_filename', 'Unknown'),
-                            'upload_time': metadata.get('upload_time', ''),
-                            'conversation_id': metadata.get('conversation_id', ''),
-                            'filetype': metadata.get('filetype', '')
-                        })
-                except Exception as e:
-                    print(f"Error loading metadata: {e}")
-    
-    # Sort by upload time, newest first
-    files.sort(key=lambda x: x.get('upload_time', ''), reverse=True)
-    
-    return jsonify({'files': files}), 200
+    # Get all files for this user, newest first
+    return jsonify({'files': file_registry.list_user_files(user_id)}), 200
 
 # Add an endpoint to get file content by file_id
 @app.route('/file/<file_id>', methods=['GET'])
@@ -1790,14 +2201,12 @@ def get_file_content(file_id):
     if not file_id.startswith(f"{user_id}_"):
         return jsonify({"msg": "File not found or not authorized"}), 404
     
-    # Get the file content
-    context_path = os.path.join(app.config['UPLOAD_FOLDER'], f'{file_id}_context.txt')
-    if not os.path.exists(context_path):
-        return jsonify({"msg": "File content not found"}), 404
-    
     try:
-        with open(context_path, 'r', encoding='utf-8') as f:
-            content = f.read()
+        # Get the file content
+        document, _ = get_cached_document(file_id)
+        if document is None:
+            return jsonify({"msg": "File content not found"}), 404
+        content = document["document_context"]
             
         # Get metadata if available
         metadata = {}
@@ -1821,8 +2230,8 @@ def get_file_content(file_id):
 def summarize_cybersec_chunks(file_content, llm_api_func, max_chars=2000, model=None):
     from document_parser import chunk_text
     chunks = chunk_text(file_content, max_chars=max_chars)
-    all_summaries = []
-    for idx, chunk in enumerate(chunks):
+
+    def summarize_chunk(idx, chunk):
         prompt = (
             f"This is part {idx+1} of a document. "
             "Summarize the key cybersecurity-related information, findings, or insights in this section. "
@@ -1830,86 +2239,93 @@ def summarize_cybersec_chunks(file_content, llm_api_func, max_chars=2000, model=
             "'I can only help with cybersecurity topics. Please ask something related to web security, hacking, threats, or protection.'\n\n"
             f"{chunk}"
         )
-        summary = llm_api_func(prompt, model=model)
-        all_summaries.append(summary)
-    # Optionally, combine and summarize all findings
-    combined_summary_prompt = (
-        "Combine and summarize the following findings from a document, focusing only on cybersecurity-related content. "
-        "If none of the content is cybersecurity-related, respond with: 'I can only help with cybersecurity topics. Please ask something related to web security, hacking, threats, or protection.'\n\n"
-        + "\n\n".join(all_summaries)
-    )
-    final_summary = llm_api_func(combined_summary_prompt, model=model)
-    return final_summary
+        return llm_api_func(prompt, model=model)
+
+    # Combine and summarize findings, a group of partial summaries at a time
+    def combine(summaries):
+        combined_summary_prompt = (
+            "Combine and summarize the following findings from a document, focusing only on cybersecurity-related content. "
+            "If none of the content is cybersecurity-related, respond with: 'I can only help with cybersecurity topics. Please ask something related to web security, hacking, threats, or protection.'\n\n"
+            + "\n\n".join(summaries)
+        )
+        return llm_api_func(combined_summary_prompt, model=model)
+
+    final_summary = map_reduce(chunks, summarize_chunk, combine)
+    return final_summary or "[ERROR] Could not summarize the document."
 
 # --- Hierarchical Summarization and Q&A Helpers ---
-def hierarchical_summarize(file_content, llm_api_func, max_chars=2000, model=None, max_depth=3):
+def hierarchical_summarize(file_content, llm_api_func, max_chars=2000, model=None, max_depth=3, cache=None, file_id=None):
     """
     Summarize a large file hierarchically so the LLM can analyze the whole content.
+    Chunk summaries are requested concurrently, then merged in a tree (see map_reduce.py).
     - file_content: The full text of the file.
     - llm_api_func: Function to call your LLM (prompt, model) -> response string.
     - max_chars: Max chars per chunk.
     - model: LLM model name.
-    - max_depth: How many times to recursively summarize if needed.
+    - max_depth: Max number of merge levels before everything left is merged in one final call.
+    - cache: Optional SummaryCache; every summarization call at every level is looked up there first.
+    - file_id: File the cached entries belong to.
     Returns: Final summary string.
     """
     from document_parser import chunk_text
-    import logging
-
-    current_content = file_content
-    for depth in range(max_depth):
-        chunks = chunk_text(current_content, max_chars=max_chars)
-        # Combine the first 2-3 non-empty chunks for the initial summary
-        non_empty_chunks = [c for c in chunks if c.strip()]
-        if len(non_empty_chunks) == 0:
-            return "[ERROR] No content found in the document."
-        if len(chunks) == 1 or depth == 0:
-            # Use up to the first 3 non-empty chunks for the first summary
-            combined = "\n\n".join(non_empty_chunks[:3])
-            print("[DEBUG] Sending to LLM for summary (first 500 chars):\n", combined[:500])
-            prompt = (
-                "You are provided with the full text of a cybersecurity document below. "
-                "Never say anything about missing documents or lack of context. Always assume the document is present if you see text below. "
-                "Summarize the following document, focusing on all cybersecurity-related information, findings, or insights. "
-                "If the content is not related to cybersecurity, respond with: "
-                "'I can only help with cybersecurity topics. Please ask something related to web security, hacking, threats, or protection.'\n\n"
-                f"{combined}"
-            )
-            return llm_api_func(prompt, model=model)
-        # Summarize each chunk
-        summaries = []
-        for idx, chunk in enumerate(chunks):
-            if not chunk.strip():
-                continue
-            print(f"[DEBUG] Summarizing chunk {idx+1} (first 200 chars):\n", chunk[:200])
-            prompt = (
-                f"This is part {idx+1} of a document. "
-                "You are provided with the full text of a cybersecurity document below. "
-                "Never say anything about missing documents or lack of context. Always assume the document is present if you see text below. "
-                "Summarize the key cybersecurity-related information, findings, or insights in this section. "
-                "If the content is not related to cybersecurity, respond with: "
-                "'I can only help with cybersecurity topics. Please ask something related to web security, hacking, threats, or protection.'\n\n"
-                f"{chunk}"
-            )
-            summaries.append(llm_api_func(prompt, model=model))
-        # Combine summaries for next round
-        current_content = "\n\n".join(summaries)
-    # Final summary if still too large
-    prompt = (
-        "You are provided with the full text of a cybersecurity document below. "
-        "Never say anything about missing documents or lack of context. Always assume the document is present if you see text below. "
-        "Summarize the following document, focusing on all cybersecurity-related information, findings, or insights. "
-        "If the content is not related to cybersecurity, respond with: "
-        "'I can only help with cybersecurity topics. Please ask something related to web security, hacking, threats, or protection.'\n\n"
-        f"{current_content}"
+
+    def summarize(prompt):
+        if cache is not None:
+            return cache.cached_call(prompt, llm_api_func, model=model, file_id=file_id)
+        return llm_api_func(prompt, model=model)
+
+    def summarize_document(text):
+        prompt = (
+            "You are provided with the full text of a cybersecurity document below. "
+            "Never say anything about missing documents or lack of context. Always assume the document is present if you see text below. "
+            "Summarize the following document, focusing on all cybersecurity-related information, findings, or insights. "
+            "If the content is not related to cybersecurity, respond with: "
+            "'I can only help with cybersecurity topics. Please ask something related to web security, hacking, threats, or protection.'\n\n"
+            f"{text}"
+        )
+        return summarize(prompt)
+
+    def summarize_chunk(idx, chunk):
+        print(f"[DEBUG] Summarizing chunk {idx+1} (first 200 chars):\n", chunk[:200])
+        prompt = (
+            f"This is part {idx+1} of a document. "
+            "You are provided with the full text of a cybersecurity document below. "
+            "Never say anything about missing documents or lack of context. Always assume the document is present if you see text below. "
+            "Summarize the key cybersecurity-related information, findings, or insights in this section. "
+            "If the content is not related to cybersecurity, respond with: "
+            "'I can only help with cybersecurity topics. Please ask something related to web security, hacking, threats, or protection.'\n\n"
+            f"{chunk}"
+        )
+        return summarize(prompt)
+
+    non_empty_chunks = [c for c in chunk_text(file_content, max_chars=max_chars) if c.strip()]
+    if len(non_empty_chunks) == 0:
+        return "[ERROR] No content found in the document."
+    if len(non_empty_chunks) <= 3:
+        # Small enough to summarize in a single call
+        combined = "\n\n".join(non_empty_chunks)
+        print("[DEBUG] Sending to LLM for summary (first 500 chars):\n", combined[:500])
+        return summarize_document(combined)
+
+    # Summarize each chunk concurrently, then merge the summaries level by level
+    summary = map_reduce(
+        non_empty_chunks,
+        summarize_chunk,
+        lambda summaries: summarize_document("\n\n".join(summaries)),
+        max_levels=max_depth
     )
-    return llm_api_func(prompt, model=model)
+    return summary or "[ERROR] Could not summarize the document."
 
 
-def qa_over_summary(file_content, user_query, llm_api_func, max_chars=2000, model=None):
+def qa_over_summary(file_content, user_query, llm_api_func, max_chars=2000, model=None, summary=None,
+                    stream=False, llm_stream_func=None):
     """
     Answer a user question using a hierarchical summary of the whole file.
+    Pass `summary` when it is already known (e.g. from the summary cache) to skip summarizing again.
+    With stream=True the answer is returned as an iterator of text deltas from llm_stream_func.
     """
-    summary = hierarchical_summarize(file_content, llm_api_func, max_chars=max_chars, model=model)
+    if summary is None:
+        summary = hierarchical_summarize(file_content, llm_api_func, max_chars=max_chars, model=model)
     prompt = (
         "You are provided with the full text of a cybersecurity document below. "
         "Never say anything about missing documents or lack of context. Always assume the document is present if you see text below. "
@@ -1919,8 +2335,40 @@ def qa_over_summary(file_content, user_query, llm_api_func, max_chars=2000, mode
         "If the content is not related to cybersecurity, respond with: "
         "'I can only help with cybersecurity topics. Please ask something related to web security, hacking, threats, or protection.'"
     )
+    if stream:
+        if llm_stream_func is None:
+            raise ValueError("stream=True requires llm_stream_func")
+        return llm_stream_func(prompt, model=model)
     return llm_api_func(prompt, model=model)
 
+def get_document_summary(file_id, file_content):
+    """
+    Return the hierarchical summary of an uploaded file, computing and caching it on first use.
+    Cached by file_id plus a hash of the content, so a changed document is summarized again.
+    This makes one LLM call per chunk: only call it from the summarize_file job.
+    """
+    summary = summary_cache.get_document_summary(file_id, file_content)
+    if summary is None:
+        summary = hierarchical_summarize(file_content, llm_api_func, cache=summary_cache, file_id=file_id)
+        if summary and not summary.startswith("[ERROR]"):
+            summary_cache.set_document_summary(file_id, file_content, summary)
+    return summary
+
+def enqueue_document_summary(file_id, file_content):
+    """
+    Queue the summary of a file. The idempotency key includes the content hash,
+    so each version of a file is summarized by at most one job.
+    """
+    job_queue.enqueue("summarize_file", {"file_id": file_id},
+                      idempotency_key=f"summarize_file:{file_id}:{content_hash(file_content)}")
+
+@task("summarize_file", queue=BULK_QUEUE)
+def summarize_file_task(file_id):
+    file_content = load_document_text(file_id)
+    if file_content is None:
+        return  # Deleted since the job was queued
+    get_document_summary(file_id, file_content)
+
 # --- Authentication Routes ---
 
 @app.route('/user/getProfile', methods=['GET'])
@@ -1930,7 +2378,7 @@ def get_profile():
         if not user_id:
             return jsonify({"msg": "user_id is required"}), 400
             
-        user = mongo.db.users.find_one({"_id": ObjectId(user_id)})
+        user = mongo.db.users.find_one({"_id": ObjectId(user_id)}, {"conversations": 0})
         
         if not user:
             return jsonify({"success": False, "message": "User not found"}), 404
@@ -1950,6 +2398,26 @@ def get_profile():
     except Exception as e:
         return jsonify({"success": False, "message": f"Failed to get profile: {str(e)}"}), 500
 
+@app.route('/user/preferences', methods=['PUT'])
+def update_preferences():
+    data = request.json or {}
+    user_id = data.get('user_id')
+    if not user_id:
+        return jsonify({"msg": "user_id is required"}), 400
+
+    updates = {}
+    if 'web_answer_cache' in data:
+        if not isinstance(data['web_answer_cache'], bool):
+            return jsonify({"msg": "web_answer_cache must be true or false"}), 400
+        updates["preferences.web_answer_cache"] = data['web_answer_cache']
+    if not updates:
+        return jsonify({"msg": "No preferences to update"}), 400
+
+    result = mongo.db.users.update_one({"_id": ObjectId(user_id)}, {"$set": updates})
+    if result.matched_count == 0:
+        return jsonify({"success": False, "message": "User not found"}), 404
+    return jsonify({"success": True, "data": {key.split(".", 1)[1]: value for key, value in updates.items()}}), 200
+
 @app.route('/scan', methods=['POST'])
 def scan_website():
     try:
@@ -1996,15 +2464,53 @@ def scan_website():
     except Exception as e:
         return jsonify({"message": f"Scan failed: {str(e)}"}), 500
 
-# --- Health Check Route ---
+# --- Health Check Routes ---
+# Liveness: the process is up and serving requests (dependencies may still be warming up)
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({
         "status": "healthy",
         "message": "Moktashif Backend API is running",
+        "ready": resources.ready(),
+        "timestamp": datetime.utcnow().isoformat() + "Z"
+    }), 200
+
+# Readiness: every required dependency is initialized, so the instance can take traffic
+@app.route('/health/ready', methods=['GET'])
+def readiness_check():
+    ready = resources.ready()
+    return jsonify({
+        "status": "ready" if ready else "starting",
+        "resources": resources.status(),
+        "startup": resources.startup_report(),
+        "timestamp": datetime.utcnow().isoformat() + "Z"
+    }), 200 if ready else 503
+
+# Unless a standalone worker is used, process jobs in this process.
+# Started last so every @task handler above is registered first.
+if os.getenv("JOB_WORKER_INLINE", "1") != "0":
+    start_worker_threads(job_queue)
+
+# --- Metrics Route ---
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify({
+        "llm": llm_client.metrics.snapshot(),
+        "document_cache": document_cache.stats(),
+        "embeddings": embedding_service.stats(),
+        "web_answer_cache": web_answer_cache.stats(),
+        "intent_classifiers": {classifier.name: classifier.stats() for classifier in intent_classifiers},
+        "startup": resources.startup_report(),
         "timestamp": datetime.utcnow().isoformat() + "Z"
     }), 200
 
+resources.mark("routes")
+print(f"[STARTUP] Module loaded in {time.perf_counter() - STARTUP_BEGIN:.2f}s: {resources.phases}")
+
+# Initialize dependencies in the background while the server starts listening
+if os.getenv("RESOURCE_WARMUP", "1") != "0":
+    resources.warm_up()
+
 if __name__ == '__main__':
     import sys
     import time
@@ -2023,5 +2529,6 @@ if __name__ == '__main__':
         print(f"\n=== Application started in {time.time() - start_time:.2f} seconds ===\n")
     else:
         print("\n=== Starting Flask app in debug mode (slower startup, auto-reload enabled) ===")
-        print("=== For faster startup, use: python chat.py --no-debug ===\n")
+        print("=== For faster startup, use: python chat.py --no-debug ===")
+        print("=== For production (concurrent streaming), use: python serve.py ===\n")
         app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
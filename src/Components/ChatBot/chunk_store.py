@@ -0,0 +1,172 @@
+import os
+import re
+import sys
+import mmap
+import struct
+
+# Packed chunk store: one file per document instead of one file per chunk.
+#
+# Layout (little-endian):
+#   magic      8 bytes   b"MKCHUNK1"
+#   count      uint32    number of chunks
+#   offsets    (count + 1) x uint64, byte offsets of each chunk in the data section
+#   data       UTF-8 text of all chunks joined with "\n"
+#
+# Chunk i is data[offsets[i]:offsets[i + 1] - 1] (the separator is dropped,
+# except after the last chunk), so the data section is exactly the whole
+# document and can be decoded in one go from the memory map.
+MAGIC = b"MKCHUNK1"
+_COUNT = struct.Struct("<I")
+_OFFSET = struct.Struct("<Q")
+SEPARATOR = b"\n"
+
+_LEGACY_CHUNK_RE = re.compile(r"^(?P<file_id>.+)_context_(?P<idx>\d+)\.txt$")
+
+
+def chunk_store_path(upload_dir, file_id):
+    return os.path.join(upload_dir, f"{file_id}_chunks.bin")
+
+
+def write_chunk_store(path, chunks):
+    """
+    Write chunks to a packed chunk store. The file is written next to its
+    final path and renamed into place, so readers never see a partial file.
+    """
+    encoded = [chunk.encode("utf-8") for chunk in chunks]
+    offsets = [0]
+    for idx, data in enumerate(encoded):
+        offsets.append(offsets[-1] + len(data) + (len(SEPARATOR) if idx < len(encoded) - 1 else 0))
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(_COUNT.pack(len(encoded)))
+        f.write(b"".join(_OFFSET.pack(offset) for offset in offsets))
+        f.write(SEPARATOR.join(encoded))
+    os.replace(tmp_path, path)
+
+
+class ChunkStore:
+    """
+    Read-only, memory-mapped view of a packed chunk store.
+
+    - chunk(i) reads a single chunk without touching the others
+    - text() decodes the whole document straight from the mapping
+    Use as a context manager (or call close()) to release the mapping.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        if self._mm[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a chunk store")
+        (self.count,) = _COUNT.unpack_from(self._mm, len(MAGIC))
+        self._offsets_start = len(MAGIC) + _COUNT.size
+        self._data_start = self._offsets_start + (self.count + 1) * _OFFSET.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+    def _offset(self, idx):
+        return _OFFSET.unpack_from(self._mm, self._offsets_start + idx * _OFFSET.size)[0]
+
+    def _decode(self, start, end):
+        view = memoryview(self._mm)[self._data_start + start:self._data_start + end]
+        try:
+            return str(view, "utf-8")
+        finally:
+            view.release()
+
+    def chunk(self, idx):
+        if not 0 <= idx < self.count:
+            raise IndexError(idx)
+        start, end = self._offset(idx), self._offset(idx + 1)
+        if idx < self.count - 1:
+            end -= len(SEPARATOR)
+        return self._decode(start, end)
+
+    def chunks(self):
+        return [self.chunk(idx) for idx in range(self.count)]
+
+    def text(self):
+        return self._decode(0, self._offset(self.count))
+
+
+def read_chunk_store_text(path):
+    """
+    Returns: the whole document stored at path, or None if there is no chunk store there.
+    """
+    if not os.path.exists(path):
+        return None
+    with ChunkStore(path) as store:
+        return store.text()
+
+
+def convert_chunk_files(upload_dir, remove_old=False):
+    """
+    Pack every document stored as per-chunk {file_id}_context_{idx}.txt files
+    into a single {file_id}_chunks.bin. Documents that already have a chunk
+    store are skipped, so this is safe to re-run.
+    Returns: dict with counts of converted documents and removed chunk files.
+    """
+    stats = {"converted": 0, "skipped": 0, "removed": 0}
+    if not os.path.exists(upload_dir):
+        return stats
+
+    documents = {}
+    for filename in os.listdir(upload_dir):
+        match = _LEGACY_CHUNK_RE.match(filename)
+        if match:
+            documents.setdefault(match.group("file_id"), set()).add(int(match.group("idx")))
+
+    for file_id, indexes in documents.items():
+        # Only contiguous chunks from 0 are part of the document (same as the old reader)
+        count = 0
+        while count in indexes:
+            count += 1
+        chunk_paths = [os.path.join(upload_dir, f"{file_id}_context_{idx}.txt") for idx in range(count)]
+
+        path = chunk_store_path(upload_dir, file_id)
+        if os.path.exists(path):
+            stats["skipped"] += 1
+        else:
+            chunks = []
+            for chunk_path in chunk_paths:
+                with open(chunk_path, "r", encoding="utf-8") as f:
+                    chunks.append(f.read())
+            write_chunk_store(path, chunks)
+            stats["converted"] += 1
+
+        if remove_old:
+            for chunk_path in chunk_paths:
+                os.remove(chunk_path)
+                stats["removed"] += 1
+
+    return stats
+
+
+if __name__ == '__main__':
+    # Usage: python chunk_store.py convert [uploads_dir] [--remove-old]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if not args or args[0] != "convert":
+        print("Usage: python chunk_store.py convert [uploads_dir] [--remove-old]")
+        sys.exit(1)
+
+    upload_dir = args[1] if len(args) > 1 else os.path.join(os.path.dirname(__file__), 'uploads')
+    result = convert_chunk_files(upload_dir, remove_old="--remove-old" in sys.argv)
+    print(f"Converted {result['converted']} documents ({result['skipped']} already packed, {result['removed']} chunk files removed)")
@@ -0,0 +1,453 @@
+import os
+import re
+import sys
+import json
+import math
+import base64
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import MongoClient, ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+# Fields that only exist for storage/indexing and are never returned to the client
+_MESSAGE_INTERNAL_FIELDS = ("_id", "user_id", "conversation_id", "seq", "terms")
+
+_CONVERSATION_FIELDS = {"title": 1, "created_at": 1, "updated_at": 1, "message_count": 1}
+
+# --- Search: every message/title stores its distinct lowercased words ("terms"),
+# indexed together with user_id, so a query is an index lookup instead of a scan ---
+_TERM_RE = re.compile(r"\w+")
+MAX_TERM_LENGTH = 40
+MAX_MATCHES_PER_CONVERSATION = 50
+# Shorter query words only match whole words: a 1-2 letter prefix matches most of the index
+MIN_PREFIX_LENGTH = int(os.getenv("SEARCH_MIN_PREFIX_LENGTH", "3"))
+# Matching messages counted per search (bounds the work for very common words)
+MAX_MATCHED_MESSAGES = int(os.getenv("SEARCH_MAX_MATCHED_MESSAGES", "5000"))
+SNIPPET_RADIUS = 30
+
+
+def _utc_now():
+    return datetime.utcnow().isoformat() + "Z"
+
+
+def search_terms(text):
+    """Distinct lowercased words of text, as stored in the search index."""
+    return sorted({term[:MAX_TERM_LENGTH] for term in _TERM_RE.findall((text or "").lower())})
+
+
+def _terms_filter(field, terms):
+    # Every query word has to be the start of an indexed word, so partial words match while typing
+    return {"$and": [
+        {field: {"$regex": "^" + re.escape(term)}} if len(term) >= MIN_PREFIX_LENGTH else {field: term}
+        for term in terms
+    ]}
+
+
+def make_snippet(content, terms, radius=SNIPPET_RADIUS):
+    """
+    Cut the part of content around the first occurrence of any query term.
+    """
+    lowered = content.lower()
+    positions = [pos for pos in (lowered.find(term) for term in terms) if pos >= 0]
+    if len(content) <= 80 or not positions:
+        return content[:80] + ('...' if len(content) > 80 else '')
+    pos = min(positions)
+    start = max(0, pos - radius)
+    end = min(len(content), pos + radius + max(len(term) for term in terms))
+    snippet = content[start:end]
+    if start > 0:
+        snippet = '...' + snippet
+    if end < len(content):
+        snippet = snippet + '...'
+    return snippet
+
+
+def encode_cursor(updated_at, conversation_id):
+    return base64.urlsafe_b64encode(json.dumps([updated_at, conversation_id]).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """
+    Returns: (updated_at, conversation_id) of the last item of the previous page.
+    Raises ValueError if the cursor is malformed.
+    """
+    try:
+        updated_at, conversation_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {e}")
+    return updated_at, conversation_id
+
+
+def _recency_weight(updated_at, now):
+    """1.0 for a conversation active now, 0.5 after 30 days, 0.25 after 90 days, ..."""
+    try:
+        age_days = (now - datetime.fromisoformat(updated_at.rstrip("Z"))).total_seconds() / 86400
+    except (AttributeError, TypeError, ValueError):
+        return 0.1
+    return 1.0 / (1.0 + max(age_days, 0.0) / 30.0)
+
+
+class ConversationStore:
+    """
+    Conversations and their messages, stored in two dedicated collections
+    instead of an embedded array on the users document.
+
+    conversations: {_id: <conversation id>, user_id, title, created_at, updated_at, message_count}
+    messages:      {user_id, conversation_id, seq, role, content, ...message fields}
+
+    A message's `seq` is its index in the conversation, so message indexes used
+    by the frontend (edit, replyTo, matchIndexes) keep their meaning.
+    """
+
+    def __init__(self, db, conversations_collection="conversations", messages_collection="messages"):
+        self.db = db
+        self.conversations = db[conversations_collection]
+        self.messages = db[messages_collection]
+
+    def ensure_indexes(self):
+        self.conversations.create_index([("user_id", ASCENDING), ("updated_at", DESCENDING), ("_id", DESCENDING)])
+        self.conversations.create_index([("user_id", ASCENDING), ("title_terms", ASCENDING)])
+        self.messages.create_index(
+            [("user_id", ASCENDING), ("conversation_id", ASCENDING), ("seq", ASCENDING)],
+            unique=True
+        )
+        self.messages.create_index([("user_id", ASCENDING), ("terms", ASCENDING)])
+
+    # --- Helpers ---
+    @staticmethod
+    def _public_conversation(doc):
+        return {
+            "id": doc["_id"],
+            "title": doc.get("title", "New Conversation"),
+            "created_at": doc.get("created_at"),
+            "updated_at": doc.get("updated_at"),
+            "message_count": doc.get("message_count", 0)
+        }
+
+    @staticmethod
+    def _public_message(doc):
+        return {k: v for k, v in doc.items() if k not in _MESSAGE_INTERNAL_FIELDS}
+
+    # --- Conversations ---
+    def create_conversation(self, user_id, title="New Conversation"):
+        current_time = _utc_now()
+        doc = {
+            "_id": str(ObjectId()),
+            "user_id": user_id,
+            "title": title,
+            "title_terms": search_terms(title),
+            "created_at": current_time,
+            "updated_at": current_time,
+            "message_count": 0
+        }
+        self.conversations.insert_one(doc)
+        conversation = self._public_conversation(doc)
+        conversation["messages"] = []
+        return conversation
+
+    def list_conversations(self, user_id, limit=None, cursor=None):
+        """
+        List conversation metadata (never message bodies), most recently updated first.
+        With a limit, pages are walked with the opaque cursor returned for the previous page.
+        Returns: (conversations, cursor of the next page or None)
+        """
+        query = {"user_id": user_id}
+        if cursor:
+            updated_at, conversation_id = decode_cursor(cursor)
+            query["$or"] = [
+                {"updated_at": {"$lt": updated_at}},
+                {"updated_at": updated_at, "_id": {"$lt": conversation_id}}
+            ]
+        docs = self.conversations.find(query, _CONVERSATION_FIELDS).sort([("updated_at", DESCENDING), ("_id", DESCENDING)])
+        if limit is None:
+            return [self._public_conversation(doc) for doc in docs], None
+
+        # One extra document tells whether there is a next page
+        docs = list(docs.limit(limit + 1))
+        next_cursor = None
+        if len(docs) > limit:
+            docs = docs[:limit]
+            next_cursor = encode_cursor(docs[-1].get("updated_at"), docs[-1]["_id"])
+        return [self._public_conversation(doc) for doc in docs], next_cursor
+
+    def get_conversation(self, user_id, conversation_id, include_messages=True):
+        doc = self.conversations.find_one({"_id": conversation_id, "user_id": user_id}, _CONVERSATION_FIELDS)
+        if not doc:
+            return None
+        conversation = self._public_conversation(doc)
+        if include_messages:
+            conversation["messages"] = self.get_messages(user_id, conversation_id)
+        return conversation
+
+    def get_conversations(self, user_id, conversation_ids):
+        """
+        Returns: {conversation id: conversation (without messages)} for the ids that exist.
+        """
+        cursor = self.conversations.find({"_id": {"$in": list(conversation_ids)}, "user_id": user_id}, _CONVERSATION_FIELDS)
+        return {doc["_id"]: self._public_conversation(doc) for doc in cursor}
+
+    def title_exists(self, user_id, title, exclude_id=None):
+        query = {"user_id": user_id, "title": title}
+        if exclude_id:
+            query["_id"] = {"$ne": exclude_id}
+        return self.conversations.count_documents(query, limit=1) > 0
+
+    def rename_conversation(self, user_id, conversation_id, title):
+        result = self.conversations.update_one(
+            {"_id": conversation_id, "user_id": user_id},
+            {"$set": {"title": title, "title_terms": search_terms(title)}, "$max": {"updated_at": _utc_now()}}
+        )
+        return result.matched_count > 0
+
+    def delete_conversation(self, user_id, conversation_id):
+        self.conversations.delete_one({"_id": conversation_id, "user_id": user_id})
+        self.messages.delete_many({"user_id": user_id, "conversation_id": conversation_id})
+
+    # --- Messages ---
+    def get_messages(self, user_id, conversation_id):
+        cursor = self.messages.find(
+            {"user_id": user_id, "conversation_id": conversation_id}, {"terms": 0}
+        ).sort("seq", ASCENDING)
+        return [self._public_message(doc) for doc in cursor]
+
+    def get_message(self, user_id, conversation_id, seq):
+        doc = self.messages.find_one({"user_id": user_id, "conversation_id": conversation_id, "seq": seq}, {"terms": 0})
+        return self._public_message(doc) if doc else None
+
+    def append_message(self, user_id, conversation_id, message, updated_at=None):
+        """
+        Append one message to a conversation with a single insert_one.
+        The seq is reserved with an atomic $inc, so two tabs sending at the same
+        time each get their own slot instead of overwriting one another.
+        Returns: the message's seq (its index in the conversation), or None if the conversation does not exist.
+        """
+        conv = self.conversations.find_one_and_update(
+            {"_id": conversation_id, "user_id": user_id},
+            # $max keeps turns that finish out of order from rolling updated_at back
+            {"$inc": {"message_count": 1}, "$max": {"updated_at": updated_at or _utc_now()}},
+            projection={"message_count": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if not conv:
+            return None
+        seq = conv["message_count"] - 1
+        doc = dict(message)
+        doc.update({
+            "user_id": user_id,
+            "conversation_id": conversation_id,
+            "seq": seq,
+            "terms": search_terms(message.get("content", ""))
+        })
+        self.messages.insert_one(doc)
+        return seq
+
+    def update_message(self, user_id, conversation_id, seq, fields, push_version=None, expected_content=None):
+        """
+        Set fields on a single message, optionally pushing the previous content onto its `versions` list.
+        If expected_content is given the update only applies while the stored content still matches,
+        so a concurrent edit from another tab is detected instead of silently overwritten.
+        Returns: True if the message was updated.
+        """
+        query = {"user_id": user_id, "conversation_id": conversation_id, "seq": seq}
+        if expected_content is not None:
+            query["content"] = expected_content
+        if "content" in fields:
+            fields = {**fields, "terms": search_terms(fields["content"])}
+        update = {"$set": fields}
+        if push_version is not None:
+            update["$push"] = {"versions": push_version}
+        result = self.messages.update_one(query, update)
+        return result.matched_count > 0
+
+    # --- Search ---
+    def search(self, user_id, query, limit=20, offset=0):
+        """
+        Find the user's conversations whose title or messages contain every word of query
+        (words of at least MIN_PREFIX_LENGTH characters may be partial). Conversations are ranked by how well they match
+        (title match, number of matching messages) weighted by how recently they were active.
+        Returns: (one page of results, total number of matching conversations)
+        """
+        terms = search_terms(query)
+        if not terms:
+            return [], 0
+
+        title_hits = {
+            doc["_id"]: doc
+            for doc in self.conversations.find({"user_id": user_id, **_terms_filter("title_terms", terms)}, _CONVERSATION_FIELDS)
+        }
+        message_filter = {"user_id": user_id, **_terms_filter("terms", terms)}
+        message_hits = {
+            group["_id"]: group
+            for group in self.messages.aggregate([
+                {"$match": message_filter},
+                {"$limit": MAX_MATCHED_MESSAGES},
+                {"$group": {"_id": "$conversation_id", "count": {"$sum": 1}}}
+            ])
+        }
+
+        conversations = dict(title_hits)
+        missing = [cid for cid in message_hits if cid not in conversations]
+        if missing:
+            for doc in self.conversations.find({"_id": {"$in": missing}, "user_id": user_id}, _CONVERSATION_FIELDS):
+                conversations[doc["_id"]] = doc
+
+        now = datetime.utcnow()
+        ranked = []
+        for cid, conv in conversations.items():
+            match_count = message_hits[cid]["count"] if cid in message_hits else 0
+            relevance = (2.0 if cid in title_hits else 0.0) + math.log1p(match_count)
+            ranked.append((relevance * _recency_weight(conv.get("updated_at"), now), conv.get("updated_at") or "", cid))
+        ranked.sort(reverse=True)
+        page = [cid for _, _, cid in ranked[offset:offset + limit]]
+
+        # Message text is only read for the conversations on this page
+        matched_messages = {}
+        page_message_ids = [cid for cid in page if cid in message_hits]
+        if page_message_ids:
+            cursor = self.messages.find(
+                {**message_filter, "conversation_id": {"$in": page_message_ids}},
+                {"conversation_id": 1, "seq": 1, "content": 1}
+            ).sort([("conversation_id", ASCENDING), ("seq", ASCENDING)])
+            for doc in cursor:
+                found = matched_messages.setdefault(doc["conversation_id"], [])
+                if len(found) < MAX_MATCHES_PER_CONVERSATION:
+                    found.append(doc)
+
+        results = []
+        for cid in page:
+            conv = conversations[cid]
+            found = matched_messages.get(cid, [])
+            matches = [make_snippet(doc.get("content", ""), terms) for doc in found]
+            is_title_match = cid in title_hits
+            results.append({
+                "id": cid,
+                "title": conv.get("title", "New Conversation"),
+                "match_type": "title" if is_title_match else "message",
+                "snippet": None if is_title_match else (matches[0] if matches else None),
+                "created_at": conv.get("created_at"),
+                "updated_at": conv.get("updated_at"),
+                "matches": matches,
+                "matchIndexes": [doc["seq"] for doc in found]
+            })
+        return results, len(ranked)
+
+    def truncate_messages(self, user_id, conversation_id, keep):
+        """
+        Drop every message with seq >= keep and reset the conversation's message count.
+        """
+        self.messages.delete_many({"user_id": user_id, "conversation_id": conversation_id, "seq": {"$gte": keep}})
+        self.conversations.update_one(
+            {"_id": conversation_id, "user_id": user_id},
+            {"$set": {"message_count": keep}, "$max": {"updated_at": _utc_now()}}
+        )
+
+
+# --- One-shot migration from users.conversations ---
+def migrate_embedded_conversations(db, drop_embedded=False):
+    """
+    Copy every conversation embedded in `users.conversations` into the
+    conversations/messages collections. Safe to re-run: conversations and
+    messages that already exist are skipped. With drop_embedded, a user's
+    embedded conversations are only removed once all of them were copied.
+    Returns: dict with counts of migrated users, conversations and messages,
+             and the ids of the users some messages failed to copy for.
+    """
+    store = ConversationStore(db)
+    store.ensure_indexes()
+    stats = {"users": 0, "conversations": 0, "messages": 0, "incomplete_users": []}
+
+    for user in db.users.find({"conversations": {"$exists": True}}, {"conversations": 1}):
+        user_id = str(user["_id"])
+        complete = True
+        for conv in user.get("conversations", []):
+            messages = conv.get("messages", [])
+            try:
+                store.conversations.insert_one({
+                    "_id": conv["id"],
+                    "user_id": user_id,
+                    "title": conv.get("title", "New Conversation"),
+                    "title_terms": search_terms(conv.get("title", "New Conversation")),
+                    "created_at": conv.get("created_at"),
+                    "updated_at": conv.get("updated_at"),
+                    "message_count": len(messages)
+                })
+                stats["conversations"] += 1
+            except DuplicateKeyError:
+                pass
+
+            if messages:
+                docs = [
+                    {**msg, "user_id": user_id, "conversation_id": conv["id"], "seq": seq,
+                     "terms": search_terms(msg.get("content", ""))}
+                    for seq, msg in enumerate(messages)
+                ]
+                try:
+                    result = store.messages.insert_many(docs, ordered=False)
+                    stats["messages"] += len(result.inserted_ids)
+                except BulkWriteError as e:
+                    stats["messages"] += e.details.get("nInserted", 0)
+                    # Duplicate keys are messages copied by an earlier run; anything else was not copied
+                    errors = [err for err in e.details.get("writeErrors", []) if err.get("code") != 11000]
+                    if errors:
+                        complete = False
+                        print(f"Failed to copy {len(errors)} messages of conversation {conv['id']} "
+                              f"(user {user_id}): {errors[0].get('errmsg')}", file=sys.stderr)
+
+        if not complete:
+            stats["incomplete_users"].append(user_id)
+            continue
+        if drop_embedded:
+            db.users.update_one({"_id": user["_id"]}, {"$unset": {"conversations": ""}})
+        stats["users"] += 1
+
+    return stats
+
+
+# --- Backfill of the search terms for data written before search indexing ---
+def index_search_terms(db, batch_size=500):
+    """
+    Add search terms to every conversation and message that doesn't have them yet.
+    Safe to re-run.
+    Returns: dict with counts of indexed conversations and messages.
+    """
+    store = ConversationStore(db)
+    store.ensure_indexes()
+    stats = {"conversations": 0, "messages": 0}
+
+    for collection, field, source, key in (
+        (store.conversations, "title_terms", "title", "conversations"),
+        (store.messages, "terms", "content", "messages")
+    ):
+        ops = []
+        for doc in collection.find({field: {"$exists": False}}, {source: 1}):
+            ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {field: search_terms(doc.get(source, ""))}}))
+            if len(ops) >= batch_size:
+                collection.bulk_write(ops, ordered=False)
+                stats[key] += len(ops)
+                ops = []
+        if ops:
+            collection.bulk_write(ops, ordered=False)
+            stats[key] += len(ops)
+
+    return stats
+
+
+if __name__ == '__main__':
+    # Usage: python conversation_store.py migrate [--drop-embedded]
+    #        python conversation_store.py index-search
+    if len(sys.argv) < 2 or sys.argv[1] not in ("migrate", "index-search"):
+        print("Usage: python conversation_store.py migrate [--drop-embedded] | index-search")
+        sys.exit(1)
+
+    mongo_uri = os.getenv("MONGO_URI", "mongodb://localhost:27017/Moktashef-DEV")
+    client = MongoClient(mongo_uri)
+    if sys.argv[1] == "index-search":
+        result = index_search_terms(client.get_default_database())
+        print(f"Indexed {result['conversations']} conversation titles and {result['messages']} messages for search")
+        sys.exit(0)
+    result = migrate_embedded_conversations(client.get_default_database(), drop_embedded="--drop-embedded" in sys.argv)
+    print(f"Migrated {result['conversations']} conversations and {result['messages']} messages for {result['users']} users")
+    if result["incomplete_users"]:
+        print(f"Not fully migrated (embedded conversations kept, re-run to retry): {', '.join(result['incomplete_users'])}")
+        sys.exit(1)
@@ -0,0 +1,83 @@
+import sys
+import threading
+from collections import OrderedDict
+
+
+def estimate_size(obj):
+    """
+    Rough in-memory size of a cached value (strings, numbers, lists and dicts), in bytes.
+    """
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(estimate_size(k) + estimate_size(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(estimate_size(item) for item in obj)
+    return sys.getsizeof(obj)
+
+
+class DocumentCache:
+    """
+    Thread-safe LRU cache of loaded documents, bounded by total size in bytes.
+
+    Entries are stored with a version (e.g. the mtime of the stored chunks);
+    a lookup with a different version is a miss and drops the stale entry, so
+    re-uploaded or deleted documents are never served from the cache, even
+    when they were rewritten by another process.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (version, value, size)
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, version=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, version=None):
+        size = estimate_size(value)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if size > self.max_bytes:
+                # Caching it would evict everything else
+                return
+            self._entries[key] = (version, value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self.current_bytes -= size
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0,
+                "evictions": self.evictions
+            }
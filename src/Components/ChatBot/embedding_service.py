@@ -0,0 +1,188 @@
+import os
+import math
+import time
+import queue
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+def normalize_text(text):
+    """Collapse whitespace and lowercase (the MiniLM tokenizer is uncased) so equivalent queries share a cache entry."""
+    return " ".join(text.split()).lower()
+
+
+def cosine_similarity(a, b):
+    """Cosine similarity of two embeddings (lists of floats); 0.0 if either is all zeros."""
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class EmbeddingService:
+    """
+    One sentence-transformer model shared by every thread in the process.
+
+    - embed_query() goes through an LRU cache keyed by the hash of the
+      normalized text, and cache misses from concurrent requests are
+      micro-batched: the first one waits up to batch_window_ms for others so
+      they are encoded in a single forward pass
+    - encode_documents() encodes a known list of texts (e.g. file chunks) in
+      batches directly
+    The model is loaded on first use.
+    """
+
+    def __init__(self, model_name, batch_window_ms=5, max_batch_size=64, cache_size=4096):
+        self.model_name = model_name
+        self.batch_window = batch_window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self.cache_size = cache_size
+
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._encode_lock = threading.Lock()
+
+        self._pending = queue.Queue()
+        self._batcher = None
+        self._batcher_lock = threading.Lock()
+
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.batches = 0
+        self.batched_queries = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            model_name=os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2"),
+            batch_window_ms=float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "5")),
+            max_batch_size=int(os.getenv("EMBEDDING_MAX_BATCH", "64")),
+            cache_size=int(os.getenv("EMBEDDING_QUERY_CACHE_SIZE", "4096"))
+        )
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    from sentence_transformers import SentenceTransformer
+                    start = time.perf_counter()
+                    self._model = SentenceTransformer(self.model_name)
+                    print(f"[EMBED] Loaded {self.model_name} in {time.perf_counter() - start:.1f}s")
+        return self._model
+
+    def _encode(self, texts, batch_size=32):
+        # The lock is taken per batch, so query micro-batches get in between the batches of a large document
+        model = self.model
+        embeddings = []
+        for start in range(0, len(texts), batch_size):
+            with self._encode_lock:
+                embeddings.extend(model.encode(texts[start:start + batch_size], batch_size=batch_size).tolist())
+        return embeddings
+
+    def encode_documents(self, texts, batch_size=32):
+        """
+        Embed a list of texts (not cached).
+        Returns: one embedding (list of floats) per text.
+        """
+        if not texts:
+            return []
+        return self._encode(texts, batch_size=batch_size)
+
+    # --- Query embeddings: cache + micro-batching ---
+    def _cache_get(self, key):
+        with self._cache_lock:
+            embedding = self._cache.get(key)
+            if embedding is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return embedding
+
+    def _cache_put(self, key, embedding):
+        with self._cache_lock:
+            self._cache[key] = embedding
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def embed_query(self, text):
+        normalized = normalize_text(text)
+        key = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+        embedding = self._cache_get(key)
+        if embedding is not None:
+            return embedding
+
+        future = Future()
+        self._ensure_batcher()
+        self._pending.put((normalized, future))
+        embedding = future.result()
+        self._cache_put(key, embedding)
+        return embedding
+
+    def embed_many(self, texts):
+        """
+        Embed a list of short texts through the query cache: only the misses
+        are encoded, in a single batch.
+        Returns: one embedding per text.
+        """
+        normalized = [normalize_text(text) for text in texts]
+        keys = [hashlib.sha256(text.encode("utf-8")).hexdigest() for text in normalized]
+        embeddings = [self._cache_get(key) for key in keys]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            encoded = self._encode([normalized[i] for i in missing], batch_size=len(missing))
+            for i, embedding in zip(missing, encoded):
+                embeddings[i] = embedding
+                self._cache_put(keys[i], embedding)
+        return embeddings
+
+    def _ensure_batcher(self):
+        if self._batcher is None:
+            with self._batcher_lock:
+                if self._batcher is None:
+                    self._batcher = threading.Thread(target=self._run_batcher, name="embedding-batcher", daemon=True)
+                    self._batcher.start()
+
+    def _run_batcher(self):
+        while True:
+            batch = [self._pending.get()]
+            deadline = time.perf_counter() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            texts = [text for text, _ in batch]
+            try:
+                embeddings = self._encode(texts, batch_size=len(texts))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.batched_queries += len(batch)
+            for (_, future), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
+
+    def stats(self):
+        with self._cache_lock:
+            lookups = self.hits + self.misses
+            return {
+                "model": self.model_name,
+                "loaded": self._model is not None,
+                "query_cache_entries": len(self._cache),
+                "query_cache_hits": self.hits,
+                "query_cache_misses": self.misses,
+                "query_cache_hit_rate": round(self.hits / lookups, 3) if lookups else 0,
+                "batches": self.batches,
+                "avg_batch_size": round(self.batched_queries / self.batches, 2) if self.batches else 0
+            }
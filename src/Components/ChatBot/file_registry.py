@@ -0,0 +1,106 @@
+import os
+import sys
+import json
+
+from pymongo import MongoClient, ASCENDING, DESCENDING
+
+# Fields returned to the client for each uploaded file
+_PUBLIC_FIELDS = {"_id": 1, "original_filename": 1, "upload_time": 1, "conversation_id": 1, "filetype": 1}
+
+
+class FileRegistry:
+    """
+    Index of uploaded files, one document per file_id, stored in Mongo.
+
+    Replaces scanning the uploads directory and parsing every *_metadata.json
+    to find a user's (or a conversation's) files: those lookups are single
+    indexed queries on (user_id, conversation_id, upload_time).
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def ensure_indexes(self):
+        self.collection.create_index([("user_id", ASCENDING), ("conversation_id", ASCENDING), ("upload_time", DESCENDING)])
+        self.collection.create_index([("user_id", ASCENDING), ("upload_time", DESCENDING)])
+
+    @staticmethod
+    def _public_file(doc):
+        return {
+            "file_id": doc["_id"],
+            "filename": doc.get("original_filename", "Unknown"),
+            "upload_time": doc.get("upload_time", ""),
+            "conversation_id": doc.get("conversation_id", ""),
+            "filetype": doc.get("filetype", "")
+        }
+
+    def register(self, file_id, metadata):
+        self.collection.update_one({"_id": file_id}, {"$set": metadata}, upsert=True)
+
+    def get(self, file_id):
+        """
+        Returns: the file's metadata (as written at upload time), or None.
+        """
+        doc = self.collection.find_one({"_id": file_id})
+        if doc:
+            doc.pop("_id")
+        return doc
+
+    def list_user_files(self, user_id):
+        cursor = self.collection.find({"user_id": user_id}, _PUBLIC_FIELDS).sort("upload_time", DESCENDING)
+        return [self._public_file(doc) for doc in cursor]
+
+    def list_conversation_files(self, user_id, conversation_id):
+        cursor = self.collection.find(
+            {"user_id": user_id, "conversation_id": conversation_id}, _PUBLIC_FIELDS
+        ).sort("upload_time", DESCENDING)
+        return [self._public_file(doc) for doc in cursor]
+
+    def latest_conversation_file(self, user_id, conversation_id):
+        doc = self.collection.find_one(
+            {"user_id": user_id, "conversation_id": conversation_id},
+            _PUBLIC_FIELDS,
+            sort=[("upload_time", DESCENDING)]
+        )
+        return self._public_file(doc) if doc else None
+
+
+def import_metadata_files(registry, upload_dir):
+    """
+    Backfill the registry from the *_metadata.json files in the uploads
+    directory. Safe to re-run: existing entries are overwritten with the
+    same metadata.
+    Returns: dict with counts of imported and unreadable files.
+    """
+    registry.ensure_indexes()
+    stats = {"imported": 0, "errors": 0}
+    if not os.path.exists(upload_dir):
+        return stats
+
+    for filename in os.listdir(upload_dir):
+        if not filename.endswith("_metadata.json"):
+            continue
+        try:
+            with open(os.path.join(upload_dir, filename), 'r', encoding='utf-8') as f:
+                metadata = json.load(f)
+        except Exception as e:
+            print(f"Error loading metadata {filename}: {e}", file=sys.stderr)
+            stats["errors"] += 1
+            continue
+        registry.register(filename[:-len("_metadata.json")], metadata)
+        stats["imported"] += 1
+
+    return stats
+
+
+if __name__ == '__main__':
+    # Usage: python file_registry.py import [uploads_dir]
+    if len(sys.argv) < 2 or sys.argv[1] != "import":
+        print("Usage: python file_registry.py import [uploads_dir]")
+        sys.exit(1)
+
+    upload_dir = sys.argv[2] if len(sys.argv) > 2 else os.path.join(os.path.dirname(__file__), 'uploads')
+    mongo_uri = os.getenv("MONGO_URI", "mongodb://localhost:27017/Moktashef-DEV")
+    client = MongoClient(mongo_uri)
+    result = import_metadata_files(FileRegistry(client.get_default_database().files), upload_dir)
+    print(f"Imported {result['imported']} files ({result['errors']} unreadable metadata files skipped)")
@@ -0,0 +1,129 @@
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+
+# Stages of the upload pipeline, in the order they run
+INGESTION_STAGES = ["extract", "chunk", "embed", "index", "summarize"]
+
+
+def _utc_now():
+    return datetime.utcnow().isoformat() + "Z"
+
+
+class IngestionTracker:
+    """
+    Per-upload progress records for the background ingestion pipeline.
+
+    One document per upload job: overall status (queued, running, retrying,
+    done, failed) plus the status, timing and error of every stage, so the
+    client can poll /upload/status/<job_id>. "failed" is final: a job that
+    will be retried is "retrying", and a retry skips the stages already done.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def ensure_indexes(self):
+        self.collection.create_index([("user_id", ASCENDING), ("file_id", ASCENDING)])
+        self.collection.create_index([("file_id", ASCENDING), ("created_at", DESCENDING)])
+
+    def create(self, user_id, file_id, filename):
+        job_id = str(ObjectId())
+        now = _utc_now()
+        self.collection.insert_one({
+            "_id": job_id,
+            "user_id": user_id,
+            "file_id": file_id,
+            "filename": filename,
+            "status": "queued",
+            "stages": {name: {"status": "pending"} for name in INGESTION_STAGES},
+            "created_at": now,
+            "updated_at": now
+        })
+        return job_id
+
+    def get(self, job_id):
+        doc = self.collection.find_one({"_id": job_id})
+        if not doc:
+            return None
+        stages = doc.get("stages", {})
+        done = sum(1 for name in INGESTION_STAGES if stages.get(name, {}).get("status") == "done")
+        return {
+            "job_id": doc["_id"],
+            "user_id": doc["user_id"],
+            "file_id": doc["file_id"],
+            "filename": doc.get("filename"),
+            "status": doc["status"],
+            "error": doc.get("error"),
+            "progress": round(done / len(INGESTION_STAGES), 2),
+            "stages": [{"name": name, **stages.get(name, {"status": "pending"})} for name in INGESTION_STAGES],
+            "created_at": doc.get("created_at"),
+            "updated_at": doc.get("updated_at")
+        }
+
+    def find_by_file(self, file_id):
+        """
+        Returns: the latest ingest job of a file as {"job_id", "status", "error",
+        "chunked"}, or None for files uploaded before ingestion was tracked.
+        """
+        doc = self.collection.find_one(
+            {"file_id": file_id},
+            {"status": 1, "error": 1, "stages.chunk.status": 1},
+            sort=[("created_at", DESCENDING)]
+        )
+        if not doc:
+            return None
+        return {
+            "job_id": doc["_id"],
+            "status": doc["status"],
+            "error": doc.get("error"),
+            "chunked": doc.get("stages", {}).get("chunk", {}).get("status") == "done"
+        }
+
+    def start_attempt(self, job_id):
+        """
+        Count a run of the ingest job.
+        Returns: the attempt number (1 for the first run).
+        """
+        doc = self.collection.find_one_and_update(
+            {"_id": job_id},
+            {"$inc": {"attempts": 1}, "$set": {"status": "running", "updated_at": _utc_now()}},
+            projection={"attempts": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        return doc["attempts"] if doc else 1
+
+    def completed_stages(self, job_id):
+        doc = self.collection.find_one({"_id": job_id}, {"stages": 1}) or {}
+        return {name for name, stage in doc.get("stages", {}).items() if stage.get("status") == "done"}
+
+    def update(self, job_id, **fields):
+        fields["updated_at"] = _utc_now()
+        self.collection.update_one({"_id": job_id}, {"$set": fields})
+
+    @contextmanager
+    def stage(self, job_id, name):
+        """
+        Mark a stage running while the block executes, then done (or failed with the error).
+        """
+        start = time.perf_counter()
+        self.update(job_id, status="running", **{f"stages.{name}": {"status": "running", "started_at": _utc_now()}})
+        try:
+            yield
+        except Exception as e:
+            print(f"[INGEST] {job_id}: stage '{name}' failed: {e}", file=sys.stderr)
+            self.update(job_id, **{
+                f"stages.{name}.status": "failed",
+                f"stages.{name}.error": str(e),
+                f"stages.{name}.duration_ms": round((time.perf_counter() - start) * 1000)
+            })
+            raise
+        self.update(job_id, **{
+            f"stages.{name}.status": "done",
+            f"stages.{name}.finished_at": _utc_now(),
+            f"stages.{name}.duration_ms": round((time.perf_counter() - start) * 1000)
+        })
@@ -0,0 +1,249 @@
+import os
+import sys
+import threading
+from datetime import datetime
+
+from pymongo import MongoClient, DESCENDING
+from pymongo.write_concern import WriteConcern
+
+from embedding_service import cosine_similarity
+
+# Longest message text kept in a logged decision
+MAX_LOGGED_TEXT = 500
+# Logged decisions contain (the start of) users' messages; Mongo deletes them after this many days
+DECISION_TTL_DAYS = int(os.getenv("INTENT_DECISION_TTL_DAYS", "90"))
+
+# --- Seed examples per label. Decisions labelled by an LLM fallback are added to these at warm-up ---
+PERSONAL_FACT_EXAMPLES = {
+    "fact": [
+        "I work as a penetration tester at a bank",
+        "our company runs Ubuntu 22.04 servers with nginx",
+        "we use Splunk as our SIEM",
+        "I'm responsible for the security of a healthcare web app",
+        "my team deploys everything on AWS with Kubernetes",
+        "we are still on Windows Server 2012 in production",
+        "I'm studying for the OSCP",
+        "our backend is Django 3.2 with PostgreSQL",
+        "I manage the firewall rules for a small e-commerce business",
+        "we use CrowdStrike on all of our endpoints",
+    ],
+    "no_fact": [
+        "what is SQL injection?",
+        "how do I prevent cross-site scripting",
+        "explain the difference between symmetric and asymmetric encryption",
+        "can you give me an example of a CSRF attack",
+        "thanks, that helps",
+        "summarize this file",
+        "what does CVE-2021-44228 affect",
+        "how does a buffer overflow work",
+        "list the OWASP top 10",
+        "hello",
+        "can you explain that in more detail?",
+        "what are the best practices for password storage",
+    ],
+}
+
+WEB_SEARCH_EXAMPLES = {
+    "web": [
+        "what are the latest vulnerabilities in Chrome",
+        "is there a patch for CVE-2024-3094 yet",
+        "recent ransomware attacks this week",
+        "what is the newest version of OpenSSL",
+        "current threat landscape news",
+        "which companies were breached this month",
+        "has Microsoft released this month's Patch Tuesday",
+        "latest zero-day exploits being used in the wild",
+    ],
+    "no_web": [
+        "what is SQL injection?",
+        "explain how TLS handshakes work",
+        "how do I prevent cross-site scripting",
+        "what is the difference between hashing and encryption",
+        "how does a buffer overflow work",
+        "explain the principle of least privilege",
+        "thanks, that helps",
+        "write a regex to validate an email address",
+        "what is a man-in-the-middle attack",
+        "how should I store passwords securely",
+    ],
+}
+
+FILE_QUERY_EXAMPLES = {
+    "file": [
+        "summarize this file",
+        "what vulnerabilities are in the scan results",
+        "explain the findings in the report I uploaded",
+        "what does this document say about open ports",
+        "which issues in the scan are critical",
+        "analyze the uploaded file",
+        "what is the most severe finding in the report",
+        "read the attached document and tell me what to fix first",
+    ],
+    "general": [
+        "what is SQL injection?",
+        "explain cross-site scripting",
+        "how do I configure a firewall",
+        "what is a vulnerability scanner",
+        "explain the principle of least privilege",
+        "how do I report a vulnerability to a vendor",
+        "what is the content security policy header",
+        "hello",
+    ],
+}
+
+
+class IntentClassifier:
+    """
+    Nearest-prototype classifier over sentence embeddings.
+
+    A label's score is the mean cosine similarity of the text to its top_k
+    closest examples; the prediction is confident when the best label beats
+    the runner-up by at least min_margin. Callers fall back to the slower
+    decision (an LLM call, a heuristic) when it isn't, and log() the outcome:
+    with learn_from_log, decisions labelled by an LLM fallback become extra
+    examples on the next load_logged_examples(), so the classifier gets
+    confident on more messages as the log grows. Heuristic decisions are
+    logged for reporting only, never learned from.
+
+    Logged decisions keep the first MAX_LOGGED_TEXT characters of the
+    message and expire after DECISION_TTL_DAYS (a TTL index on created_at),
+    so learned examples only ever come from that window.
+    """
+
+    def __init__(self, name, examples, embedding_service, min_margin=0.06, top_k=3,
+                 decision_log=None, max_learned_per_label=200, learn_from_log=True):
+        self.name = name
+        self.examples = {label: list(texts) for label, texts in examples.items()}
+        self.embedding_service = embedding_service
+        self.min_margin = min_margin
+        self.top_k = top_k
+        # Unacknowledged writes: logging a decision never waits on Mongo
+        self.decision_log = decision_log.with_options(write_concern=WriteConcern(w=0)) if decision_log is not None else None
+        self._log_reader = decision_log
+        self.max_learned_per_label = max_learned_per_label
+        self.learn_from_log = learn_from_log
+        self._prototypes = None
+        self._lock = threading.Lock()
+        self.confident = 0
+        self.fallbacks = 0
+
+    def _load_prototypes(self):
+        if self._prototypes is None:
+            with self._lock:
+                if self._prototypes is None:
+                    self._prototypes = {
+                        label: self.embedding_service.encode_documents(texts)
+                        for label, texts in self.examples.items()
+                    }
+        return self._prototypes
+
+    def load_logged_examples(self):
+        """
+        Add the texts the LLM fallback labelled to the examples (most recent
+        first, at most max_learned_per_label per label) and rebuild the prototypes.
+        Returns: the number of examples added.
+        """
+        if self._log_reader is None or not self.learn_from_log:
+            return 0
+        added = 0
+        for label in self.examples:
+            seen = set(self.examples[label])
+            cursor = self._log_reader.find(
+                {"classifier": self.name, "source": "fallback", "label": label},
+                {"text": 1}
+            ).sort("created_at", DESCENDING).limit(self.max_learned_per_label)
+            for doc in cursor:
+                if doc["text"] not in seen:
+                    seen.add(doc["text"])
+                    self.examples[label].append(doc["text"])
+                    added += 1
+        with self._lock:
+            self._prototypes = None
+        self._load_prototypes()
+        return added
+
+    def ensure_indexes(self):
+        if self._log_reader is not None:
+            self._log_reader.create_index([("classifier", 1), ("source", 1), ("label", 1), ("created_at", DESCENDING)])
+            self._log_reader.create_index("created_at", expireAfterSeconds=DECISION_TTL_DAYS * 86400)
+
+    def predict(self, text):
+        """
+        Returns: (label, margin, confident). On any error (e.g. the model can't
+        load) the prediction is (None, 0.0, False) so the caller falls back.
+        """
+        try:
+            embedding = self.embedding_service.embed_query(text)
+            scores = {}
+            for label, vectors in self._load_prototypes().items():
+                similarities = sorted((cosine_similarity(embedding, v) for v in vectors), reverse=True)[:self.top_k]
+                scores[label] = sum(similarities) / len(similarities)
+        except Exception as e:
+            print(f"[INTENT] {self.name} prediction failed: {e}", file=sys.stderr)
+            self.fallbacks += 1
+            return None, 0.0, False
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        label, best = ranked[0]
+        margin = best - ranked[1][1] if len(ranked) > 1 else best
+        confident = margin >= self.min_margin
+        if confident:
+            self.confident += 1
+        else:
+            self.fallbacks += 1
+        return label, margin, confident
+
+    def log(self, text, label, source, margin=None):
+        """
+        Record a decision. source is "local" (this classifier), "fallback" (an LLM,
+        learned from) or "heuristic" (a rule such as a keyword check, not learned from).
+        """
+        print(f"[INTENT] {self.name}: {label} ({source}{f', margin {margin:.3f}' if margin is not None else ''})")
+        if self.decision_log is None:
+            return
+        try:
+            self.decision_log.insert_one({
+                "classifier": self.name,
+                "text": text[:MAX_LOGGED_TEXT],
+                "label": label,
+                "source": source,
+                "margin": margin,
+                "created_at": datetime.utcnow()
+            })
+        except Exception as e:
+            print(f"[INTENT] Failed to log decision: {e}", file=sys.stderr)
+
+    def stats(self):
+        decisions = self.confident + self.fallbacks
+        return {
+            "examples": {label: len(texts) for label, texts in self.examples.items()},
+            "confident": self.confident,
+            "fallbacks": self.fallbacks,
+            "local_rate": round(self.confident / decisions, 3) if decisions else 0
+        }
+
+
+def decision_report(collection):
+    """
+    Returns: {classifier: {source: {label: count}}} over the logged decisions.
+    """
+    report = {}
+    pipeline = [{"$group": {"_id": {"classifier": "$classifier", "source": "$source", "label": "$label"}, "count": {"$sum": 1}}}]
+    for row in collection.aggregate(pipeline):
+        key = row["_id"]
+        report.setdefault(key["classifier"], {}).setdefault(key["source"], {})[key["label"]] = row["count"]
+    return report
+
+
+if __name__ == '__main__':
+    # Usage: python intent_classifier.py report
+    if len(sys.argv) < 2 or sys.argv[1] != "report":
+        print("Usage: python intent_classifier.py report")
+        sys.exit(1)
+
+    mongo_uri = os.getenv("MONGO_URI", "mongodb://localhost:27017/Moktashef-DEV")
+    client = MongoClient(mongo_uri)
+    for classifier, sources in decision_report(client.get_default_database().intent_decisions).items():
+        print(classifier)
+        for source, labels in sources.items():
+            print(f"  {source}: " + ", ".join(f"{label}={count}" for label, count in sorted(labels.items())))
@@ -0,0 +1,257 @@
+import os
+import sys
+import time
+import random
+import socket
+import threading
+import traceback
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+# How long finished jobs are kept around (keeps idempotency keys meaningful for a while)
+FINISHED_JOB_TTL_SECONDS = int(os.getenv("JOB_FINISHED_TTL_SECONDS", str(7 * 24 * 3600)))
+
+# Queues: short per-message jobs run on "default"; uploads are chunked on "ingest", which
+# nothing slow shares, since chat waits for it; long jobs (whole-file summaries) go to "bulk"
+# so they never hold up everyone else's jobs; one-off backfills (jobs of any task, queued
+# with enqueue(..., queue=BACKFILL_QUEUE)) run on "backfill", behind nothing live
+DEFAULT_QUEUE = "default"
+INGEST_QUEUE = "ingest"
+BULK_QUEUE = "bulk"
+BACKFILL_QUEUE = "backfill"
+
+ABANDONED_ERROR = "Worker lost while running the last attempt"
+
+# --- Task registry ---
+TASKS = {}
+TASK_QUEUES = {}
+TASK_ABANDON_HOOKS = {}
+
+
+def task(name, queue=DEFAULT_QUEUE, on_abandoned=None):
+    """
+    Register a function as the handler for jobs of type `name`, run by workers of `queue`.
+    Handlers receive the job payload as keyword arguments. Jobs are delivered
+    at least once, so handlers must tolerate being re-run after a crash.
+    on_abandoned, if given, is called with the payload when a job is failed
+    because its worker died on the last attempt (the handler never got to
+    record the failure itself).
+    """
+    def decorator(fn):
+        TASKS[name] = fn
+        TASK_QUEUES[name] = queue
+        if on_abandoned is not None:
+            TASK_ABANDON_HOOKS[name] = on_abandoned
+        return fn
+    return decorator
+
+
+class JobQueue:
+    """
+    Durable work queue stored in a Mongo collection.
+
+    Jobs move pending -> running -> done, or back to pending with an
+    exponential backoff when the handler raises, until max_attempts is
+    reached and the job is marked failed. While a handler runs, its worker
+    renews the lease every lease_seconds / 3, so a long job is never taken
+    over by another worker; a running job whose lease expires (worker died)
+    is picked up again, unless it has used up its attempts, then it fails.
+    """
+
+    def __init__(self, collection, max_attempts=5, lease_seconds=300):
+        self.collection = collection
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+
+    def ensure_indexes(self):
+        self.collection.create_index([("status", ASCENDING), ("queue", ASCENDING), ("run_at", ASCENDING)])
+        self.collection.create_index("idempotency_key", unique=True, sparse=True)
+        self.collection.create_index("finished_at", expireAfterSeconds=FINISHED_JOB_TTL_SECONDS)
+
+    def enqueue(self, task_name, payload, idempotency_key=None, delay_seconds=0, queue=None):
+        """
+        Add a job to the queue (the task's own queue unless `queue` is given).
+        Returns: the job id. If a job with the same idempotency_key already exists, its id is returned instead.
+        """
+        now = datetime.utcnow()
+        job = {
+            "task": task_name,
+            "queue": queue or TASK_QUEUES.get(task_name, DEFAULT_QUEUE),
+            "payload": payload,
+            "status": "pending",
+            "attempts": 0,
+            "run_at": now + timedelta(seconds=delay_seconds),
+            "created_at": now,
+            "updated_at": now
+        }
+        if idempotency_key:
+            job["idempotency_key"] = idempotency_key
+        try:
+            return self.collection.insert_one(job).inserted_id
+        except DuplicateKeyError:
+            existing = self.collection.find_one({"idempotency_key": idempotency_key}, {"_id": 1})
+            return existing["_id"] if existing else None
+
+    def claim(self, worker_id, queue=DEFAULT_QUEUE):
+        """
+        Atomically take the next due job of `queue`, or None if there is nothing to do.
+        """
+        now = datetime.utcnow()
+        # Jobs queued before queues existed have no queue field and belong to the default one
+        queue_filter = {"$in": [queue, None]} if queue == DEFAULT_QUEUE else queue
+        return self.collection.find_one_and_update(
+            {"queue": queue_filter, "$or": [
+                {"status": "pending", "run_at": {"$lte": now}},
+                {"status": "running", "lease_until": {"$lt": now}, "attempts": {"$lt": self.max_attempts}}
+            ]},
+            {
+                "$set": {
+                    "status": "running",
+                    "worker": worker_id,
+                    "lease_until": now + timedelta(seconds=self.lease_seconds),
+                    "updated_at": now
+                },
+                "$inc": {"attempts": 1}
+            },
+            sort=[("run_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def renew_lease(self, job, worker_id):
+        """
+        Extend the lease of a job this worker is running.
+        Returns: False if the job is no longer ours.
+        """
+        now = datetime.utcnow()
+        result = self.collection.update_one(
+            {"_id": job["_id"], "status": "running", "worker": worker_id},
+            {"$set": {"lease_until": now + timedelta(seconds=self.lease_seconds), "updated_at": now}}
+        )
+        return result.matched_count == 1
+
+    def fail_abandoned(self):
+        """
+        Mark failed the jobs whose worker died on their last attempt (claim() won't retry them),
+        and run their task's on_abandoned hook.
+        Returns: the number of jobs failed.
+        """
+        now = datetime.utcnow()
+        abandoned = {"status": "running", "lease_until": {"$lt": now}, "attempts": {"$gte": self.max_attempts}}
+        failed = 0
+        for job in self.collection.find(abandoned, {"task": 1, "payload": 1}):
+            # Conditional on the same filter, so only one worker fails (and reports) each job
+            result = self.collection.update_one(
+                {"_id": job["_id"], **abandoned},
+                {"$set": {"status": "failed", "finished_at": now, "updated_at": now,
+                          "last_error": ABANDONED_ERROR},
+                 "$unset": {"lease_until": ""}}
+            )
+            if result.modified_count != 1:
+                continue
+            failed += 1
+            hook = TASK_ABANDON_HOOKS.get(job["task"])
+            if hook is not None:
+                try:
+                    hook(**job.get("payload", {}))
+                except Exception as e:
+                    print(f"[JOBS] on_abandoned hook of {job['task']} ({job['_id']}) failed: {e}", file=sys.stderr)
+        return failed
+
+    def _keep_lease(self, job, worker_id, stop_event):
+        while not stop_event.wait(self.lease_seconds / 3):
+            try:
+                if not self.renew_lease(job, worker_id):
+                    return
+            except Exception as e:
+                print(f"[JOBS] Lease renewal for {job['_id']} failed: {e}", file=sys.stderr)
+
+    def complete(self, job):
+        now = datetime.utcnow()
+        self.collection.update_one(
+            {"_id": job["_id"]},
+            {"$set": {"status": "done", "finished_at": now, "updated_at": now}, "$unset": {"lease_until": ""}}
+        )
+
+    def fail(self, job, error):
+        now = datetime.utcnow()
+        if job["attempts"] >= self.max_attempts:
+            update = {"status": "failed", "finished_at": now}
+        else:
+            # Exponential backoff with jitter: ~2s, 4s, 8s, ...
+            delay = (2 ** job["attempts"]) * (0.5 + random.random())
+            update = {"status": "pending", "run_at": now + timedelta(seconds=delay)}
+        update.update({"last_error": str(error)[:2000], "updated_at": now})
+        self.collection.update_one({"_id": job["_id"]}, {"$set": update, "$unset": {"lease_until": ""}})
+
+    def run_once(self, worker_id, queue=DEFAULT_QUEUE):
+        """
+        Process a single job.
+        Returns: True if a job was processed (successfully or not), False if the queue was empty.
+        """
+        job = self.claim(worker_id, queue=queue)
+        if job is None:
+            self.fail_abandoned()
+            return False
+        handler = TASKS.get(job["task"])
+        heartbeat_stop = threading.Event()
+        threading.Thread(target=self._keep_lease, args=(job, worker_id, heartbeat_stop),
+                         name="job-lease", daemon=True).start()
+        try:
+            if handler is None:
+                raise LookupError(f"No handler registered for task '{job['task']}'")
+            handler(**job.get("payload", {}))
+            self.complete(job)
+        except Exception as e:
+            print(f"[JOBS] {job['task']} ({job['_id']}) attempt {job['attempts']} failed: {e}", file=sys.stderr)
+            traceback.print_exc()
+            self.fail(job, e)
+        finally:
+            heartbeat_stop.set()
+        return True
+
+
+def run_worker(queue, poll_interval=1.0, stop_event=None, queue_name=DEFAULT_QUEUE):
+    """
+    Process jobs of queue_name until stop_event is set, sleeping poll_interval seconds whenever it is empty.
+    """
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+    tasks = sorted(name for name in TASKS if TASK_QUEUES[name] == queue_name)
+    print(f"[JOBS] Worker {worker_id} started on queue '{queue_name}' with tasks: {', '.join(tasks) or 'any queued on it'}")
+    while stop_event is None or not stop_event.is_set():
+        try:
+            if not queue.run_once(worker_id, queue=queue_name):
+                time.sleep(poll_interval)
+        except Exception as e:
+            # e.g. Mongo temporarily unreachable; keep the worker alive
+            print(f"[JOBS] Worker error: {e}", file=sys.stderr)
+            time.sleep(poll_interval)
+
+
+def start_worker_threads(queue, poll_interval=1.0, threads=None):
+    """
+    Run workers in daemon threads inside the current process.
+    threads: {queue name: number of worker threads}, default JOB_WORKER_THREADS
+    (default 4) for the default queue, JOB_INGEST_WORKER_THREADS (default 2) for
+    ingest, JOB_BULK_WORKER_THREADS (default 1) for bulk and JOB_BACKFILL_WORKER_THREADS
+    (default 1) for backfill.
+    Returns: the threading.Event that stops them.
+    """
+    if threads is None:
+        threads = {
+            DEFAULT_QUEUE: int(os.getenv("JOB_WORKER_THREADS", "4")),
+            INGEST_QUEUE: int(os.getenv("JOB_INGEST_WORKER_THREADS", "2")),
+            BULK_QUEUE: int(os.getenv("JOB_BULK_WORKER_THREADS", "1")),
+            BACKFILL_QUEUE: int(os.getenv("JOB_BACKFILL_WORKER_THREADS", "1"))
+        }
+    stop_event = threading.Event()
+    for queue_name, count in threads.items():
+        for i in range(count):
+            threading.Thread(
+                target=run_worker,
+                args=(queue, poll_interval, stop_event, queue_name),
+                name=f"job-worker-{queue_name}-{i}",
+                daemon=True
+            ).start()
+    return stop_event
@@ -0,0 +1,154 @@
+import os
+import sys
+import time
+import random
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class LLMMetrics:
+    """
+    Thread-safe counters for LLM calls: latency, retries, errors and token usage.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.status_codes = {}
+
+    def record(self, latency, status=None, usage=None, error=False):
+        with self._lock:
+            self.calls += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            if error:
+                self.errors += 1
+            if status is not None:
+                self.status_codes[str(status)] = self.status_codes.get(str(status), 0) + 1
+            if usage:
+                self.prompt_tokens += usage.get("prompt_tokens", 0)
+                self.completion_tokens += usage.get("completion_tokens", 0)
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "errors": self.errors,
+                "retries": self.retries,
+                "avg_latency_ms": round(self.total_latency / self.calls * 1000, 1) if self.calls else 0,
+                "max_latency_ms": round(self.max_latency * 1000, 1),
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "status_codes": dict(self.status_codes)
+            }
+
+
+class LLMClient:
+    """
+    Shared client for the OpenAI-compatible /chat/completions endpoint.
+
+    One pooled keep-alive requests.Session is reused for every call, so the
+    TCP/TLS handshake is paid once per connection instead of once per
+    completion. Calls have connect/read timeouts and are retried with
+    jittered exponential backoff on 429/5xx and connection errors.
+    """
+
+    def __init__(self, base_url, api_key, pool_size=20, connect_timeout=5.0, read_timeout=120.0, max_retries=3):
+        self.base_url = (base_url or "").rstrip("/")
+        self.api_key = api_key
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.metrics = LLMMetrics()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        })
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            base_url=os.getenv("BASE_URL"),
+            api_key=os.getenv("API_KEY"),
+            pool_size=int(os.getenv("LLM_POOL_SIZE", "20")),
+            connect_timeout=float(os.getenv("LLM_CONNECT_TIMEOUT", "5")),
+            read_timeout=float(os.getenv("LLM_READ_TIMEOUT", "120")),
+            max_retries=int(os.getenv("LLM_MAX_RETRIES", "3"))
+        )
+
+    def _backoff(self, attempt, response=None):
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after:
+                try:
+                    return float(retry_after)
+                except ValueError:
+                    pass
+        return min(30.0, (2 ** attempt) * (0.5 + random.random()))
+
+    def chat_completion(self, messages, model, temperature=0.6, stream=False):
+        """
+        Call /chat/completions.
+        Returns: the decoded JSON body if stream=False, or the open streaming Response if stream=True.
+        """
+        payload = {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "stream": stream
+        }
+        url = f"{self.base_url}/chat/completions"
+
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            try:
+                response = self.session.post(url, json=payload, stream=stream, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.metrics.record(time.perf_counter() - start, error=True)
+                if attempt == self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                print(f"[LLM] {type(e).__name__}, retrying in {delay:.1f}s", file=sys.stderr)
+                self.metrics.record_retry()
+                time.sleep(delay)
+                continue
+
+            if response.status_code in RETRYABLE_STATUS_CODES and attempt < self.max_retries:
+                self.metrics.record(time.perf_counter() - start, status=response.status_code, error=True)
+                delay = self._backoff(attempt, response)
+                print(f"[LLM] HTTP {response.status_code}, retrying in {delay:.1f}s", file=sys.stderr)
+                response.close()
+                self.metrics.record_retry()
+                time.sleep(delay)
+                continue
+
+            if not response.ok:
+                self.metrics.record(time.perf_counter() - start, status=response.status_code, error=True)
+                response.raise_for_status()
+
+            if stream:
+                # Latency here is time to response headers; the body is consumed by the caller
+                self.metrics.record(time.perf_counter() - start, status=response.status_code)
+                return response
+
+            data = response.json()
+            self.metrics.record(time.perf_counter() - start, status=response.status_code, usage=data.get("usage"))
+            return data
@@ -0,0 +1,62 @@
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# Max LLM calls in flight per map/reduce step, and how many partial summaries are merged per reduce call.
+# Rate limits (429) and 5xx are retried by the LLM client, so calls here are made once.
+MAP_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "4"))
+REDUCE_FAN_IN = int(os.getenv("SUMMARY_FAN_IN", "8"))
+
+
+def map_concurrent(fn, items, concurrency=MAP_CONCURRENCY):
+    """
+    Apply fn to every item with at most `concurrency` calls in flight.
+    Returns: results in input order, with None for items whose call failed,
+    so callers can keep every successful result.
+    """
+    def run(item):
+        try:
+            return fn(item)
+        except Exception as e:
+            print(f"[MAP-REDUCE] Call failed, skipping item: {e}", file=sys.stderr)
+            return None
+
+    if len(items) <= 1 or concurrency <= 1:
+        return [run(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(items)), thread_name_prefix="map") as executor:
+        return list(executor.map(run, items))
+
+
+def map_reduce(items, map_fn, reduce_fn, concurrency=MAP_CONCURRENCY, fan_in=REDUCE_FAN_IN, max_levels=None):
+    """
+    Summarize many items with a concurrent map step followed by a tree reduce.
+
+    - map_fn(index, item) -> partial result; called concurrently for every item
+    - reduce_fn(list_of_partials) -> merged result; called on groups of `fan_in` partials
+      per level until one result is left (or max_levels is reached, then everything
+      left is merged in one last call)
+
+    Failed calls are dropped and the rest carried forward, so wall-clock time
+    grows with the depth of the tree rather than the number of items.
+    Returns: the final result, or None if every map call failed.
+    """
+    partials = [p for p in map_concurrent(lambda pair: map_fn(*pair), list(enumerate(items)), concurrency) if p]
+    if not partials:
+        return None
+
+    level = 0
+    while len(partials) > 1:
+        if max_levels is not None and level >= max_levels:
+            return reduce_fn(partials)
+        groups = [partials[i:i + fan_in] for i in range(0, len(partials), fan_in)]
+        merged = iter(map_concurrent(reduce_fn, [g for g in groups if len(g) > 1], concurrency))
+        partials = []
+        for group in groups:
+            if len(group) == 1:
+                # Nothing to merge, carry it up to the next level as is
+                partials.append(group[0])
+                continue
+            # A failed merge keeps its inputs (joined) instead of losing them
+            partials.append(next(merged) or "\n\n".join(group))
+        level += 1
+    return partials[0]
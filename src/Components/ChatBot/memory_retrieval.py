@@ -0,0 +1,121 @@
+import os
+import sys
+import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from embedding_service import cosine_similarity
+from prompt_assembler import count_tokens
+
+# Entries at least this similar to a better-ranked one are dropped as duplicates
+MEMORY_DEDUP_SIMILARITY = float(os.getenv("MEMORY_DEDUP_SIMILARITY", "0.9"))
+# Age (days) at which a memory's recency weight is halfway to its floor
+MEMORY_RECENCY_HALF_LIFE_DAYS = float(os.getenv("MEMORY_RECENCY_HALF_LIFE_DAYS", "30"))
+# Tokens of memory text returned per lookup
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", "800"))
+MEMORY_SOURCE_WORKERS = int(os.getenv("MEMORY_SOURCE_WORKERS", "8"))
+
+# Separate from the request stage pool: retrieve() itself usually runs as a stage
+_executor = ThreadPoolExecutor(max_workers=MEMORY_SOURCE_WORKERS, thread_name_prefix="memory")
+
+
+def _memory_time(memory):
+    for field in ("timestamp", "created_at", "updated_at"):
+        value = memory.get(field)
+        if isinstance(value, datetime):
+            return value.replace(tzinfo=None)
+        if isinstance(value, str):
+            try:
+                return datetime.fromisoformat(value.rstrip("Z")).replace(tzinfo=None)
+            except ValueError:
+                continue
+    return None
+
+
+def recency_weight(memory, now, half_life_days=MEMORY_RECENCY_HALF_LIFE_DAYS):
+    """1.0 for a new memory, decaying towards 0.5; undated memories are not penalized."""
+    created = _memory_time(memory)
+    if created is None:
+        return 1.0
+    age_days = max((now - created).total_seconds(), 0) / 86400
+    return 0.5 + 0.5 * 0.5 ** (age_days / half_life_days)
+
+
+def importance_weight(memory):
+    """0.5 to 1.0 from the memory's importance (0-1, default 0.5)."""
+    try:
+        importance = float(memory.get("importance", 0.5))
+    except (TypeError, ValueError):
+        importance = 0.5
+    return 0.5 + 0.5 * min(max(importance, 0.0), 1.0)
+
+
+class MemoryRetriever:
+    """
+    One memory lookup over several stores.
+
+    Each source is a function (user_id, query, conversation_id) returning
+    {"current": [...], "other": [...]} lists of memories with a "text". The
+    sources are queried concurrently; their memories are embedded (through
+    the embedding service's cache), scored by relevance to the query x
+    recency x importance, deduplicated by embedding similarity (the better
+    scored copy wins) and cut to token_budget tokens.
+
+    Returns the same {"current", "other"} shape, best first, with "source"
+    and "score" added to each memory.
+    """
+
+    def __init__(self, sources, embedding_service, dedup_similarity=MEMORY_DEDUP_SIMILARITY,
+                 token_budget=MEMORY_TOKEN_BUDGET, half_life_days=MEMORY_RECENCY_HALF_LIFE_DAYS):
+        self.sources = sources
+        self.embedding_service = embedding_service
+        self.dedup_similarity = dedup_similarity
+        self.token_budget = token_budget
+        self.half_life_days = half_life_days
+
+    def _query_sources(self, user_id, query, conversation_id):
+        futures = {name: _executor.submit(fn, user_id, query, conversation_id) for name, fn in self.sources.items()}
+        candidates = []
+        for name, future in futures.items():
+            try:
+                result = future.result() or {}
+            except Exception as e:
+                print(f"[MEMORY] {name} lookup failed: {e}", file=sys.stderr)
+                continue
+            for scope in ("current", "other"):
+                for memory in result.get(scope, []):
+                    if memory.get("text", "").strip():
+                        candidates.append({**memory, "source": name, "scope": scope})
+        return candidates
+
+    def retrieve(self, user_id, query, conversation_id=None):
+        start = time.perf_counter()
+        candidates = self._query_sources(user_id, query, conversation_id)
+        if not candidates:
+            return {"current": [], "other": []}
+
+        query_embedding, *embeddings = self.embedding_service.embed_many([query] + [m["text"] for m in candidates])
+        now = datetime.utcnow()
+        for memory, embedding in zip(candidates, embeddings):
+            relevance = max(cosine_similarity(query_embedding, embedding), 0.0)
+            memory["score"] = round(relevance * recency_weight(memory, now, self.half_life_days) * importance_weight(memory), 4)
+            memory["_embedding"] = embedding
+
+        kept = []
+        used_tokens = 0
+        for memory in sorted(candidates, key=lambda m: m["score"], reverse=True):
+            if any(cosine_similarity(memory["_embedding"], other["_embedding"]) >= self.dedup_similarity for other in kept):
+                continue
+            tokens = count_tokens(memory["text"])
+            if used_tokens + tokens > self.token_budget:
+                continue
+            used_tokens += tokens
+            kept.append(memory)
+
+        merged = {"current": [], "other": []}
+        for memory in kept:
+            del memory["_embedding"]
+            merged[memory.pop("scope")].append(memory)
+        print(f"[MEMORY] {len(kept)}/{len(candidates)} memories kept (~{used_tokens} tokens) "
+              f"in {(time.perf_counter() - start) * 1000:.0f}ms")
+        return merged
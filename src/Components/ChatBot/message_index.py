@@ -0,0 +1,121 @@
+import os
+import sys
+
+from pymongo import MongoClient
+
+from job_queue import JobQueue, BACKFILL_QUEUE
+
+# Longest message text kept in the vector metadata (used for snippets)
+MAX_METADATA_TEXT = 1000
+
+
+class MessageIndex:
+    """
+    Semantic index of conversation messages in Pinecone, one namespace per user.
+
+    Vector ids are "<conversation_id>:<seq>", so a message is re-indexed in
+    place when it is edited, and a conversation's vectors can be listed and
+    deleted by id prefix. Messages are indexed one at a time as they are
+    written; nothing is ever rebuilt.
+    """
+
+    def __init__(self, index, embedding_service, namespace_prefix="messages"):
+        self.index = index
+        self.embedding_service = embedding_service
+        self.namespace_prefix = namespace_prefix
+
+    def namespace(self, user_id):
+        return f"{self.namespace_prefix}-{user_id}"
+
+    @staticmethod
+    def vector_id(conversation_id, seq):
+        return f"{conversation_id}:{seq}"
+
+    def upsert(self, user_id, conversation_id, seq, content, role=None):
+        if not content or not content.strip():
+            self.delete(user_id, [self.vector_id(conversation_id, seq)])
+            return
+        embedding = self.embedding_service.encode_documents([content])[0]
+        metadata = {"conversation_id": conversation_id, "seq": seq, "text": content[:MAX_METADATA_TEXT]}
+        if role:
+            metadata["role"] = role
+        self.index.upsert(
+            vectors=[(self.vector_id(conversation_id, seq), embedding, metadata)],
+            namespace=self.namespace(user_id)
+        )
+
+    def delete(self, user_id, ids):
+        if ids:
+            self.index.delete(ids=ids, namespace=self.namespace(user_id))
+
+    def delete_conversation(self, user_id, conversation_id, from_seq=0):
+        """
+        Remove the conversation's vectors for every message with seq >= from_seq.
+        """
+        namespace = self.namespace(user_id)
+        for ids in self.index.list(prefix=f"{conversation_id}:", namespace=namespace):
+            stale = [vid for vid in ids if int(vid.rsplit(":", 1)[1]) >= from_seq]
+            if stale:
+                self.index.delete(ids=stale, namespace=namespace)
+
+    def search(self, user_id, query, top_k=10):
+        """
+        Returns: list of {conversation_id, seq, score, text}, best match first.
+        """
+        embedding = self.embedding_service.embed_query(query)
+        results = self.index.query(
+            vector=embedding,
+            top_k=top_k,
+            include_metadata=True,
+            namespace=self.namespace(user_id)
+        )
+        hits = []
+        for match in results["matches"]:
+            metadata = match["metadata"] or {}
+            try:
+                hits.append({
+                    "conversation_id": metadata["conversation_id"],
+                    "seq": int(metadata["seq"]),
+                    "score": match["score"],
+                    "text": metadata.get("text", "")
+                })
+            except (KeyError, TypeError, ValueError) as e:
+                print(f"[MESSAGE-INDEX] Skipping malformed match {match['id']}: {e}", file=sys.stderr)
+        return hits
+
+
+def enqueue_backfill(db, job_queue, user_id=None):
+    """
+    Queue an index_message job for every stored message (of one user, if
+    given), on the backfill queue, which has its own worker: uploads and live
+    messages are never queued behind it. Safe to re-run: a message already
+    queued by a previous backfill is skipped.
+    Returns: the number of messages processed.
+    """
+    query = {"content": {"$nin": ["", None]}}
+    if user_id:
+        query["user_id"] = user_id
+    count = 0
+    for doc in db.messages.find(query, {"user_id": 1, "conversation_id": 1, "seq": 1}):
+        job_queue.enqueue(
+            "index_message",
+            {"user_id": doc["user_id"], "conversation_id": doc["conversation_id"], "seq": doc["seq"]},
+            idempotency_key=f"backfill_message:{doc['conversation_id']}:{doc['seq']}",
+            queue=BACKFILL_QUEUE
+        )
+        count += 1
+    return count
+
+
+if __name__ == '__main__':
+    # Usage: python message_index.py backfill [user_id]
+    # The jobs are run by the worker (python worker.py) or the app's in-process worker
+    if len(sys.argv) < 2 or sys.argv[1] != "backfill":
+        print("Usage: python message_index.py backfill [user_id]")
+        sys.exit(1)
+
+    mongo_uri = os.getenv("MONGO_URI", "mongodb://localhost:27017/Moktashef-DEV")
+    client = MongoClient(mongo_uri)
+    db = client.get_default_database()
+    count = enqueue_backfill(db, JobQueue(db.jobs), user_id=sys.argv[2] if len(sys.argv) > 2 else None)
+    print(f"Queued {count} messages for indexing")
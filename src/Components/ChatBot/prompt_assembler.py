@@ -0,0 +1,173 @@
+import os
+import sys
+import hashlib
+import threading
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Tokens for everything sent to the model except the reply (system prompt, context, history, the user message)
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "6000"))
+# tiktoken encoding used to count tokens; without tiktoken, ~4 characters per token
+PROMPT_TOKENIZER = os.getenv("PROMPT_TOKENIZER", "cl100k_base")
+# A section is dropped rather than cut when less than this much budget is left for it
+MIN_SECTION_TOKENS = 32
+
+_encoding = None
+_encoding_failed = False
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    global _encoding, _encoding_failed
+    if _encoding is None and not _encoding_failed and tiktoken is not None:
+        with _encoding_lock:
+            if _encoding is None and not _encoding_failed:
+                try:
+                    _encoding = tiktoken.get_encoding(PROMPT_TOKENIZER)
+                except Exception as e:
+                    # e.g. the encoding file can't be downloaded: count by characters instead
+                    print(f"[PROMPT] tiktoken unavailable, estimating tokens from length: {e}", file=sys.stderr)
+                    _encoding_failed = True
+    return _encoding
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text, max_tokens):
+    """
+    Cut text to at most max_tokens, at a line break when one is near the end.
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    encoding = _get_encoding()
+    if encoding is None:
+        cut = text[:max(max_tokens - 1, 0) * 4]
+    else:
+        cut = encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+    newline = cut.rfind("\n")
+    if newline > len(cut) // 2:
+        cut = cut[:newline]
+    return cut.rstrip() + "\n[...]"
+
+
+def history_hash(messages):
+    """Hash of the roles and contents of a list of messages (detects edits to summarized history)."""
+    digest = hashlib.sha256()
+    for m in messages:
+        digest.update(f"{m.get('role')}\0{m.get('content')}\0".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class PromptAssembler:
+    """
+    Builds the message list for one completion within a token budget.
+
+    The base prompt and the user message are always sent. Everything else is
+    a section (or the conversation history) competing for the rest of the
+    budget in priority order (lower number first): a section that doesn't
+    fit is cut down, or dropped when less than MIN_SECTION_TOKENS is left;
+    the history keeps as many of its most recent messages as fit.
+
+    The output is laid out for prefix caching: the base prompt and the
+    stable sections (a document, the summary of older history) come first,
+    then the history, which only grows at the end from one turn to the
+    next; per-turn sections (memories, a reply, a fact just shared) go in a
+    system message right before the user message.
+    """
+
+    def __init__(self, base_prompt, budget=PROMPT_TOKEN_BUDGET):
+        self.base_prompt = base_prompt
+        self.budget = budget
+        self.sections = []
+        self.history = []
+        self.history_priority = None
+        self.usage = {}
+        self.dropped = []
+        self.history_dropped = 0
+
+    def add(self, name, text, priority, stable=False, max_tokens=None):
+        if text and text.strip():
+            self.sections.append({"name": name, "text": text, "priority": priority,
+                                  "stable": stable, "max_tokens": max_tokens})
+        return self
+
+    def set_history(self, messages, priority):
+        self.history = [{"role": m["role"], "content": m["content"]} for m in messages]
+        self.history_priority = priority
+        return self
+
+    def _allocate(self, reserved):
+        remaining = self.budget - reserved
+        kept = {}
+        entries = sorted(self.sections, key=lambda s: s["priority"])
+        if self.history_priority is not None:
+            entries = sorted(entries + [{"name": "history", "priority": self.history_priority}],
+                             key=lambda s: s["priority"])
+        for entry in entries:
+            if entry["name"] == "history":
+                kept_history = []
+                for m in reversed(self.history):
+                    cost = count_tokens(m["content"]) + 4
+                    if cost > remaining:
+                        break
+                    kept_history.insert(0, m)
+                    remaining -= cost
+                self.history_dropped = len(self.history) - len(kept_history)
+                kept["history"] = kept_history
+                self.usage["history"] = sum(count_tokens(m["content"]) + 4 for m in kept_history)
+                continue
+
+            limit = min(remaining, entry["max_tokens"]) if entry["max_tokens"] else remaining
+            text = entry["text"]
+            if count_tokens(text) > limit:
+                if limit < MIN_SECTION_TOKENS:
+                    self.dropped.append(entry["name"])
+                    continue
+                text = truncate_to_tokens(text, limit)
+            cost = count_tokens(text)
+            remaining -= cost
+            kept[entry["name"]] = text
+            self.usage[entry["name"]] = cost
+        return kept
+
+    def build_text(self):
+        """
+        The base prompt followed by the sections that fit, in the order they were added
+        (for single-string prompts such as a search query).
+        """
+        self.usage = {"base": count_tokens(self.base_prompt)}
+        kept = self._allocate(self.usage["base"])
+        return self.base_prompt + "".join(kept[s["name"]] for s in self.sections if s["name"] in kept)
+
+    def build(self, user_message):
+        """
+        Returns: the message list to send, ending with user_message.
+        """
+        self.usage = {"base": count_tokens(self.base_prompt), "user": count_tokens(user_message)}
+        kept = self._allocate(self.usage["base"] + self.usage["user"])
+
+        stable = "".join("\n\n" + kept[s["name"]] for s in self.sections if s["stable"] and s["name"] in kept)
+        volatile = "".join("\n\n" + kept[s["name"]] for s in self.sections if not s["stable"] and s["name"] in kept)
+
+        llm_messages = [{"role": "system", "content": self.base_prompt + stable}]
+        llm_messages.extend(kept.get("history", []))
+        if volatile:
+            llm_messages.append({"role": "system", "content": volatile.strip()})
+        llm_messages.append({"role": "user", "content": user_message})
+        return llm_messages
+
+    def report(self):
+        parts = ", ".join(f"{name}={tokens}" for name, tokens in self.usage.items())
+        dropped = f", dropped: {', '.join(self.dropped)}" if self.dropped else ""
+        history = f", {self.history_dropped} older messages left out" if self.history_dropped else ""
+        return f"~{sum(self.usage.values())}/{self.budget} tokens ({parts}){dropped}{history}"
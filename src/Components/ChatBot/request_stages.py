@@ -0,0 +1,101 @@
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Bounded pools shared by all requests so a burst of chats can't spawn unbounded threads.
+# Stages a response waits on get their own pool, sized to the serving concurrency
+# (SERVE_THREADS requests per worker, ~3 awaited stages each), so they never queue
+# behind other requests' background work.
+STAGES_PER_REQUEST = 3
+STAGE_WORKERS = int(os.getenv("STAGE_WORKERS", str(int(os.getenv("SERVE_THREADS", "64")) * STAGES_PER_REQUEST)))
+STAGE_BACKGROUND_WORKERS = int(os.getenv("STAGE_BACKGROUND_WORKERS", "8"))
+_executor = ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix="stage")
+_background_executor = ThreadPoolExecutor(max_workers=STAGE_BACKGROUND_WORKERS, thread_name_prefix="stage-bg")
+
+
+class RequestStages:
+    """
+    Runs the independent steps of a single request concurrently on the shared
+    stage pools and records how long each one took.
+
+    - submit(name, fn, ...): start a stage whose result is needed later, read it with result(name)
+    - fire_and_forget(name, fn, ...): start a stage nobody waits on (on the background pool); errors are only logged
+    - chain(name, after, fn, ...): run fn(result_of_after, ...) in the background once `after` finishes
+    - stream(iterable): wrap a response generator to record time-to-first-token and print the breakdown
+    """
+
+    def __init__(self, label):
+        self.label = label
+        self.started = time.perf_counter()
+        self.futures = {}
+        self.durations = {}
+        self.waits = {}
+        self.marks = {}
+
+    def _timed(self, name, fn, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.durations[name] = time.perf_counter() - start
+
+    def submit(self, name, fn, *args, **kwargs):
+        future = _executor.submit(self._timed, name, fn, *args, **kwargs)
+        self.futures[name] = future
+        return future
+
+    def fire_and_forget(self, name, fn, *args, **kwargs):
+        future = _background_executor.submit(self._timed, name, fn, *args, **kwargs)
+        self.futures[name] = future
+        future.add_done_callback(lambda f: self._log_error(name, f))
+        return future
+
+    def chain(self, name, after, fn, *args, **kwargs):
+        def _run_next(done):
+            if done.exception() is None:
+                self.fire_and_forget(name, fn, done.result(), *args, **kwargs)
+        self.futures[after].add_done_callback(_run_next)
+
+    def result(self, name, default=None, timeout=None):
+        """
+        Wait for a stage and return its result, or `default` if it failed or was never started.
+        """
+        future = self.futures.get(name)
+        if future is None:
+            return default
+        start = time.perf_counter()
+        try:
+            return future.result(timeout=timeout)
+        except Exception as e:
+            print(f"[STAGES] {self.label}: stage '{name}' failed: {e}", file=sys.stderr)
+            return default
+        finally:
+            self.waits[name] = time.perf_counter() - start
+
+    def mark(self, name):
+        """Record the time since the request started, once per name."""
+        self.marks.setdefault(name, time.perf_counter() - self.started)
+
+    def stream(self, iterable):
+        try:
+            for chunk in iterable:
+                self.mark("first_token")
+                yield chunk
+        finally:
+            self.mark("done")
+            self.report()
+
+    def report(self):
+        # Background stages may still be finishing, so iterate over snapshots
+        parts = [
+            f"{name}={duration * 1000:.0f}ms (waited {self.waits.get(name, 0) * 1000:.0f}ms)"
+            for name, duration in list(self.durations.items())
+        ]
+        parts += [f"{name}@{elapsed * 1000:.0f}ms" for name, elapsed in list(self.marks.items())]
+        print(f"[STAGES] {self.label}: " + ", ".join(parts))
+
+    def _log_error(self, name, future):
+        error = future.exception()
+        if error is not None:
+            print(f"[STAGES] {self.label}: background stage '{name}' failed: {error}", file=sys.stderr)
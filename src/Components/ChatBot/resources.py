@@ -0,0 +1,123 @@
+import sys
+import time
+import threading
+
+
+class LazyResource:
+    """
+    A heavy dependency (client, model, module) created on first use.
+
+    Attribute access is forwarded to the underlying object, so a LazyResource
+    can stand in for a module-level singleton: `pinecone_index.query(...)`
+    creates the index client on the first call. A failed initialization is
+    recorded and retried on the next use instead of crashing the process.
+    """
+
+    def __init__(self, name, factory, required=True):
+        self._name = name
+        self._factory = factory
+        self._required = required
+        self._value = None
+        self._ready = False
+        self._lock = threading.Lock()
+        self._init_seconds = None
+        self._error = None
+
+    def get(self):
+        if not self._ready:
+            with self._lock:
+                if not self._ready:
+                    start = time.perf_counter()
+                    try:
+                        self._value = self._factory()
+                    except Exception as e:
+                        self._error = f"{type(e).__name__}: {e}"
+                        print(f"[RESOURCES] {self._name} failed to initialize: {self._error}", file=sys.stderr)
+                        raise
+                    self._init_seconds = time.perf_counter() - start
+                    self._error = None
+                    self._ready = True
+                    print(f"[RESOURCES] {self._name} ready in {self._init_seconds:.2f}s")
+        return self._value
+
+    def __getattr__(self, attr):
+        # Only called for attributes not set in __init__
+        return getattr(self.get(), attr)
+
+    def status(self):
+        return {
+            "ready": self._ready,
+            "required": self._required,
+            "init_ms": round(self._init_seconds * 1000) if self._init_seconds is not None else None,
+            "error": self._error
+        }
+
+
+class ResourceRegistry:
+    """
+    The process's lazily created dependencies plus a startup-time breakdown.
+
+    - register() declares a resource without creating it
+    - warm_up() creates every resource in a background thread, so the server
+      can start listening right away
+    - ready() is True once every required resource is up (readiness), while
+      the process being able to answer at all is liveness
+    """
+
+    def __init__(self, started=None):
+        self._resources = {}
+        self._last_mark = started if started is not None else time.perf_counter()
+        self.phases = {}
+        self.warm_up_seconds = None
+
+    def register(self, name, factory, required=True):
+        resource = LazyResource(name, factory, required=required)
+        self._resources[name] = resource
+        return resource
+
+    def mark(self, phase):
+        """Record how long the startup phase that just finished took."""
+        now = time.perf_counter()
+        self.phases[phase] = round((now - self._last_mark) * 1000)
+        self._last_mark = now
+
+    def warm_up(self, max_retry_delay=30):
+        """
+        Initialize every registered resource in a daemon thread, retrying the
+        ones that fail (e.g. Mongo not reachable yet) with backoff until all are up.
+        Returns: the thread.
+        """
+        def run():
+            start = time.perf_counter()
+            pending = list(self._resources.values())
+            attempt = 0
+            while pending:
+                for resource in pending:
+                    try:
+                        resource.get()
+                    except Exception:
+                        # Already recorded; retried below (or on first use)
+                        pass
+                pending = [r for r in pending if not r._ready]
+                if pending:
+                    time.sleep(min(max_retry_delay, 2 ** attempt))
+                    attempt += 1
+            self.warm_up_seconds = time.perf_counter() - start
+            print(f"[STARTUP] Warm-up finished in {self.warm_up_seconds:.2f}s")
+
+        thread = threading.Thread(target=run, name="resource-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def ready(self):
+        return all(r._ready for r in self._resources.values() if r._required)
+
+    def status(self):
+        return {name: resource.status() for name, resource in self._resources.items()}
+
+    def startup_report(self):
+        return {
+            "phases_ms": dict(self.phases),
+            "resources_ms": {name: r.status()["init_ms"] for name, r in self._resources.items()},
+            "warm_up_ms": round(self.warm_up_seconds * 1000) if self.warm_up_seconds is not None else None
+        }
@@ -0,0 +1,176 @@
+import os
+import sys
+import signal
+import threading
+import multiprocessing
+
+# Production entry point. `python chat.py` runs Flask's development server,
+# where a single long streaming reply can hold up other requests.
+#
+#   Linux/macOS: gunicorn with gthread (default) or gevent workers
+#   Windows:     waitress (gunicorn doesn't run there). Ctrl+C (or Ctrl+Break) stops accepting
+#                connections and waits for in-flight streams; a second Ctrl+C stops at once
+#
+# Usage: python serve.py
+#
+# Settings (environment variables):
+#   SERVE_HOST / SERVE_PORT       bind address (default 0.0.0.0:5000)
+#   SERVE_WORKER_CLASS            gthread | gevent (gunicorn only, default gthread)
+#   SERVE_WORKERS                 worker processes (default 2; each loads its own embedding model)
+#   SERVE_THREADS                 threads per gthread worker / waitress (default 64),
+#                                 i.e. concurrent streams per worker
+#   SERVE_WORKER_CONNECTIONS      concurrent connections per gevent worker (default 1000)
+#   SERVE_KEEPALIVE               seconds an idle keep-alive connection stays open (default 75)
+#   SERVE_TIMEOUT                 seconds a silent worker may run before being restarted
+#                                 (default 300; streams longer than an LLM reply are expected)
+#   SERVE_GRACEFUL_TIMEOUT        seconds in-flight streams get to finish on shutdown (default 120)
+
+HOST = os.getenv("SERVE_HOST", "0.0.0.0")
+PORT = int(os.getenv("SERVE_PORT", "5000"))
+WORKER_CLASS = os.getenv("SERVE_WORKER_CLASS", "gthread")
+WORKERS = int(os.getenv("SERVE_WORKERS", str(min(2, multiprocessing.cpu_count()))))
+THREADS = int(os.getenv("SERVE_THREADS", "64"))
+WORKER_CONNECTIONS = int(os.getenv("SERVE_WORKER_CONNECTIONS", "1000"))
+KEEPALIVE = int(os.getenv("SERVE_KEEPALIVE", "75"))
+TIMEOUT = int(os.getenv("SERVE_TIMEOUT", "300"))
+GRACEFUL_TIMEOUT = int(os.getenv("SERVE_GRACEFUL_TIMEOUT", "120"))
+
+
+def gunicorn_options():
+    return {
+        "bind": f"{HOST}:{PORT}",
+        "worker_class": WORKER_CLASS,
+        "workers": WORKERS,
+        "threads": THREADS,
+        "worker_connections": WORKER_CONNECTIONS,
+        "keepalive": KEEPALIVE,
+        "timeout": TIMEOUT,
+        # On SIGTERM workers stop accepting connections and get this long to finish in-flight streams
+        "graceful_timeout": GRACEFUL_TIMEOUT,
+        # Not preloaded: chat.py starts background threads (job worker, warm-up) at import,
+        # and threads don't survive the fork into workers
+        "preload_app": False,
+        "accesslog": "-",
+        "errorlog": "-"
+    }
+
+
+def serve_gunicorn():
+    from gunicorn.app.base import BaseApplication
+
+    class ChatApplication(BaseApplication):
+        def __init__(self, options):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from chat import app
+            return app
+
+    print(f"[SERVE] gunicorn on {HOST}:{PORT}: {WORKERS} {WORKER_CLASS} worker(s), "
+          f"{THREADS if WORKER_CLASS == 'gthread' else WORKER_CONNECTIONS} concurrent requests each")
+    ChatApplication(gunicorn_options()).run()
+
+
+class ActiveRequests:
+    """
+    WSGI middleware counting the requests whose response hasn't been closed yet
+    (a streamed reply counts until its last frame is sent), so shutdown can wait for them.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def _done(self):
+        with self._lock:
+            self.count -= 1
+
+    def __call__(self, environ, start_response):
+        with self._lock:
+            self.count += 1
+        try:
+            result = self.app(environ, start_response)
+        except BaseException:
+            self._done()
+            raise
+        return _TrackedResponse(result, self._done)
+
+
+class _TrackedResponse:
+    def __init__(self, result, done):
+        self.result = result
+        self.done = done
+
+    def __iter__(self):
+        return iter(self.result)
+
+    def close(self):
+        # The server calls close() once the response is finished or the client went away
+        try:
+            close = getattr(self.result, "close", None)
+            if close is not None:
+                close()
+        finally:
+            self.done()
+
+
+def serve_waitress():
+    import time
+    from waitress import create_server
+    from chat import app
+
+    active = ActiveRequests(app)
+    server = create_server(
+        active,
+        host=HOST,
+        port=PORT,
+        threads=THREADS,
+        connection_limit=max(THREADS * 4, 100),
+        channel_timeout=TIMEOUT
+    )
+    stop_event = threading.Event()
+
+    def request_stop(signum, frame):
+        stop_event.set()
+        # A second Ctrl+C interrupts the drain
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    for name in ("SIGINT", "SIGTERM", "SIGBREAK"):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), request_stop)
+
+    print(f"[SERVE] waitress on {HOST}:{PORT} with {THREADS} threads")
+    threading.Thread(target=server.run, name="waitress-loop", daemon=True).start()
+    while not stop_event.wait(1.0):
+        pass
+
+    def stop_listening():
+        # Only the listening socket: the loop keeps serving the open channels
+        server.del_channel()
+        server.socket.close()
+
+    # Runs in the server's own loop thread, then in-flight streams get to finish
+    server.trigger.pull_trigger(stop_listening)
+    print(f"[SERVE] Stopped accepting connections, waiting up to {GRACEFUL_TIMEOUT}s "
+          f"for {active.count} in-flight request(s)")
+    deadline = time.monotonic() + GRACEFUL_TIMEOUT
+    try:
+        while active.count > 0 and time.monotonic() < deadline:
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+    if active.count:
+        print(f"[SERVE] {active.count} request(s) still running at shutdown", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    if sys.platform == "win32":
+        serve_waitress()
+    else:
+        serve_gunicorn()
@@ -0,0 +1,150 @@
+import os
+import sys
+import json
+import time
+import queue
+import threading
+
+# Deltas are sent to the client in frames of at least this many characters,
+# or whatever has accumulated once the oldest buffered delta is this old
+STREAM_MIN_FRAME_CHARS = int(os.getenv("STREAM_MIN_FRAME_CHARS", "48"))
+STREAM_MAX_FRAME_DELAY_MS = float(os.getenv("STREAM_MAX_FRAME_DELAY_MS", "40"))
+
+
+class SSEParser:
+    """
+    Incremental parser for a text/event-stream body.
+
+    feed() takes raw bytes as they arrive from the socket, in chunks of any
+    size, and returns the data of every event completed by them. Partial
+    lines (and partial UTF-8 sequences) are kept until the rest arrives.
+    """
+
+    def __init__(self):
+        self._buffer = b""
+        self._data_lines = []
+
+    def feed(self, chunk):
+        self._buffer += chunk
+        events = []
+        while True:
+            newline = self._buffer.find(b"\n")
+            if newline < 0:
+                break
+            line = self._buffer[:newline].rstrip(b"\r").decode("utf-8")
+            self._buffer = self._buffer[newline + 1:]
+
+            if not line:
+                # A blank line ends the event
+                if self._data_lines:
+                    events.append("\n".join(self._data_lines))
+                    self._data_lines = []
+            elif line.startswith("data:"):
+                value = line[len("data:"):]
+                self._data_lines.append(value[1:] if value.startswith(" ") else value)
+            # Comments (":...") and other fields (event:, id:, retry:) are not used by the completions API
+        return events
+
+    def close(self):
+        """Returns: the data of an event left unterminated at the end of the stream, if any."""
+        events = self.feed(b"\n") if self._buffer else []
+        if self._data_lines:
+            events.append("\n".join(self._data_lines))
+            self._data_lines = []
+        return events
+
+
+def iter_completion_deltas(response):
+    """
+    Yield the text deltas of a streaming chat completion response,
+    reading the body as it arrives and parsing the event stream incrementally.
+    """
+    parser = SSEParser()
+
+    def events():
+        for chunk in response.iter_content(chunk_size=None):
+            yield from parser.feed(chunk)
+        yield from parser.close()
+
+    try:
+        for data in events():
+            if data.strip() == "[DONE]":
+                break
+            try:
+                delta = json.loads(data).get("choices", [{}])[0].get("delta", {}).get("content", "")
+            except Exception as e:
+                print(f"Stream parse error: {e}", file=sys.stderr)
+                continue
+            if delta:
+                yield delta
+    finally:
+        response.close()
+
+
+def _read_into(deltas, frames, stop_event):
+    # Runs in its own thread so coalesce() can flush on time while this waits for the next delta
+    try:
+        for delta in deltas:
+            if stop_event.is_set():
+                break
+            frames.put(("delta", delta))
+    except Exception as e:
+        frames.put(("error", e))
+    else:
+        frames.put(("end", None))
+    finally:
+        close = getattr(deltas, "close", None)
+        if close is not None:
+            close()
+
+
+def coalesce(deltas, min_chars=STREAM_MIN_FRAME_CHARS, max_delay_ms=STREAM_MAX_FRAME_DELAY_MS):
+    """
+    Merge tiny deltas into larger frames. The first delta is sent as soon as it
+    arrives; after that a frame is sent once it holds min_chars characters or
+    its oldest delta has waited max_delay_ms, even if the upstream is stalled.
+    Whatever is left is flushed when the stream ends (or before an error from
+    deltas is re-raised).
+    """
+    frames = queue.Queue()
+    stop_event = threading.Event()
+    threading.Thread(target=_read_into, args=(deltas, frames, stop_event),
+                     name="stream-reader", daemon=True).start()
+
+    buffer = []
+    size = 0
+    started = None
+    first = True
+    max_delay = max_delay_ms / 1000.0
+    try:
+        while True:
+            timeout = max(started + max_delay - time.perf_counter(), 0) if buffer else None
+            try:
+                kind, value = frames.get(timeout=timeout)
+            except queue.Empty:
+                yield "".join(buffer)
+                buffer = []
+                size = 0
+                continue
+
+            if kind != "delta":
+                if buffer:
+                    yield "".join(buffer)
+                if kind == "error":
+                    raise value
+                return
+            if first:
+                first = False
+                yield value
+                continue
+            if not buffer:
+                started = time.perf_counter()
+            buffer.append(value)
+            size += len(value)
+            if size >= min_chars or time.perf_counter() - started >= max_delay:
+                yield "".join(buffer)
+                buffer = []
+                size = 0
+    finally:
+        # The client went away (or the stream ended): stop reading the upstream
+        stop_event.set()
@@ -0,0 +1,90 @@
+import os
+import hashlib
+from datetime import datetime
+
+from pymongo import ASCENDING
+
+# Entries are deleted by Mongo this long after they were written (a summary is recomputed on the next miss)
+SUMMARY_CACHE_TTL_SECONDS = int(os.getenv("SUMMARY_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class SummaryCache:
+    """
+    Persistent cache for document summaries, stored in Mongo.
+
+    Three kinds of entries share the collection:
+    - "doc:<file_id>:<content hash>": the final summary of a whole document
+    - "llm:<hash of model + prompt>": the output of one summarization call, so every
+      level of the summary tree (chunk summaries, merged summaries) is reused; the
+      same prompt can come from several files, which are all listed in file_ids
+    - "history:<conversation_id>": the rolling summary of a conversation's first
+      `upto` messages, with the hash of the messages it covers
+    Every entry expires ttl_seconds after it was written (Mongo TTL index).
+    """
+
+    def __init__(self, collection, ttl_seconds=SUMMARY_CACHE_TTL_SECONDS):
+        self.collection = collection
+        self.ttl_seconds = ttl_seconds
+
+    def ensure_indexes(self):
+        self.collection.create_index([("file_id", ASCENDING)])
+        self.collection.create_index([("file_ids", ASCENDING)])
+        self.collection.create_index("created_at", expireAfterSeconds=self.ttl_seconds)
+
+    def get(self, key):
+        doc = self.collection.find_one({"_id": key}, {"summary": 1})
+        return doc["summary"] if doc else None
+
+    def set(self, key, summary, file_id=None):
+        self.collection.update_one(
+            {"_id": key},
+            {"$set": {"summary": summary, "file_id": file_id, "created_at": datetime.utcnow()}},
+            upsert=True
+        )
+
+    def cached_call(self, prompt, llm_api_func, model=None, file_id=None):
+        """
+        Call llm_api_func(prompt, model=model) unless the same prompt was already summarized.
+        """
+        key = "llm:" + content_hash(f"{model or ''}\0{prompt}")
+        summary = self.get(key)
+        if summary is None:
+            summary = llm_api_func(prompt, model=model)
+            if summary:
+                update = {"$set": {"summary": summary, "created_at": datetime.utcnow()}}
+                if file_id:
+                    update["$addToSet"] = {"file_ids": file_id}
+                self.collection.update_one({"_id": key}, update, upsert=True)
+        elif file_id:
+            # The same prompt can come from several files: delete_file() keeps the entry until all of them are deleted
+            self.collection.update_one({"_id": key}, {"$addToSet": {"file_ids": file_id}})
+        return summary
+
+    def get_document_summary(self, file_id, text):
+        return self.get(f"doc:{file_id}:{content_hash(text)}")
+
+    def set_document_summary(self, file_id, text, summary):
+        self.set(f"doc:{file_id}:{content_hash(text)}", summary, file_id=file_id)
+
+    def delete_file(self, file_id):
+        """Drop the file's document summaries, and the summarization calls no other file shares."""
+        self.collection.delete_many({"file_id": file_id})
+        self.collection.update_many({"file_ids": file_id}, {"$pull": {"file_ids": file_id}})
+        self.collection.delete_many({"file_ids": {"$size": 0}})
+
+    def get_history_summary(self, conversation_id):
+        return self.collection.find_one({"_id": f"history:{conversation_id}"}, {"summary": 1, "upto": 1, "covered_hash": 1})
+
+    def set_history_summary(self, conversation_id, summary, upto, covered_hash):
+        self.collection.update_one(
+            {"_id": f"history:{conversation_id}"},
+            {"$set": {"summary": summary, "upto": upto, "covered_hash": covered_hash, "created_at": datetime.utcnow()}},
+            upsert=True
+        )
+
+    def delete_history_summary(self, conversation_id):
+        self.collection.delete_one({"_id": f"history:{conversation_id}"})
@@ -0,0 +1,115 @@
+import re
+import hashlib
+import threading
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, DESCENDING
+
+from embedding_service import cosine_similarity
+
+
+def normalize_query(query):
+    """Lowercase, drop punctuation and collapse whitespace, so trivially different phrasings share an entry."""
+    return " ".join(re.sub(r"[^\w\s]", " ", (query or "").lower()).split())
+
+
+class WebAnswerCache:
+    """
+    Web-search answers shared by all users, stored in Mongo.
+
+    Entries are keyed by the hash of the normalized query and expire after
+    ttl_seconds (Mongo TTL index). The collection is kept to max_entries by
+    evicting the least recently used entries. With an embedding_service, a
+    query that misses the exact key can still hit an entry whose query
+    embedding is at least similarity_threshold similar.
+
+    Only store answers generated from the query alone: anything mixed with a
+    user's private context (files, memories, replies) must not be shared.
+    """
+
+    def __init__(self, collection, ttl_seconds=6 * 3600, max_entries=5000,
+                 embedding_service=None, similarity_threshold=0.92, semantic_candidates=200):
+        self.collection = collection
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.embedding_service = embedding_service
+        self.similarity_threshold = similarity_threshold
+        self.semantic_candidates = semantic_candidates
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def ensure_indexes(self):
+        self.collection.create_index("expires_at", expireAfterSeconds=0)
+        self.collection.create_index([("last_used_at", DESCENDING)])
+
+    @staticmethod
+    def key(query):
+        return hashlib.sha256(normalize_query(query).encode("utf-8")).hexdigest()
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, query):
+        """
+        Returns: {"answer", "links", "query"} of a fresh cached answer, or None.
+        """
+        now = datetime.utcnow()
+        projection = {"answer": 1, "links": 1, "query": 1}
+        doc = self.collection.find_one({"_id": self.key(query), "expires_at": {"$gt": now}}, projection)
+        counter = "hits"
+
+        if doc is None and self.embedding_service is not None:
+            embedding = self.embedding_service.embed_query(normalize_query(query))
+            candidates = self.collection.find(
+                {"expires_at": {"$gt": now}, "embedding": {"$exists": True}},
+                {**projection, "embedding": 1}
+            ).sort("last_used_at", DESCENDING).limit(self.semantic_candidates)
+            best, best_score = None, self.similarity_threshold
+            for candidate in candidates:
+                score = cosine_similarity(embedding, candidate["embedding"])
+                if score >= best_score:
+                    best, best_score = candidate, score
+            doc = best
+            counter = "semantic_hits"
+
+        if doc is None:
+            self._count("misses")
+            return None
+        self._count(counter)
+        self.collection.update_one({"_id": doc["_id"]}, {"$set": {"last_used_at": now}, "$inc": {"hit_count": 1}})
+        return {"answer": doc["answer"], "links": doc.get("links", []), "query": doc.get("query")}
+
+    def set(self, query, answer, links=None):
+        now = datetime.utcnow()
+        normalized = normalize_query(query)
+        doc = {
+            "query": normalized,
+            "answer": answer,
+            "links": links or [],
+            "created_at": now,
+            "last_used_at": now,
+            "expires_at": now + timedelta(seconds=self.ttl_seconds)
+        }
+        if self.embedding_service is not None:
+            doc["embedding"] = self.embedding_service.embed_query(normalized)
+        self.collection.update_one({"_id": self.key(query)}, {"$set": doc, "$setOnInsert": {"hit_count": 0}}, upsert=True)
+        self._evict()
+
+    def _evict(self):
+        excess = self.collection.estimated_document_count() - self.max_entries
+        if excess > 0:
+            stale = [d["_id"] for d in self.collection.find({}, {"_id": 1}).sort("last_used_at", ASCENDING).limit(excess)]
+            self.collection.delete_many({"_id": {"$in": stale}})
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.semantic_hits + self.misses
+            return {
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.semantic_hits) / lookups, 3) if lookups else 0
+            }
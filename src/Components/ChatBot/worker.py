@@ -0,0 +1,19 @@
+import os
+
+# This process is the worker, so chat.py must not start its own in-process one
+os.environ["JOB_WORKER_INLINE"] = "0"
+
+from job_queue import start_worker_threads
+from chat import job_queue  # importing chat registers the task handlers
+
+if __name__ == '__main__':
+    # Usage: python worker.py
+    # Threads per queue: JOB_WORKER_THREADS (default queue), JOB_INGEST_WORKER_THREADS (ingest queue),
+    # JOB_BULK_WORKER_THREADS (bulk queue), JOB_BACKFILL_WORKER_THREADS (backfill queue)
+    poll_interval = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))
+    stop_event = start_worker_threads(job_queue, poll_interval=poll_interval)
+    try:
+        while not stop_event.wait(1.0):
+            pass
+    except KeyboardInterrupt:
+        stop_event.set()
@@ -10,12 +10,12 @@ start /b mongod --dbpath=./data/db
 
 REM Install required Python packages
 echo Installing Python packages...
-pip install flask flask-pymongo flask-bcrypt flask-jwt-extended python-dotenv requests flask-cors sentence-transformers pinecone-client
+pip install flask flask-pymongo flask-bcrypt flask-jwt-extended python-dotenv requests flask-cors sentence-transformers pinecone-client waitress tiktoken
 
 REM Start the backend server
 echo Starting Backend Server...
 cd src\Components\ChatBot
-start /b python chat.py
+start /b python serve.py
 
 REM Wait a moment for the backend to initialize
 timeout /t 5